@@ -1,13 +1,17 @@
 import sys
 import os
 import json
-import requests
 import uuid
 import random
 import time
 from datetime import datetime, timedelta
 from modules.version import VERSION
-from modules.chess_core import json_to_board, board_to_json, is_legal_move, apply_move, boards_equal, detect_move, find_checkers, is_game_active, game_result, show_board, repair_json_board, warn_if_in_check
+from modules.chess_core import json_to_board, board_to_json, is_legal_move, apply_move, boards_equal, detect_move, find_checkers, is_game_active, game_result, show_board, warn_if_in_check
+from modules.move_parser import resolve_move
+from modules.json_extractor import extract_json_object
+from modules.proxy_client import ProxyClient, ProxyError, make_proxy_client, collect_stream
+from modules.prompt_codec import encode_board, board_format_description, check_encoding, DEFAULT_PROMPT_ENCODING
+from modules.model_registry import ModelRouter, router_from_config
 from utils.app_utils import load_config 
 from utils.file_utils import save_content_in_file
 from utils.constants import OUT_FOLDER_PARAMETER, DEFAULT_CONFIG_FILE
@@ -15,27 +19,19 @@ from utils.constants import OUT_FOLDER_PARAMETER, DEFAULT_CONFIG_FILE
 # TODO porta questo in un file di configurazione config.json
 DEFAULT_MODEL = "gpt-4.1-nano"  # Modello predefinito se non specificato
 
-# Mappa dei modelli con i loro ID
-model_map: dict[int, str] = {
-    0: "gpt-4o-mini",  # 0.15
-    1: "gpt-4o",    #$2.50
-    2: "gpt-4.1-nano", # 0.10
-    3: "gpt-4.1-mini", # $0.40
-    4: "o4-mini",     # $1.10
-    5: "gpt-4.1"   #$2.00
-}
-
-def get_model_gear(name: str) -> int:
-    """
-    Ritorna l'indice del modello dato il suo nome,
-    oppure 0 se name è None o non si trova in inv_model_map.
-    """
-    if not name:
-        return 0
-    for idx, model in model_map.items():
-        if model == name:
-            return idx
-    return 0
+# Router dei modelli: sceglie il modello per ogni richiesta in base a esiti recenti, latenza p95 e costo
+# (scala dei modelli in modules/model_registry.py), riconfigurato in main() dal file di configurazione (MODEL_ROUTER)
+router = ModelRouter(start_model=DEFAULT_MODEL)
+
+# Client del proxy OpenAI (connessione keep-alive condivisa), riconfigurato in main() dal file di configurazione
+proxy = ProxyClient()
+# Se True le risposte dell'LLM arrivano in streaming (/chat/stream) e vengono mostrate man mano (config PROXY_STREAM)
+STREAM_REPLIES = False
+# Codifica della scacchiera nei prompt: "json" (default) o "fen" (config PROMPT_ENCODING)
+PROMPT_ENCODING = DEFAULT_PROMPT_ENCODING
+
+def print_delta(delta: str):
+    print(delta, end="", flush=True)
 
 # 
 def validate_params():
@@ -108,9 +104,9 @@ def init_chatgpt_session(board_state, language='italiano'):
     Regole:
     - La lingua dei messaggi di gioco deve essere in {language}.
     - La lingua dei messaggi di errore o di avvertimento sarà in inglese, tra parentesi quadre []: sono indicazioni che ti aiuteranno a migliorare il gioco.
-    - Sei un esperto di gioco di scacchi, devi analizzare la seguente situazione di gioco, rappresentata da una codifica in formato JSON che mostra lo stato dell'organizzazione dei pezzi neri e bianchi sulla scacchiera. 
-    {json.dumps(board_state, indent=4)}
-    - Tu giochi dalla parte dei Neri e devi rispondere alla mossa proposta dai Bianchi che verrà comunicata in ogni messaggio (nel formato "origine-destinazione") insieme alla stato completo della scacchiera in JSON. 
+    - Sei un esperto di gioco di scacchi, devi analizzare la seguente situazione di gioco, rappresentata da {board_format_description(PROMPT_ENCODING)}. 
+    {encode_board(board_state, PROMPT_ENCODING, indent=4)}
+    - Tu giochi dalla parte dei Neri e devi rispondere alla mossa proposta dai Bianchi che verrà comunicata in ogni messaggio (nel formato "origine-destinazione") insieme alla stato completo della scacchiera nella stessa codifica. 
     - La partita è finita quando uno delle due liste di Re è vuota.
     """
 
@@ -137,19 +133,14 @@ def init_chatgpt_session(board_state, language='italiano'):
         ] 
 
     # 2. Chiama l’endpoint /chat/init
-    resp = requests.post(
-        "http://localhost:5000/chat/init",
-        json={"system_messages": system_messages},
-        headers={"Content-Type": "application/json"}
-    )
     print("Let's start ChatGPT Session...")
     # 3. Controlla l’esito
-    if resp.status_code == 200:
-        result = resp.json()
+    try:
+        result = proxy.init(system_messages)
         print("System messages added:", result["added_system_messages"])
         print("System messages skipped:", result["skipped_system_messages"])
-    else:
-        print(f"Errore {resp.status_code}: {resp.text}")
+    except ProxyError as e:
+        print(f"Errore {e.status_code}: {e.message}")
 
 
 def get_last_assistant_message():
@@ -157,13 +148,12 @@ def get_last_assistant_message():
     Rimuove l’ultimo messaggio (sia user che assistant): 
     se vuoi solo assistant, potresti poi controllare il role di ritorno.
     """
-    resp = requests.post(f"http://localhost:5000/chat/last/assistant")
-    if resp.ok:
-        last = resp.json()["last"]
+    try:
+        last = proxy.last_assistant()
         # print("[DEBUG] ✅ Last message:", last)
         return last
-    else:
-        print(f"❌ Error {resp.status_code}:", resp.text)
+    except ProxyError as e:
+        print(f"❌ Error {e.status_code}:", e.message)
         return None
 
 def get_last_user_message():
@@ -171,13 +161,12 @@ def get_last_user_message():
     Rimuove l’ultimo messaggio (sia user che assistant): 
     se vuoi solo assistant, potresti poi controllare il role di ritorno.
     """
-    resp = requests.post(f"http://localhost:5000/chat/last/user")
-    if resp.ok:
-        last = resp.json()["last"]
+    try:
+        last = proxy.last_user()
         # print("[DEBUG] ✅ Last message:", last)
         return last
-    else:
-        print(f"❌ Error {resp.status_code}:", resp.text)
+    except ProxyError as e:
+        print(f"❌ Error {e.status_code}:", e.message)
         return None
 
 def remove_last_assistant_message():
@@ -185,59 +174,53 @@ def remove_last_assistant_message():
     Rimuove l’ultimo messaggio (sia user che assistant): 
     se vuoi solo assistant, potresti poi controllare il role di ritorno.
     """
-    resp = requests.post(f"http://localhost:5000/chat/pop/assistant")
-    if resp.ok:
-        popped = resp.json()["popped"]
+    try:
+        popped = proxy.pop_assistant()
         # print("[DEBUG] ✅ Pop Message:", popped)
         return popped
-    else:
-        print(f"❌ Error {resp.status_code}:", resp.text)
+    except ProxyError as e:
+        print(f"❌ Error {e.status_code}:", e.message)
         return None
 
 def send_message_to_proxy_service(role="user", content = ""):
 
-    resp = requests.post(
-        f"http://localhost:5000/chat/append",
-        json={"role": role, "content": content},
-        headers={"Content-Type": "application/json"}
-    )
-    if resp.ok:
-        data = resp.json()
+    try:
+        data = proxy.append(role, content)
         # print("[DEBUG] ✅ Append Message:", data["appended"])
         # print("[DEBUG] 🔢 History Size:", data["history_size"])
-    else:
-        print(f"❌ Error {resp.status_code}:", resp.text)
+    except ProxyError as e:
+        print(f"❌ Error {e.status_code}:", e.message)
+
+def attempt_outcome(model: str, latency: float) -> dict:
+    """
+    Parametri di router.record() per l'ultima richiesta: modello, latenza e token riportati dal proxy
+    (0 se la richiesta è fallita o la risposta è servita dalla cache), da cui il router stima il costo.
+    """
+    usage = proxy.last_usage or {}
+    return {
+        "model": model,
+        "latency": latency,
+        "prompt_tokens": usage.get("prompt_tokens", 0),
+        "completion_tokens": usage.get("completion_tokens", 0)
+    }
 
 def send_chess_move_to_chatgpt(board_state, proposed_action, model: str = DEFAULT_MODEL,
              temperature: float = 0.5, language='italiano'):
     prompt_text = f"""
-    Input: Fornisco lo stato corrente della scacchiera in formato JSON.
-    {json.dumps(board_state, indent=4)}
+    Input: Fornisco lo stato corrente della scacchiera.
+    {encode_board(board_state, PROMPT_ENCODING, indent=4)}
     Mossa proposta dai Bianchi: {proposed_action}
     """
     
-    # 3. Prepara il payload JSON
-    payload = {
-        "prompt": prompt_text,
-        "model": model,
-        "temperature": temperature
-    }
-
-    # 4. Invia la richiesta al tuo Flask server in ascolto su localhost:5000
-    response = requests.post(
-        "http://localhost:5000/chat",
-        json=payload,
-        headers={"Content-Type": "application/json"}
-    )
-
-    # 5. Gestisci la risposta
-    if response.status_code == 200:
-        response_data = response.json()
-        # print(f"[DEBUG] ChatGPT response: {response_data}")
-        return response_data["response"]
-    else:
-        response_data = response.json()
-        # print(f"[DEBUG] ChatGPT error response: {response_data}")
+    # 3. Invia la richiesta al proxy OpenAI e gestisci la risposta
+    try:
+        if STREAM_REPLIES:
+            answer = collect_stream(proxy.chat_stream(prompt_text, model=model, temperature=temperature), print_delta)
+            print()
+            return answer
+        return proxy.chat(prompt_text, model=model, temperature=temperature)
+    except ProxyError as e:
+        # print(f"[DEBUG] ChatGPT error response: {e}")
         return None
                            
 def play_match(config, json_board, execution_id, is_human_turn):
@@ -246,7 +229,7 @@ def play_match(config, json_board, execution_id, is_human_turn):
 
     # TODO: utilizzare config per parametri come modello, temperatura, ecc.
     # print(f"Configurazione partita: {config}")
-    CURRENT_MODEL = DEFAULT_MODEL  # Modello attualmente in uso
+    CURRENT_MODEL = router.choose()  # Modello attualmente in uso (scelto dal router)
     START_TIME = datetime.now()
     TIME_LIMIT = timedelta(minutes=45)
     RETRY_TIME = 3
@@ -269,9 +252,11 @@ def play_match(config, json_board, execution_id, is_human_turn):
         if is_human_turn:
             # Aspetta input da tastiera
             # Formato atteso: "<piece> <from_sq> <to_sq>", es. "P a2 a3"
-            user_input = input("Enter move (eg. P a2 a3): ").strip().split()
-            if len(user_input) != 3:
-                print("Invalid input, use: <piece> <origin> <destination>")
+            # accetta anche la notazione algebrica (es. "e2-e4", "Nf3", "P e2 - e4")
+            try:
+                user_input = list(resolve_move(input("Enter move (eg. P a2 a3): "), board_prev, "white"))
+            except ValueError as e:
+                print(f"Invalid input, use: <piece> <origin> <destination> ({e})")
                 continue
 
             piece_code, from_sq, to_sq = user_input
@@ -310,20 +295,28 @@ def play_match(config, json_board, execution_id, is_human_turn):
             computer_response = None
 
             detect_ai_move = None
+            # esito da registrare nel router per l'ultimo tentativo (modello, latenza e token)
+            attempt = None
             while computer_response is None and retry_count < max_retries:
+                if attempt is not None:
+                    # il tentativo precedente non ha prodotto una mossa valida: il router può già salire di modello
+                    router.record(success=False, **attempt)
                 retry_count += 1
+                CURRENT_MODEL = router.choose()
                 temperature = random.uniform(0.70, 0.95)  # Imposta una temperatura casuale tra 0.70 e 0.95
+                started = time.monotonic()
                 computer_response = send_chess_move_to_chatgpt(board_to_json(board_prev), f"{from_sq}-{to_sq}", model=CURRENT_MODEL, temperature=temperature)
+                attempt = attempt_outcome(CURRENT_MODEL, time.monotonic() - started)
 
                 if computer_response is None:
                     print("[DEBUG] No response from ChatGPT. Retrying...")
                     time.sleep(RETRY_TIME)
                     continue
 
-                # Prova a riparare il JSON se necessari
+                # Estrae l'oggetto JSON dalla risposta, riparandolo se necessario
                 try:
-                    computer_response = repair_json_board(computer_response)    
-                except Exception as e:
+                    board = extract_json_object(computer_response)
+                except ValueError as e:
                     print(f"Error repairing JSON: {e}")
                     # Rimuove l'ultimo messaggio assistant visto che JSON non è valido
                     remove_last_assistant_message()
@@ -333,7 +326,6 @@ def play_match(config, json_board, execution_id, is_human_turn):
                     continue
 
                 # Trasforomo la risposta di chatgpt nell'ipotetico stato futuro della scacchiera
-                board = json.loads(computer_response)
                 board_next = json_to_board(board)
 
                 try:
@@ -350,39 +342,31 @@ def play_match(config, json_board, execution_id, is_human_turn):
                         send_message_to_proxy_service(role="user", content=f"[{move_feedback_message}]")
                         computer_response = None
                 except Exception as e1:
-                    # forse chatgpt ha giocato correttamente, ma non ha aggiornato lo stato della scacchiera, in questo caso devo insegnargli come fare
+                    # forse chatgpt ha giocato correttamente, ma non ha aggiornato lo stato della scacchiera:
+                    # risolviamo direttamente la mossa proposta contro le mosse legali, senza un nuovo round trip
                     print(f"[DEBUG] Error during move detection: {e1}")
-                    board_feedback_message = "" # str(e1)
-                    message_removed = get_last_assistant_message()
-                    payload = {}
-                    try:
-                        payload = json.loads(message_removed['content'])
-                    except json.JSONDecodeError as e2:
-                        # qui puoi loggare l’errore e decidere un fallback
-                        print("Malformed JSON:", e2)
-                    move = payload.get('mossa_proposta', None)
-                    # ad una prima analisi la differenza tra lo stato della scacchiera successivamente alla mossa proposta da assistant non sembra corretta
-                    if move is not None:
-                        move = move.replace("x", "-").lower().strip() # rimuovo eventuali x che non sono necessarie
-                        board_feedback_message += f" Assistant (Black) propose the move: '{move}', but something seems not coherent with the board definition."
-                        if boards_equal(board_prev, board_next):
-                            # se sono uguali probabilmente assistant non ha aggiornato la board_next, facciamolo noi e istruiamolo       
-                            if move is not None and '-' in move:
-                                try:
-                                    from_sq, to_sq = move.split('-')
-                                    if is_legal_move(None, from_sq, to_sq, board_prev, "black"):
-                                        # applichiamo la mossa proposta da assistant
-                                        correct_board_next = board_to_json(apply_move(None, from_sq, to_sq, board_prev))
-                                        print(f"[DEBUG] Board updated with move: {move}")
-                                        board_feedback_message += f" Error: the board state has not changed after the move '{move}', update the board in this way: {correct_board_next}"
-                                except Exception as e3:
-                                    print(f"[ERROR] Failed to apply move: {e3}")
-                                    board_feedback_message += f" Error: failed to apply the move '{move}' on the board, please ensure you update the board correctly."
-                    else:
-                         board_feedback_message += f"Assistant (Black) did not propose a valid move, please provide a valid move for the actual board state: {board_to_json(board_prev)}"
-                    send_message_to_proxy_service(role="user", content=f"[{board_feedback_message}]")
-                    computer_response = None
-                    continue
+                    move = board.get('mossa_proposta', None)
+                    resolved = None
+                    if move:
+                        try:
+                            resolved = resolve_move(move, board_prev, "black")
+                        except ValueError as e3:
+                            print(f"[DEBUG] Cannot resolve proposed move: {e3}")
+
+                    if resolved is None:
+                        if move:
+                            board_feedback_message = f"Assistant (Black) propose the move: '{move}', but it is not legal or not coherent with the actual board state: {board_to_json(board_prev)}"
+                        else:
+                            board_feedback_message = f"Assistant (Black) did not propose a valid move, please provide a valid move for the actual board state: {board_to_json(board_prev)}"
+                        send_message_to_proxy_service(role="user", content=f"[{board_feedback_message}]")
+                        computer_response = None
+                        continue
+
+                    # applichiamo noi la mossa proposta da assistant
+                    detect_ai_move = resolved
+                    board_next = apply_move(resolved[0], resolved[1], resolved[2], board_prev)
+                    computer_response = json.dumps({**board, **board_to_json(board_next)}, indent=4, ensure_ascii=False)
+                    print(f"[DEBUG] Board updated with move: '{move}' -> {resolved[1]}-{resolved[2]}")
                 
                 if computer_response is not None:
                     warn_checkers = warn_if_in_check(board_next, "black", detect_ai_move)
@@ -396,35 +380,44 @@ def play_match(config, json_board, execution_id, is_human_turn):
                     # TODO il salvataggio della risposta in un file è opzionale, andrebbe storicizzato in un database
                     save_content_in_file(computer_response, "resources/responses", f"chat-{execution_id}")
 
-                    print(f"[DEBUG] Response from ChatGpt: '{json.loads(computer_response).get('commento_giocatore', '{}')}'")
+                    print(f"[DEBUG] Response from ChatGpt: '{board.get('commento_giocatore', '{}')}'")
                     
                     if retry_count > 2:
                         send_message_to_proxy_service(role="user", content=f"[CONGRATULATIONS! Assistant (Black) played last move with success.]")
             
-            if detect_ai_move is not None and computer_response is not None:
+            # esito dell'ultimo tentativo per il router: l'unico che può aver prodotto una mossa legale
+            move_found = detect_ai_move is not None and computer_response is not None
+            if attempt is not None:
+                router.record(success=move_found, **attempt)
+
+            if move_found:
                 board_prev = board_next
                 is_human_turn = True
                 print(f"Correct Move detected: {detect_ai_move[0]} {detect_ai_move[1]}->{detect_ai_move[2]}")
             else:
-                gear_up = get_model_gear(CURRENT_MODEL)+1
-                CURRENT_MODEL = model_map.get(gear_up, DEFAULT_MODEL)
-                print(f"[DEBUG] Engine cannot retrieve a correct move from ChatGPT, trying to increase model gear to: {CURRENT_MODEL}")
+                print(f"[DEBUG] Engine cannot retrieve a correct move from ChatGPT, next model chosen by the router: {router.choose()}")
                 continue
                 
     return game_result(board_prev)
 
 def main():
+    global proxy, router, STREAM_REPLIES, PROMPT_ENCODING
     params = validate_params()
 
     if len(params) >= 1 and ('-config' in [param.lower() for param in params]):
         config = load_config(params[1])
     else: 
         config = load_config()
+    execution_id = str( uuid.uuid4())
+    print(f"Execution ID: {execution_id}")
+    # una sessione del proxy per esecuzione: più partite in parallelo non condividono la storia
+    proxy = make_proxy_client(config, session_id=execution_id)
+    STREAM_REPLIES = bool(config.get("PROXY_STREAM", False))
+    PROMPT_ENCODING = check_encoding(config.get("PROMPT_ENCODING", DEFAULT_PROMPT_ENCODING))
+    router = router_from_config(config, DEFAULT_MODEL)
     
     # TODO imposta un parametro per la cartella di output
     output_folder =  os.getcwd() + config.get("folders", {}).get(OUT_FOLDER_PARAMETER, "/out/")
-    execution_id = str( uuid.uuid4())
-    print(f"Execution ID: {execution_id}")
 
     is_human_turn = True
 
@@ -0,0 +1,300 @@
+import os
+import math
+import time
+import asyncio
+import logging
+import itertools
+import threading
+from contextlib import contextmanager, asynccontextmanager
+from modules.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Peso dell'ultima richiesta nella media mobile del tempo di servizio
+SERVICE_TIME_WEIGHT = 0.2
+
+ADMISSION_IN_FLIGHT = REGISTRY.gauge(
+    "promptchess_admission_in_flight", "Richieste ammesse e in corso", ("scope",))
+ADMISSION_QUEUE_DEPTH = REGISTRY.gauge(
+    "promptchess_admission_queue_depth", "Richieste in attesa di essere ammesse", ("scope",))
+ADMISSION_WAIT = REGISTRY.histogram(
+    "promptchess_admission_wait_seconds", "Attesa in coda prima dell'ammissione", ("scope",))
+ADMISSION_SHED = REGISTRY.counter(
+    "promptchess_admission_shed_total",
+    "Richieste rifiutate con 503 per motivo (queue_full, deadline, timeout)", ("scope", "reason"))
+
+
+def _wake(future):
+    # eseguita nel loop del task in attesa (call_soon_threadsafe): il task potrebbe essere già scaduto
+    if not future.done():
+        future.set_result(True)
+
+
+class Overloaded(Exception):
+    """
+    Il servizio è saturo: la richiesta è stata rifiutata senza essere eseguita.
+    retry_after sono i secondi suggeriti al client prima di riprovare (header Retry-After).
+    """
+
+    def __init__(self, message: str, retry_after: int = 1, reason: str = "queue_full"):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class AdmissionController:
+    """
+    Controllo di ammissione per le richieste che occupano un thread (o un task) in attesa dell'LLM:
+    - al massimo max_concurrent richieste in corso per processo e max_per_user per utente;
+    - le altre attendono in una coda FIFO di al massimo max_queue posti (una richiesta di un utente
+      al proprio limite non blocca quelle degli utenti dopo di lui);
+    - nessuna richiesta attende più di max_wait secondi (o del timeout indicato dal client); se il
+      tempo di attesa stimato dal tempo medio di servizio supera già questo limite, la richiesta
+      viene rifiutata subito invece di scadere in coda.
+    Le richieste rifiutate sollevano Overloaded, che i servizi traducono in 503 con Retry-After.
+    max_concurrent o max_per_user None (o 0) = nessun limite.
+    """
+
+    def __init__(self, max_concurrent: int = 32, max_per_user: int = 4, max_queue: int = 64,
+                 max_wait: float = 10.0, scope: str = "proxy", clock=time.monotonic):
+        self.max_concurrent = max_concurrent or None
+        self.max_per_user = max_per_user or None
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.scope = scope
+        self.clock = clock
+        self._lock = threading.Condition()
+        self._active = 0
+        self._per_user = {}
+        # coda FIFO di ticket (sequenza, utente)
+        self._queue = []
+        # ticket delle richieste asincrone -> (loop, future) risolto quando il ticket viene ammesso
+        self._waiters = {}
+        self._seq = itertools.count()
+        # media mobile della durata delle richieste ammesse (None finché non ne termina una)
+        self._service_time = None
+        self._stats = {"admitted": 0, "shed": 0}
+
+    # -- stato (con il lock acquisito) ------------------------------------
+
+    def _has_room(self, user: str) -> bool:
+        if self.max_concurrent is not None and self._active >= self.max_concurrent:
+            return False
+        return self.max_per_user is None or self._per_user.get(user, 0) < self.max_per_user
+
+    def _start(self, user: str):
+        self._active += 1
+        self._per_user[user] = self._per_user.get(user, 0) + 1
+        self._stats["admitted"] += 1
+        self._publish()
+
+    def _publish(self):
+        ADMISSION_IN_FLIGHT.set(self._active, scope=self.scope)
+        ADMISSION_QUEUE_DEPTH.set(len(self._queue), scope=self.scope)
+
+    def _estimated_wait(self, position: int) -> float:
+        """
+        Attesa stimata per la richiesta in posizione position della coda (1 = la prossima).
+        """
+        if self._service_time is None:
+            return 0.0
+        return self._service_time * position / (self.max_concurrent or 1)
+
+    def _retry_after(self) -> int:
+        return max(1, math.ceil(self._estimated_wait(len(self._queue) + 1)))
+
+    def _shed(self, reason: str, message: str):
+        self._stats["shed"] += 1
+        ADMISSION_SHED.inc(scope=self.scope, reason=reason)
+        logger.warning(f"Richiesta rifiutata ({self.scope}, {reason}): {message}")
+        return Overloaded(message, retry_after=self._retry_after(), reason=reason)
+
+    def _enqueue(self, user: str, budget: float):
+        """
+        Ammette subito la richiesta (ritorna None) oppure la mette in coda e ritorna il ticket;
+        solleva Overloaded se la coda è piena o l'attesa stimata supera budget.
+        """
+        if not self._queue and self._has_room(user):
+            self._start(user)
+            return None
+        if len(self._queue) >= self.max_queue:
+            raise self._shed("queue_full", f"Coda piena ({self.max_queue} richieste in attesa)")
+        estimated = self._estimated_wait(len(self._queue) + 1)
+        if estimated > budget:
+            raise self._shed("deadline", f"Attesa stimata {estimated:.1f}s oltre il limite di {budget:.1f}s")
+        ticket = (next(self._seq), user)
+        self._queue.append(ticket)
+        self._publish()
+        return ticket
+
+    def _admit(self, ticket):
+        self._queue.remove(ticket)
+        self._start(ticket[1])
+
+    def _dispatch(self):
+        """
+        Ammette in ordine i ticket asincroni che hanno posto e sveglia i loro task nel rispettivo loop;
+        si ferma al primo ticket sincrono ammissibile, che parte per primo quando il suo thread si sveglia.
+        """
+        for ticket in list(self._queue):
+            if not self._has_room(ticket[1]):
+                continue
+            waiter = self._waiters.pop(ticket, None)
+            if waiter is None:
+                break
+            self._admit(ticket)
+            loop, future = waiter
+            loop.call_soon_threadsafe(_wake, future)
+
+    def _changed(self):
+        # lo stato è cambiato (posto liberato, ticket ammesso o tolto): sveglia chi può partire
+        self._publish()
+        self._dispatch()
+        self._lock.notify_all()
+
+    def _poll(self, ticket) -> bool:
+        """
+        Ammette il ticket se c'è posto e nessun ticket precedente può partire prima di lui.
+        """
+        for queued in self._queue:
+            if queued is ticket:
+                break
+            if self._has_room(queued[1]):
+                return False
+        if not self._has_room(ticket[1]):
+            return False
+        self._admit(ticket)
+        self._changed()
+        return True
+
+    def _remove(self, ticket):
+        if ticket in self._queue:
+            self._queue.remove(ticket)
+            self._changed()
+
+    def _budget(self, timeout) -> float:
+        return self.max_wait if timeout is None else max(0.0, min(self.max_wait, timeout))
+
+    def _finish(self, user: str):
+        self._active -= 1
+        self._per_user[user] -= 1
+        if not self._per_user[user]:
+            del self._per_user[user]
+
+    def _releaser(self, user: str):
+        """
+        Funzione che libera il posto della richiesta (idempotente: chiamarla più volte non ha effetto).
+        """
+        started = self.clock()
+        released = []
+
+        def release():
+            with self._lock:
+                if released:
+                    return
+                released.append(True)
+                self._finish(user)
+                elapsed = self.clock() - started
+                self._service_time = elapsed if self._service_time is None else (
+                    SERVICE_TIME_WEIGHT * elapsed + (1 - SERVICE_TIME_WEIGHT) * self._service_time)
+                self._changed()
+        return release
+
+    # -- API ----------------------------------------------------------------
+
+    def acquire(self, user: str = None, timeout: float = None):
+        """
+        Attende (al massimo max_wait o timeout secondi) un posto per la richiesta di user
+        e ritorna la funzione che lo libera; solleva Overloaded se il servizio è saturo.
+        """
+        user = user or ""
+        queued_at = self.clock()
+        budget = self._budget(timeout)
+        with self._lock:
+            ticket = self._enqueue(user, budget)
+            try:
+                while ticket is not None and not self._poll(ticket):
+                    remaining = queued_at + budget - self.clock()
+                    if remaining <= 0:
+                        self._remove(ticket)
+                        raise self._shed("timeout", f"Nessun posto libero entro {budget:.1f}s")
+                    self._lock.wait(timeout=remaining)
+            except BaseException:
+                self._remove(ticket)
+                raise
+        ADMISSION_WAIT.observe(self.clock() - queued_at, scope=self.scope)
+        return self._releaser(user)
+
+    async def aacquire(self, user: str = None, timeout: float = None):
+        """
+        Come acquire(), senza bloccare l'event loop: il task attende un future che viene risolto
+        (da qualunque thread liberi un posto) quando il suo ticket è ammesso.
+        """
+        user = user or ""
+        queued_at = self.clock()
+        budget = self._budget(timeout)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            ticket = self._enqueue(user, budget)
+            if ticket is not None:
+                admitted = loop.create_future()
+                self._waiters[ticket] = (loop, admitted)
+                self._dispatch()
+        if ticket is not None:
+            try:
+                await asyncio.wait_for(admitted, budget)
+            except BaseException as e:
+                with self._lock:
+                    self._waiters.pop(ticket, None)
+                    queued = ticket in self._queue
+                    self._remove(ticket)
+                    if queued and isinstance(e, asyncio.TimeoutError):
+                        raise self._shed("timeout", f"Nessun posto libero entro {budget:.1f}s") from None
+                    if not queued and not isinstance(e, asyncio.TimeoutError):
+                        # ammesso mentre il task veniva cancellato: il posto torna libero senza essere usato
+                        self._finish(user)
+                        self._changed()
+                if queued or not isinstance(e, asyncio.TimeoutError):
+                    raise
+        ADMISSION_WAIT.observe(self.clock() - queued_at, scope=self.scope)
+        return self._releaser(user)
+
+    @contextmanager
+    def admit(self, user: str = None, timeout: float = None):
+        release = self.acquire(user, timeout)
+        try:
+            yield
+        finally:
+            release()
+
+    @asynccontextmanager
+    async def admit_async(self, user: str = None, timeout: float = None):
+        release = await self.aacquire(user, timeout)
+        try:
+            yield
+        finally:
+            release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **self._stats,
+                "in_flight": self._active,
+                "queued": len(self._queue),
+                "service_time": round(self._service_time, 3) if self._service_time is not None else None
+            }
+
+
+def admission_from_env(prefix: str = "PROXY", scope: str = "proxy") -> AdmissionController:
+    """
+    Crea il controllo di ammissione leggendo <prefix>_MAX_CONCURRENT (richieste in corso per processo,
+    default 32), <prefix>_MAX_PER_USER (per utente, default 4), <prefix>_MAX_QUEUE (posti in coda,
+    default 64) e <prefix>_QUEUE_TIMEOUT (secondi massimi di attesa in coda, default 10).
+    """
+    return AdmissionController(
+        max_concurrent=int(os.getenv(f"{prefix}_MAX_CONCURRENT", 32)),
+        max_per_user=int(os.getenv(f"{prefix}_MAX_PER_USER", 4)),
+        max_queue=int(os.getenv(f"{prefix}_MAX_QUEUE", 64)),
+        max_wait=float(os.getenv(f"{prefix}_QUEUE_TIMEOUT", 10)),
+        scope=scope
+    )
@@ -0,0 +1,870 @@
+import time
+import asyncio
+import logging
+import tiktoken
+from functools import lru_cache
+from collections import deque
+from itertools import chain, islice
+from modules.llm_cache import make_cache_key
+from modules.history_compaction import compact_board_history
+from modules.metrics import track_llm_call, record_llm_usage, usage_tokens
+from modules.model_registry import context_tokens, max_output_tokens
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = "gpt-4.1-nano"  # Modello predefinito se la richiesta non lo specifica
+# Token minimi da riservare alla risposta quando si riduce la storia
+DEFAULT_MIN_RESPONSE_TOKENS = 2048
+# Contesto massimo usato per storia e risposta anche se il modello ne accetta di più (es. 1M token di gpt-4.1):
+# oltre questa soglia la storia viene ridotta o sintetizzata invece di far crescere il costo di ogni mossa
+DEFAULT_MAX_CONTEXT_TOKENS = 32768
+# Overhead fisso per ruolo + delimitatori di ogni messaggio (cl100k_base)
+MESSAGE_TOKEN_OVERHEAD = 13
+# Byte stimati per messaggio oltre al contenuto (dizionario e ruolo), per la stima della memoria della sessione
+MESSAGE_SIZE_OVERHEAD = 32
+# Numero massimo di risposte candidate richieste in una sola chiamata (parametro n)
+MAX_CANDIDATES = 8
+# Prompt minimal per richiedere la sintesi del contesto (/chat/summarize)
+DEFAULT_SUMMARY_PROMPT = (
+    "Fornisci una sintesi strutturata e concisa delle richieste dell'utente emerse nella conversazione finora. "
+    "Evidenzia le intenzioni principali e riassumi i contenuti in forma sintetica e professionale."
+)
+# Intestazione del messaggio di sistema con la sintesi dei turni più vecchi (sintesi in background)
+SUMMARY_PREFIX = "Sintesi della conversazione precedente:"
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str):
+    """
+    Restituisce (e memorizza per modello) l'encoder tiktoken del modello.
+    Per i modelli non noti a tiktoken usa o200k_base; se l'encoder non è
+    disponibile (es. nessun accesso alla rete per scaricarlo) ritorna None.
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        pass
+    except Exception as e:
+        logger.warning(f"Encoder tiktoken non disponibile per {model}: {e}")
+        return None
+    try:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logger.warning(f"Encoder tiktoken non disponibile per {model}: {e}")
+        return None
+
+def count_tokens(content: str, model: str) -> int:
+    """
+    Conta i token di un singolo messaggio, overhead incluso.
+    Senza encoder usa la stima approssimativa 1 token ≃ 4 caratteri.
+    """
+    enc = get_encoding(model)
+    if enc is None:
+        return len(content) // 4 + MESSAGE_TOKEN_OVERHEAD
+    return len(enc.encode(content)) + MESSAGE_TOKEN_OVERHEAD
+
+def count_message_tokens(messages: list[dict], model: str) -> int:
+    """
+    Conta i token usati dalla lista di messages, includendo qualche overhead per
+    i metadati dei messaggi (13 token per messaggio su cl100k_base).
+    """
+    return sum(count_tokens(m["content"], model) for m in messages)
+
+def message_size(message: dict) -> int:
+    """
+    Stima approssimativa dei byte occupati in memoria da un messaggio.
+    """
+    return len(message.get("content", "")) + MESSAGE_SIZE_OVERHEAD
+
+def dynamic_max_tokens(model: str, messages: list[dict] = None, margin: int = 100, used: int = None) -> int:
+    """
+    Restituisce quanti token puoi allocare per la risposta:
+      max = min(modello.contesto_max - token_usati - margin, modello.max_output_tokens)
+    Se 'used' è già noto (es. il totale mantenuto da ChatSession) la storia non viene ricontata.
+    Assicura almeno un valore minimo di 0.
+    """
+    if used is None:
+        used = count_message_tokens(messages or [], model)
+
+    context_max = context_tokens(model)
+    available = min(context_max - used - margin, max_output_tokens(model))
+    return max(0, available)
+
+class ChatSession:
+    """
+    Sessione di chat con il modello.
+    I messaggi di sistema restano fissi in testa; i turni user/assistant sono tenuti in una deque
+    insieme al loro conteggio di token, così da poter sfrattare i più vecchi in O(1)
+    quando la storia supera il budget di token del modello o max_history messaggi.
+    """
+
+    def __init__(self, client, max_history=128, token_model: str = DEFAULT_MODEL,
+                 min_response_tokens: int = DEFAULT_MIN_RESPONSE_TOKENS, async_client=None, cache=None,
+                 scheduler=None, compact_boards: bool = True, summarizer=None,
+                 max_context_tokens: int = DEFAULT_MAX_CONTEXT_TOKENS):
+        self.client = client
+        # Client AsyncOpenAI, usato dal proxy asincrono (achat)
+        self.async_client = async_client
+        # Cache delle risposte (LLMCache), usata solo dalle richieste con use_cache=True
+        self.cache = cache
+        # Pianificatore dei limiti di rate per modello (RateLimitScheduler), opzionale
+        self.scheduler = scheduler
+        # Messaggi di sistema iniziali, come coppie [messaggio, token]
+        self._system = []
+        # Turni user/assistant, come coppie [messaggio, token], dal più vecchio al più recente
+        self._turns = deque()
+        # Totali correnti dei token (system e turni)
+        self._system_tokens = 0
+        self._turn_tokens = 0
+        # Byte stimati dei messaggi di sistema e dei turni (vedi message_size), aggiornati come i token
+        self._content_size = 0
+        # Modello usato per il conteggio incrementale dei token (quello dell'ultima richiesta, vedi use_token_model)
+        self.token_model = token_model
+        # Numero massimo di messaggi (escluso il system)
+        self.max_history = max_history
+        # Token da lasciare sempre liberi per la risposta
+        self.min_response_tokens = min_response_tokens
+        # Tetto al contesto usato per il budget della storia (vedi DEFAULT_MAX_CONTEXT_TOKENS)
+        self.max_context_tokens = max_context_tokens
+        # Se True, prima di ogni completion le scacchiere superate nei turni vengono compattate
+        self.compact_boards = compact_boards
+        # Indice del turno con l'ultima scacchiera: i turni precedenti sono già compattati
+        self._compacted_until = 0
+        # Sintesi in background dei turni più vecchi (BackgroundSummarizer), opzionale
+        self.summarizer = summarizer
+        # Sintesi corrente come coppia [messaggio, token], tra i messaggi di sistema e i turni
+        self._summary = None
+        # Sintesi in corso: (turni sintetizzati, Future/Task della completion)
+        self._summary_job = None
+        # Modello dell'ultima richiesta, per il budget usato dalla sintesi in background
+        self._last_model = token_model
+        # Funzione journal(entry) che riceve ogni modifica della storia prima che venga applicata
+        # (write-ahead log della sessione, vedi SessionWAL), opzionale
+        self.journal = None
+        # Contatore delle modifiche della storia: dice al registro se la sessione va salvata nello store
+        self.revision = 0
+        # Funzione usage_sink(model, prompt_tokens, completion_tokens, latency) che riceve i consumi di ogni
+        # completion (registro dei consumi per sessione e utente, vedi UsageLedger), opzionale
+        self.usage_sink = None
+        # Consumi dell'ultima completion ({model, prompt_tokens, completion_tokens}), None se servita dalla cache
+        self.last_usage = None
+        # Prompt dell'ultima richiesta di candidati: entra nella storia solo con la risposta scelta
+        self._pending_prompt = None
+
+    @property
+    def messages(self) -> list:
+        # Copia della storia nel formato atteso dall'API: le modifiche passano dai metodi della sessione
+        summary = [self._summary[0]] if self._summary else []
+        return [m for m, _ in self._system] + summary + [m for m, _ in self._turns]
+
+    @messages.setter
+    def messages(self, messages: list):
+        messages = list(messages)
+        self._log("reset", messages=messages)
+        journal, self.journal = self.journal, None
+        self._system = []
+        self._turns = deque()
+        self._system_tokens = 0
+        self._turn_tokens = 0
+        self._content_size = 0
+        self._compacted_until = 0
+        self._summary = None
+        self._summary_job = None
+        self._pending_prompt = None
+        try:
+            for m in messages:
+                self._add(m)
+        finally:
+            self.journal = journal
+
+    def __len__(self) -> int:
+        # numero di messaggi della storia in O(1), senza costruire la copia di messages
+        return len(self._system) + (1 if self._summary else 0) + len(self._turns)
+
+    @property
+    def size_bytes(self) -> int:
+        """
+        Byte stimati della storia (somma di message_size), mantenuti in O(1) ad ogni modifica.
+        """
+        return self._content_size + (message_size(self._summary[0]) if self._summary else 0)
+
+    @property
+    def system_message_count(self) -> int:
+        return len(self._system) + (1 if self._summary else 0)
+
+    @property
+    def total_tokens(self) -> int:
+        summary_tokens = self._summary[1] if self._summary else 0
+        return self._system_tokens + summary_tokens + self._turn_tokens
+
+    def _log(self, op: str, **fields):
+        self.revision += 1
+        if self.journal is not None:
+            self.journal({"op": op, **fields})
+
+    def _add(self, message: dict, left: bool = False):
+        self._log("add", message=message, left=left)
+        tokens = count_tokens(message["content"], self.token_model)
+        if message["role"] == "system" and message["content"].startswith(SUMMARY_PREFIX):
+            self._summary = [message, tokens]
+            return
+        self._content_size += message_size(message)
+        if message["role"] == "system":
+            self._system.append([message, tokens])
+            self._system_tokens += tokens
+        elif left:
+            self._turns.appendleft([message, tokens])
+            self._turn_tokens += tokens
+            if self._compacted_until:
+                self._compacted_until += 1
+        else:
+            self._turns.append([message, tokens])
+            self._turn_tokens += tokens
+
+    def _evict_oldest(self) -> dict:
+        self._log("evict")
+        message, tokens = self._turns.popleft()
+        self._turn_tokens -= tokens
+        self._content_size -= message_size(message)
+        self._compacted_until = max(0, self._compacted_until - 1)
+        return message
+
+    def _pop_turn(self, idx: int = -1) -> dict:
+        idx %= len(self._turns)
+        self._log("pop", index=idx)
+        message, tokens = self._turns[idx]
+        del self._turns[idx]
+        self._turn_tokens -= tokens
+        self._content_size -= message_size(message)
+        if idx < self._compacted_until:
+            self._compacted_until -= 1
+        return message
+
+    def use_token_model(self, model: str):
+        """
+        Conta i token con l'encoder di model: se è diverso da quello usato finora i conteggi dei
+        messaggi vengono ricalcolati (solo quando l'encoder cambia, non a ogni richiesta).
+        """
+        if model == self.token_model:
+            return
+        previous = getattr(get_encoding(self.token_model), "name", None)
+        self.token_model = model
+        if getattr(get_encoding(model), "name", None) == previous:
+            return
+        for pair in chain(self._system, self._turns, [self._summary] if self._summary else []):
+            pair[1] = count_tokens(pair[0]["content"], model)
+        self._system_tokens = sum(tokens for _, tokens in self._system)
+        self._turn_tokens = sum(tokens for _, tokens in self._turns)
+
+    def history_budget(self, model: str, margin: int = 100) -> int:
+        """
+        Token massimi che la storia può occupare per il modello, lasciando spazio alla risposta;
+        il contesto del modello è limitato a max_context_tokens.
+        """
+        context_max = min(context_tokens(model), self.max_context_tokens)
+        return context_max - self.min_response_tokens - margin
+
+    def trim_to_budget(self, model: str = None, margin: int = 100) -> int:
+        """
+        Sfratta i turni più vecchi (mai i messaggi di sistema né il turno più recente)
+        finché la storia rientra nel budget di token del modello e in max_history.
+        Ritorna il numero di messaggi rimossi.
+        """
+        # la storia viene contata con l'encoder dello stesso modello del budget
+        self.use_token_model(model or self.token_model)
+        budget = self.history_budget(self.token_model, margin)
+        removed = 0
+        while len(self._turns) > 1 and (self.total_tokens > budget or len(self._turns) > self.max_history):
+            self._evict_oldest()
+            removed += 1
+        if removed:
+            logger.debug(f"Rimossi {removed} messaggi meno recenti per rientrare nel budget di token")
+        return removed
+
+    def compact_history(self) -> int:
+        """
+        Sostituisce le scacchiere superate nei turni user/assistant con un riferimento alla mossa,
+        mantenendo l'ultima scacchiera e tutti i messaggi di feedback, e aggiorna i totali di token.
+        I turni già compattati non vengono rianalizzati. Ritorna il numero di messaggi compattati.
+        """
+        # solo i turni non ancora compattati: la deque non viene copiata per intero
+        start = self._compacted_until
+        pairs = list(islice(self._turns, start, None))
+        turns = [m for m, _ in pairs]
+        latest, compacted = compact_board_history(turns)
+        self._compacted_until = start + latest
+        if not compacted:
+            return 0
+        for offset in range(latest):
+            if turns[offset] is not pairs[offset][0]:
+                self._replace_turn(start + offset, turns[offset], pairs[offset])
+        logger.debug(f"Compattati {compacted} messaggi con scacchiere superate")
+        return compacted
+
+    def _replace_turn(self, index: int, message: dict, pair: list = None):
+        # sostituisce il contenuto di un turno aggiornando il totale dei token
+        self._log("replace", index=index, message=message)
+        pair = pair or self._turns[index]
+        tokens = count_tokens(message["content"], self.token_model)
+        self._turn_tokens += tokens - pair[1]
+        self._content_size += message_size(message) - message_size(pair[0])
+        pair[0], pair[1] = message, tokens
+
+    def apply_journal(self, entry: dict):
+        """
+        Riapplica una modifica registrata da journal (recupero della sessione dal write-ahead log).
+        """
+        journal, self.journal = self.journal, None
+        try:
+            op = entry["op"]
+            if op == "add":
+                self._add(entry["message"], left=entry.get("left", False))
+            elif op == "evict":
+                self._evict_oldest()
+            elif op == "pop":
+                self._pop_turn(entry["index"])
+            elif op == "replace":
+                self._replace_turn(entry["index"], entry["message"])
+            elif op == "reset":
+                self.messages = entry["messages"]
+            else:
+                raise ValueError(f"Operazione del journal sconosciuta: {op}")
+        finally:
+            self.journal = journal
+
+    def _summary_span(self, target_tokens: int, keep_turns: int) -> list:
+        # turni più vecchi da sintetizzare perché la storia scenda sotto target_tokens
+        span = []
+        excess = self.total_tokens - target_tokens
+        for index, pair in enumerate(self._turns):
+            if excess <= 0 or index >= len(self._turns) - keep_turns:
+                break
+            span.append(pair)
+            excess -= pair[1]
+        return span
+
+    def _summary_request(self, span: list, model: str) -> dict:
+        lines = []
+        if self._summary:
+            lines.append(self._summary[0]["content"])
+        lines.extend(f"{message['role']}: {message['content']}" for message, _ in span)
+        return {
+            "model": self.summarizer.model or model,
+            "messages": [
+                {"role": "system", "content": self.summarizer.prompt},
+                {"role": "user", "content": "\n\n".join(lines)}
+            ],
+            "temperature": 0.3
+        }
+
+    def schedule_summary(self, model: str = None) -> bool:
+        """
+        Se i token della sessione superano la soglia alta del sintetizzatore, avvia in background
+        la sintesi dei turni più vecchi (una sola alla volta per sessione). Non blocca il chiamante.
+        """
+        if self.summarizer is None or self._summary_job is not None:
+            return False
+        model = model or self._last_model
+        if not self.summarizer.should_summarize(self, model):
+            return False
+        span = self._summary_span(self.summarizer.target_tokens(self, model), self.summarizer.keep_turns)
+        if not span:
+            return False
+        future = self.summarizer.submit(self, self._summary_request(span, model))
+        if future is None:
+            return False
+        self._summary_job = (span, future)
+        logger.debug(f"Sintesi in background avviata su {len(span)} turni")
+        return True
+
+    def apply_pending_summary(self) -> bool:
+        """
+        Se la sintesi in background è terminata, sostituisce in un solo passo i turni sintetizzati
+        con il messaggio di sintesi. Da chiamare con il lock della sessione acquisito (lo fa prepare_chat).
+        Se nel frattempo quei turni sono cambiati (sfrattati o rimossi) la sintesi viene scartata.
+        """
+        if self._summary_job is None or not self._summary_job[1].done():
+            return False
+        span, future = self._summary_job
+        self._summary_job = None
+        try:
+            summary = future.result().choices[0].message.content
+        except BaseException as e:
+            logger.warning(f"Sintesi in background fallita: {e}")
+            self.summarizer.record("failed")
+            return False
+        if len(self._turns) < len(span) or any(self._turns[i] is not pair for i, pair in enumerate(span)):
+            self.summarizer.record("discarded")
+            return False
+        for _ in span:
+            self._evict_oldest()
+        self._add({"role": "system", "content": f"{SUMMARY_PREFIX}\n{summary}"})
+        self.summarizer.record("applied")
+        logger.debug(f"Sintesi in background applicata: {len(span)} turni sostituiti")
+        return True
+
+    def to_dict(self) -> dict:
+        """
+        Stato serializzabile della sessione (senza il client OpenAI).
+        """
+        return {
+            "messages": self.messages,
+            "system_message_count": self.system_message_count
+        }
+
+    def load_dict(self, data: dict):
+        """
+        Ripristina lo stato prodotto da to_dict().
+        """
+        self.messages = data.get("messages", [])
+
+    def has_message(self, role: str, content: str) -> bool:
+        """
+        Verifica se un messaggio con il dato role e content è già presente nella storia.
+        """
+        return any(
+            m.get("role") == role and m.get("content") == content
+            for m in self.messages
+        )
+    
+    def put_message(self, role: str, content: str):
+        # Aggiunge un messaggio e mantiene la storia entro il budget di token e max_history
+        self._add({"role": role, "content": content})
+        self.trim_to_budget()
+    
+    def prepend_message(self, role: str, content: str):
+        # Aggiunge un messaggio subito dopo il system (in testa alla storia)
+        # Mantiene il sistema al primo posto
+        self._add({"role": role, "content": content}, left=True)
+        # Se eccede la history, rimuove l'ultimo
+        if len(self._turns) > self.max_history:
+            self._pop_turn()
+
+    def pop_last_message(self):
+        # Rimuove l'ultimo messaggio (se non è il system)
+        if self._turns:
+            return self._pop_turn()
+        return None
+    
+    def pop_last_assistant(self):
+        """
+        Rimuove e restituisce l'ultimo messaggio con role 'assistant'.
+        Se non trova messaggi assistant (oltre al system), ritorna None.
+        """
+        # scorri la storia al contrario alla ricerca di un assistant
+        for idx in range(len(self._turns) - 1, -1, -1):
+            if self._turns[idx][0]["role"] == "assistant":
+                return self._pop_turn(idx)
+        return None
+
+    def clear_messages(self):
+        """
+        Rimuove tutti i messaggi dalla sessione.
+        """
+        self.messages = []
+    
+    def get_last_assistant(self):
+        """
+        Rimuove e restituisce l'ultimo messaggio con role 'assistant'.
+        Se non trova messaggi assistant (oltre al system), ritorna None.
+        """
+        # scorri la storia al contrario alla ricerca di un assistant
+        for message, _ in reversed(self._turns):
+            if message["role"] == "assistant":
+                return message
+        return None
+    
+    def get_last_user(self):
+        """
+        Rimuove e restituisce l'ultimo messaggio con role 'user'.
+        Se non trova messaggi user (oltre al system), ritorna None.
+        """
+        # scorri la storia al contrario alla ricerca di un user
+        for message, _ in reversed(self._turns):
+            if message["role"] == "user":
+                return message
+        return None
+
+    def add_initial_system(self, content: str, force : bool) -> bool:
+        """
+        Aggiunge un messaggio di sistema solo se NON sono ancora stati inviati
+        né messaggi user né assistant.
+        Ritorna True se il messaggio è stato aggiunto, False altrimenti.
+        """
+        # cerca eventuali turni 'user' o 'assistant'
+        has_interaction = len(self._turns) > 0
+        if not has_interaction:
+            # Se non ci sono interazioni, aggiunge il system solo se non esiste già
+            if not self.has_message("system", content):
+                self._add({"role": "system", "content": content})
+            return True
+        else:
+            if force:
+                # Se forzato, rimuove tutti i messaggi precedenti
+                self.clear_messages()
+                # Aggiunge il nuovo system come primo messaggio
+                self._add({"role": "system", "content": content})
+                return True
+        return False
+
+    def available_tokens(self, model: str, margin: int = 100) -> int:
+        """
+        Token disponibili per la risposta, calcolati in O(1) dal totale corrente della storia.
+        """
+        return dynamic_max_tokens(model, margin=margin, used=self.total_tokens)
+
+    def prepare_chat(self, prompt: str, model: str = DEFAULT_MODEL,
+                     temperature: float = 0.5, margin: int = 100) -> dict:
+        """
+        Aggiunge il prompt alla storia, la riduce al budget del modello e restituisce
+        i parametri della richiesta di completion (model, messages, temperature, max_tokens).
+        È condiviso dalla chiamata sincrona (chat) e da quella asincrona (achat).
+        """
+        if self.system_message_count == 0:
+            raise RuntimeError("Nessun messaggio di sistema iniziale. Usa /chat/init per aggiungerne uno.")
+
+        model = model or DEFAULT_MODEL
+        temperature = 0.5 if temperature is None else temperature
+        self._last_model = model
+        self.last_usage = None
+        self._pending_prompt = None
+
+        # 0) applica l'eventuale sintesi in background già pronta
+        self.apply_pending_summary()
+
+        # 1) append utente
+        last_user = self.get_last_user()
+        if last_user is not None and last_user.get('content') == prompt:
+            logger.debug("Messaggio utente già presente, non lo aggiungo.")
+        else:
+            self.put_message("user", prompt)
+
+        # 2) sostituisce le scacchiere superate con un riferimento alla mossa
+        if self.compact_boards:
+            self.compact_history()
+
+        # 3) riduce la storia al budget del modello richiesto e calcola max_tokens
+        self.trim_to_budget(model, margin=margin)
+        max_tokens = self.available_tokens(model, margin=margin)
+
+        logger.debug(f"Model: {model} - Token disponibili per la risposta: {max_tokens}")
+       
+        # resta possibile solo se i messaggi di sistema e il prompt da soli superano il contesto del modello
+        if max_tokens <= 0:
+            raise RuntimeError("Max tokens exceeded.")
+
+        return {
+            "model": model,
+            "messages": self.messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens
+        }
+
+    def commit_answer(self, answer: str) -> str:
+        # Aggiunge la risposta del modello (preceduta dal prompt, se era una richiesta di candidati)
+        if self._pending_prompt is not None:
+            prompt, self._pending_prompt = self._pending_prompt, None
+            self.put_message("user", prompt)
+        self.put_message("assistant", answer)
+        # oltre la soglia alta la sintesi dei turni più vecchi parte in background
+        self.schedule_summary()
+
+        logger.debug(f"dimensione chat: {len(self)}")
+        return answer
+
+    def _cached_answer(self, request: dict, use_cache: bool):
+        """
+        Ritorna (chiave, risposta in cache); la chiave è None se la cache non è richiesta o non configurata.
+        """
+        if not use_cache or self.cache is None:
+            return None, None
+        key = make_cache_key(request["model"], request["messages"], request["temperature"])
+        return key, self.cache.get(key)
+
+    def _account_usage(self, request: dict, answer: str, completion, started: float, prompt_estimate, sink) -> dict:
+        # token del prompt e della risposta (dal campo usage se presente, altrimenti stimati) per /metrics
+        # e per il registro dei consumi (sink), con la durata della chiamata misurata da 'started'
+        prompt_tokens, completion_tokens = usage_tokens(
+            completion, prompt_estimate, lambda: count_tokens(answer or "", self.token_model))
+        record_llm_usage(request["model"], prompt_tokens, completion_tokens)
+        if sink is not None:
+            latency = time.perf_counter() - started if started is not None else 0.0
+            sink(request["model"], prompt_tokens, completion_tokens, latency)
+        return {"model": request["model"], "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+
+    def _record_usage(self, request: dict, answer: str, completion=None, started: float = None):
+        self.last_usage = self._account_usage(request, answer, completion, started, self.total_tokens, self.usage_sink)
+
+    def _summary_completion(self, request: dict, priority: int = 0, sink=None):
+        """
+        Completion della sintesi in background (nel thread del sintetizzatore): i consumi vanno in /metrics
+        e nel registro dei consumi come le altre completion, al sink della richiesta che l'ha avviata.
+        """
+        started = time.perf_counter()
+        completion = self._create(request, priority)
+        self._account_usage(request, completion.choices[0].message.content, completion, started,
+                            lambda: count_message_tokens(request["messages"], self.token_model), sink)
+        return completion
+
+    async def _asummary_completion(self, request: dict, priority: int = 0, sink=None):
+        started = time.perf_counter()
+        completion = await self._acreate(request, priority)
+        self._account_usage(request, completion.choices[0].message.content, completion, started,
+                            lambda: count_message_tokens(request["messages"], self.token_model), sink)
+        return completion
+
+    def _create(self, request: dict, priority: int = 0, **options):
+        # Chiama l'API, passando dal pianificatore dei limiti di rate se configurato
+        def call():
+            with track_llm_call(request["model"], options.get("stream", False)):
+                return self.client.chat.completions.create(**request, **options)
+        if self.scheduler is None:
+            return call()
+        return self.scheduler.run(request["model"], self.total_tokens, call, priority=priority)
+
+    async def _acreate(self, request: dict, priority: int = 0, **options):
+        async def call():
+            with track_llm_call(request["model"], options.get("stream", False)):
+                return await self.async_client.chat.completions.create(**request, **options)
+        if self.scheduler is None:
+            return await call()
+        return await self.scheduler.arun(request["model"], self.total_tokens, call, priority=priority)
+
+    def chat(self, prompt: str, model: str = DEFAULT_MODEL,
+             temperature: float = 0.5, margin: int = 100, use_cache: bool = False, priority: int = 0) -> str:
+        
+        if self.client is None and not (use_cache and self.cache is not None):
+            raise RuntimeError("OPENAI_API_KEY not configured. Set the environment variable to enable AI features.")
+
+        request = self.prepare_chat(prompt, model, temperature, margin)
+
+        key, cached = self._cached_answer(request, use_cache)
+        if cached is not None:
+            logger.debug("Risposta servita dalla cache")
+            return self.commit_answer(cached)
+        if self.client is None:
+            raise RuntimeError("OPENAI_API_KEY not configured. Set the environment variable to enable AI features.")
+
+        # Chiama l'API
+        started = time.perf_counter()
+        completion = self._create(request, priority)
+        answer = completion.choices[0].message.content
+        self._record_usage(request, answer, completion, started)
+        if key is not None:
+            self.cache.put(key, answer)
+        return self.commit_answer(answer)
+
+    async def achat(self, prompt: str, model: str = DEFAULT_MODEL,
+                    temperature: float = 0.5, margin: int = 100, timeout: float = None,
+                    use_cache: bool = False, priority: int = 0) -> str:
+        """
+        Variante asincrona di chat() basata sul client AsyncOpenAI.
+        Se la richiesta supera 'timeout' secondi o il task viene cancellato,
+        la chiamata verso OpenAI viene interrotta e nessuna risposta è aggiunta alla storia.
+        """
+        if self.async_client is None and not (use_cache and self.cache is not None):
+            raise RuntimeError("OPENAI_API_KEY not configured. Set the environment variable to enable AI features.")
+
+        request = self.prepare_chat(prompt, model, temperature, margin)
+
+        key, cached = self._cached_answer(request, use_cache)
+        if cached is not None:
+            logger.debug("Risposta servita dalla cache")
+            return self.commit_answer(cached)
+        if self.async_client is None:
+            raise RuntimeError("OPENAI_API_KEY not configured. Set the environment variable to enable AI features.")
+
+        started = time.perf_counter()
+        completion = await asyncio.wait_for(self._acreate(request, priority), timeout)
+        answer = completion.choices[0].message.content
+        self._record_usage(request, answer, completion, started)
+        if key is not None:
+            self.cache.put(key, answer)
+        return self.commit_answer(answer)
+
+    def chat_stream(self, prompt: str, model: str = DEFAULT_MODEL,
+                    temperature: float = 0.5, margin: int = 100, use_cache: bool = False, priority: int = 0):
+        """
+        Variante in streaming di chat(): generatore che restituisce i frammenti di testo man mano che arrivano.
+        Al termine la risposta completa viene aggiunta alla storia; se il consumatore chiude il generatore
+        prima della fine, lo stream verso OpenAI viene chiuso e nessuna risposta è aggiunta.
+        """
+        if self.client is None and not (use_cache and self.cache is not None):
+            raise RuntimeError("OPENAI_API_KEY not configured. Set the environment variable to enable AI features.")
+
+        request = self.prepare_chat(prompt, model, temperature, margin)
+
+        key, cached = self._cached_answer(request, use_cache)
+        if cached is not None:
+            logger.debug("Risposta servita dalla cache")
+            yield cached
+            self.commit_answer(cached)
+            return
+        if self.client is None:
+            raise RuntimeError("OPENAI_API_KEY not configured. Set the environment variable to enable AI features.")
+
+        started = time.perf_counter()
+        stream = self._create(request, priority, stream=True)
+        parts = []
+        try:
+            for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    yield delta
+        finally:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                close()
+        answer = "".join(parts)
+        self._record_usage(request, answer, started=started)
+        if key is not None:
+            self.cache.put(key, answer)
+        self.commit_answer(answer)
+
+    async def achat_stream(self, prompt: str, model: str = DEFAULT_MODEL,
+                           temperature: float = 0.5, margin: int = 100, use_cache: bool = False,
+                           priority: int = 0):
+        """
+        Variante asincrona di chat_stream() basata sul client AsyncOpenAI.
+        """
+        if self.async_client is None and not (use_cache and self.cache is not None):
+            raise RuntimeError("OPENAI_API_KEY not configured. Set the environment variable to enable AI features.")
+
+        request = self.prepare_chat(prompt, model, temperature, margin)
+
+        key, cached = self._cached_answer(request, use_cache)
+        if cached is not None:
+            logger.debug("Risposta servita dalla cache")
+            yield cached
+            self.commit_answer(cached)
+            return
+        if self.async_client is None:
+            raise RuntimeError("OPENAI_API_KEY not configured. Set the environment variable to enable AI features.")
+
+        started = time.perf_counter()
+        stream = await self._acreate(request, priority, stream=True)
+        parts = []
+        try:
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    yield delta
+        finally:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                await close()
+        answer = "".join(parts)
+        self._record_usage(request, answer, started=started)
+        if key is not None:
+            self.cache.put(key, answer)
+        self.commit_answer(answer)
+
+    def _candidates_request(self, prompt: str, model: str, temperature: float, margin: int) -> dict:
+        """
+        Come prepare_chat(), ma il prompt aggiunto viene tolto subito dalla storia e tenuto da parte:
+        commit_answer lo aggiunge insieme alla risposta scelta, così se nessun candidato viene
+        confermato (o la chiamata fallisce) la storia non resta con un turno utente senza risposta.
+        """
+        last_user = self.get_last_user()
+        added = last_user is None or last_user.get('content') != prompt
+        request = self.prepare_chat(prompt, model, temperature, margin)
+        if added:
+            self._pop_turn()
+            self._pending_prompt = prompt
+        return request
+
+    def chat_candidates(self, prompt: str, model: str = DEFAULT_MODEL, temperature: float = 0.5,
+                        n: int = 3, margin: int = 100, priority: int = 0) -> list:
+        """
+        Chiede n risposte alternative al prompt in una sola chiamata (parametro n dell'API).
+        Né il prompt né le risposte vengono aggiunti alla storia: il chiamante valida i candidati e
+        conferma quello scelto con commit_answer (o /chat/append), che aggiunge prompt e risposta,
+        invece di un round trip per ogni tentativo.
+        """
+        if self.client is None:
+            raise RuntimeError("OPENAI_API_KEY not configured. Set the environment variable to enable AI features.")
+
+        request = self._candidates_request(prompt, model, temperature, margin)
+        started = time.perf_counter()
+        completion = self._create(request, priority, n=n)
+        answers = [choice.message.content for choice in completion.choices]
+        self._record_usage(request, "".join(a or "" for a in answers), completion, started)
+        logger.debug(f"{len(answers)} risposte candidate in una sola chiamata")
+        return answers
+
+    async def achat_candidates(self, prompt: str, model: str = DEFAULT_MODEL, temperature: float = 0.5,
+                               n: int = 3, margin: int = 100, timeout: float = None, priority: int = 0) -> list:
+        """
+        Variante asincrona di chat_candidates() basata sul client AsyncOpenAI.
+        """
+        if self.async_client is None:
+            raise RuntimeError("OPENAI_API_KEY not configured. Set the environment variable to enable AI features.")
+
+        request = self._candidates_request(prompt, model, temperature, margin)
+        started = time.perf_counter()
+        completion = await asyncio.wait_for(self._acreate(request, priority, n=n), timeout)
+        answers = [choice.message.content for choice in completion.choices]
+        self._record_usage(request, "".join(a or "" for a in answers), completion, started)
+        return answers
+
+    def _summary_plan(self) -> dict:
+        # i messaggi user sono solo nei turni: il controllo non richiede la copia della storia
+        if sum(1 for m, _ in self._turns if m.get("role") == "user") < 2:
+            raise ValueError("Sono necessari almeno 2 messaggi utente per eseguire la sintesi.")
+        messages = self.messages
+
+        # Indici di tutti i messaggi user (confronto per posizione, non per contenuto)
+        user_indexes = [i for i, m in enumerate(messages) if m.get("role") == "user"]
+
+        # Separa l'ultimo messaggio utente
+        last_index = user_indexes[-1]
+        # cronologia temporanea per la richiesta di sintesi: senza i messaggi user da sintetizzare
+        reduced = [m for i, m in enumerate(messages) if m.get("role") != "user" or i == last_index]
+
+        return {
+            "original": messages,
+            "last_user": messages[last_index],
+            # nuova cronologia ridotta, senza alcun messaggio user (l'ultimo viene reinserito dopo la sintesi)
+            "preserved": [m for m in messages if m.get("role") != "user"],
+            "reduced": reduced
+        }
+
+    def _apply_summary(self, plan: dict, summary: str) -> dict:
+        # Ricostruisci la chat session:
+        # 1. Rimuove tutti i messaggi user tranne l’ultimo
+        # 2. Inserisce la sintesi come messaggio system
+        # 3. Reinserisce l’ultimo messaggio utente
+        last_user_message = plan["last_user"]
+        self.messages = plan["preserved"]
+        self.put_message("system", f"Richiesta originale del cliente:\n{summary}")
+        self.put_message("user", last_user_message["content"])
+        return {"summary": summary, "preserved_user": last_user_message["content"]}
+
+    def summarize(self, prompt: str, model: str = DEFAULT_MODEL, temperature: float = 0.5) -> dict:
+        """
+        Sostituisce i messaggi user precedenti all'ultimo con una sintesi prodotta dall'LLM.
+        Ritorna {"summary", "preserved_user"}; in caso di errore la storia originale viene ripristinata.
+        """
+        plan = self._summary_plan()
+        self.messages = plan["reduced"]
+        try:
+            summary = self.chat(prompt, model=model, temperature=temperature)
+        except Exception:
+            self.messages = plan["original"]
+            raise
+        return self._apply_summary(plan, summary)
+
+    async def asummarize(self, prompt: str, model: str = DEFAULT_MODEL,
+                         temperature: float = 0.5, timeout: float = None) -> dict:
+        """
+        Variante asincrona di summarize().
+        """
+        plan = self._summary_plan()
+        self.messages = plan["reduced"]
+        try:
+            summary = await self.achat(prompt, model=model, temperature=temperature, timeout=timeout)
+        except BaseException:
+            self.messages = plan["original"]
+            raise
+        return self._apply_summary(plan, summary)
@@ -1,5 +1,10 @@
 import pandas as pd
 import json
+import re
+from modules.json_extractor import extract_json_object
+
+# Una FEN nel testo di un messaggio: posizionamento dei pezzi ed eventuali campi successivi
+FEN_PATTERN = re.compile(r"(?:[pnbrqkPNBRQK1-8]{1,8}/){7}[pnbrqkPNBRQK1-8]{1,8}(?: [wb] [KQkq-]+ [a-h1-8-]+ \d+ \d+)?")
 
 def json_to_board(data):
     """
@@ -74,6 +79,54 @@ def board_to_json(board: pd.DataFrame) -> dict:
 
     return output
 
+def board_to_fen(board: pd.DataFrame, side_to_move: str = 'b') -> str:
+    """
+    Converte il DataFrame 'board' in una stringa FEN (traversa 8 → 1, colonne a → h).
+    Arrocco e presa en passant non sono tracciati dal motore: i rispettivi campi sono '-'.
+    side_to_move: 'w' o 'b' (di default i Neri, cioè il lato giocato dall'LLM).
+    """
+    rows = []
+    for rank in range(8, 0, -1):
+        row, empty = '', 0
+        for file in 'abcdefgh':
+            piece = board.at[file, rank]
+            if piece == '':
+                empty += 1
+                continue
+            if empty:
+                row += str(empty)
+                empty = 0
+            row += piece
+        if empty:
+            row += str(empty)
+        rows.append(row)
+    return f"{'/'.join(rows)} {side_to_move} - - 0 1"
+
+def fen_to_board(fen: str) -> pd.DataFrame:
+    """
+    Converte una stringa FEN (è sufficiente il campo di posizionamento dei pezzi) nel DataFrame 8×8.
+    Solleva ValueError se la stringa non descrive 8 traverse da 8 caselle.
+    """
+    board = pd.DataFrame('', index=list('abcdefgh'), columns=list(range(1, 9)))
+    rows = fen.strip().split(' ')[0].split('/')
+    if len(rows) != 8:
+        raise ValueError(f"FEN non valida (traverse: {len(rows)}): {fen}")
+    for rank, row in zip(range(8, 0, -1), rows):
+        file_index = 0
+        for char in row:
+            if char.isdigit():
+                file_index += int(char)
+            elif char.lower() in 'pnbrqk':
+                if file_index > 7:
+                    raise ValueError(f"FEN non valida (traversa {rank} troppo lunga): {fen}")
+                board.at['abcdefgh'[file_index], rank] = char
+                file_index += 1
+            else:
+                raise ValueError(f"FEN non valida (carattere '{char}'): {fen}")
+        if file_index != 8:
+            raise ValueError(f"FEN non valida (traversa {rank} di {file_index} caselle): {fen}")
+    return board
+
 def is_path_clear(board, from_sq, to_sq):
     files = 'abcdefgh'
     ranks = '12345678'
@@ -151,6 +204,30 @@ def is_legal_move(piece, from_sq, to_sq, board, player_color):
     # Tutti gli altri casi non gestiti
     return False
 
+def legal_moves(board, player_color) -> list:
+    """
+    Elenca tutte le mosse pseudo-legali del colore indicato secondo is_legal_move,
+    escludendo le catture dei propri pezzi.
+    Restituisce una lista di tuple (piece, from_sq, to_sq), nello stesso formato di detect_move.
+    """
+    is_white = player_color.lower() in ('white', 'bianco', 'bianchi')
+    squares = [f"{f}{r}" for f in board.index for r in board.columns]
+    moves = []
+    for from_sq in squares:
+        piece = board.at[from_sq[0], int(from_sq[1])]
+        if not piece or piece.isupper() != is_white:
+            continue
+        for to_sq in squares:
+            if to_sq == from_sq:
+                continue
+            target = board.at[to_sq[0], int(to_sq[1])]
+            # non si cattura un proprio pezzo
+            if target and target.isupper() == is_white:
+                continue
+            if is_legal_move(piece, from_sq, to_sq, board, 'white' if is_white else 'black'):
+                moves.append((piece, from_sq, to_sq))
+    return moves
+
 def boards_equal(board1: pd.DataFrame, board2: pd.DataFrame) -> bool:
     """
     Verifica se due stati di scacchiera (pandas DataFrame) sono identici.
@@ -230,6 +307,31 @@ def detect_move(prev_board: pd.DataFrame, curr_board: pd.DataFrame):
     
     return piece, from_sq, to_sq
 
+def replay_moves(board: pd.DataFrame, moves: list, first_color: str = 'white') -> pd.DataFrame:
+    """
+    Ricostruisce la posizione applicando in sequenza le mosse "origine-destinazione" (es. 'e2-e4')
+    a partire da 'board', alternando i colori a partire da first_color.
+    Ogni mossa viene verificata (pezzo del colore di turno, legalità, Re non lasciato sotto scacco):
+    alla prima mossa non valida solleva ValueError indicandone la posizione nella sequenza.
+    """
+    color = first_color
+    for index, move in enumerate(moves):
+        try:
+            from_sq, to_sq = move.strip().lower().split('-')
+            piece = board.at[from_sq[0], int(from_sq[1])]
+        except (ValueError, KeyError, IndexError):
+            raise ValueError(f"Move {index + 1} '{move}' is not in the 'from-to' format.")
+        if piece == '' or piece.isupper() != (color == 'white'):
+            raise ValueError(f"Move {index + 1} '{move}': no {color} piece at {from_sq}.")
+        if not is_legal_move(piece, from_sq, to_sq, board, color):
+            raise ValueError(f"Move {index + 1} '{move}' is illegal for {color}.")
+        board_next = apply_move(piece, from_sq, to_sq, board)
+        if find_checkers(board_next, color):
+            raise ValueError(f"Move {index + 1} '{move}' leaves the {color} king in check.")
+        board = board_next
+        color = 'black' if color == 'white' else 'white'
+    return board
+
 def show_board(board):
     """
     Stampa la board con sfondo alternato e pezzi bianchi/neri colorati distintamente:
@@ -381,26 +483,14 @@ def is_game_active(board) -> bool:
     return has_white_king and has_black_king
                      
 def repair_json_board(json_board):
-    
-    raw = json_board.strip()
-
-    # 1) Rimuovi eventuali code fences
-    if raw.startswith("```"):
-        # rimuove tutti i backtick e la parola json
-        raw = raw.strip("`").replace("json", "", 1).strip()
-
-    # 2) Controlla quante graffe mancano e aggiungile
-    open_braces  = raw.count("{")
-    close_braces = raw.count("}")
-    if open_braces > close_braces:
-        raw += "}" * (open_braces - close_braces)
-
-    # 3) Tenta il parsing
+    """
+    Ripara la risposta JSON dell'LLM e la restituisce come stringa JSON indentata.
+    Mantenuta per compatibilità: per ottenere direttamente il dict usare json_extractor.extract_json_object.
+    """
     try:
-        data = json.loads(raw)
-    except Exception as e:
+        data = extract_json_object(json_board)
+    except ValueError as e:
         print("Malformed JSON:", e)
-        # qui puoi loggare `raw` per debug
         raise
 
     return json.dumps(data, indent=4, ensure_ascii=False)
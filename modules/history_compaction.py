@@ -0,0 +1,84 @@
+import json
+from modules.chess_core import FEN_PATTERN
+from modules.move_protocol import message_moves
+
+# Ruoli dei messaggi compattabili: i messaggi di sistema (regole, posizione iniziale) restano intatti
+COMPACTABLE_ROLES = ("user", "assistant")
+
+
+def _board_placeholder(message: dict) -> str:
+    moves = message_moves(message)
+    if moves:
+        return f"[scacchiera omessa, mossa {moves[-1]}]"
+    return "[scacchiera omessa]"
+
+
+def _is_board(value) -> bool:
+    return isinstance(value, dict) and "neri" in value and "bianchi" in value
+
+
+def strip_board_payloads(message: dict):
+    """
+    Contenuto del messaggio senza le scacchiere (oggetti JSON con 'neri' e 'bianchi', stringhe FEN),
+    oppure None se il messaggio non ne contiene.
+    - Un oggetto JSON che oltre alla scacchiera ha altre chiavi (es. la risposta con mossa_proposta e
+      commenti) resta JSON valido senza 'neri' e 'bianchi';
+    - una scacchiera isolata o una FEN viene sostituita da un breve riferimento alla mossa.
+    """
+    content = message.get("content") or ""
+    if "neri" not in content and "/" not in content:
+        return None
+    decoder = json.JSONDecoder()
+    parts, last, changed = [], 0, False
+    start = content.find("{")
+    while start != -1:
+        try:
+            value, end = decoder.raw_decode(content, start)
+        except json.JSONDecodeError:
+            start = content.find("{", start + 1)
+            continue
+        if _is_board(value):
+            rest = {k: v for k, v in value.items() if k not in ("neri", "bianchi")}
+            replacement = json.dumps(rest, ensure_ascii=False) if rest else _board_placeholder(message)
+            parts.append(content[last:start])
+            parts.append(replacement)
+            last, changed = end, True
+        start = content.find("{", end)
+    parts.append(content[last:])
+    compacted = "".join(parts)
+    compacted, fen_count = FEN_PATTERN.subn(_board_placeholder(message), compacted)
+    if not changed and not fen_count:
+        return None
+    return compacted
+
+
+def has_board_payload(message: dict) -> bool:
+    return strip_board_payloads(message) is not None
+
+
+def compact_board_history(messages: list, start: int = 0):
+    """
+    Compatta in place la storia (lista di messaggi): nei turni user/assistant da 'start' in poi
+    sostituisce le scacchiere superate con un riferimento alla mossa, lasciando intatta l'ultima
+    scacchiera inviata e tutto il resto del testo (mosse, feedback, avvisi di errore).
+    I messaggi prima di 'start' sono considerati già compattati.
+    Ritorna (indice del messaggio con l'ultima scacchiera, da passare come 'start' alla chiamata
+    successiva; numero di messaggi compattati).
+    """
+    latest = None
+    for index in range(len(messages) - 1, start - 1, -1):
+        if messages[index].get("role") in COMPACTABLE_ROLES and has_board_payload(messages[index]):
+            latest = index
+            break
+    if latest is None:
+        return start, 0
+    compacted = 0
+    for index in range(start, latest):
+        message = messages[index]
+        if message.get("role") not in COMPACTABLE_ROLES:
+            continue
+        content = strip_board_payloads(message)
+        if content is not None:
+            messages[index] = {**message, "content": content}
+            compacted += 1
+    return latest, compacted
@@ -0,0 +1,164 @@
+import json
+
+# Caratteri che possono seguire la chiusura di una stringa JSON
+_KEY_END = ":"
+_VALUE_END = ",}]"
+# Escape dei caratteri di controllo non ammessi nelle stringhe JSON
+_CONTROL_ESCAPES = {"\n": "\\n", "\r": "\\r", "\t": "\\t", "\b": "\\b", "\f": "\\f"}
+_CLOSERS = {"{": "}", "[": "]"}
+
+_decoder = json.JSONDecoder()
+
+
+def extract_json_object(text: str) -> dict:
+    """
+    Estrae il primo oggetto JSON dalla risposta dell'LLM e lo restituisce come dict.
+    Tollera in una sola passata gli errori tipici delle risposte:
+    - code fence (```json) o testo prima e dopo l'oggetto
+    - risposta troncata: stringhe, liste e oggetti non chiusi vengono chiusi in fondo
+    - virgolette non escapate e caratteri di controllo dentro le stringhe
+    - virgole finali prima di '}' o ']'
+    Solleva ValueError se la risposta non contiene un oggetto recuperabile.
+    """
+    start = text.find("{") if isinstance(text, str) else -1
+    if start < 0:
+        raise ValueError("Nessun oggetto JSON nella risposta")
+    # caso comune: JSON valido, al più con testo intorno (nessuna copia del testo)
+    try:
+        data, _ = _decoder.raw_decode(text, start)
+        return data
+    except json.JSONDecodeError:
+        pass
+    data = json.loads(_repair(text, start))
+    print("[DEBUG] JSON della risposta riparato")
+    return data
+
+
+def _repair(text: str, start: int) -> str:
+    """
+    Riscrive l'oggetto che inizia in text[start] come JSON valido, scorrendo ogni carattere una volta.
+    """
+    out = []
+    stack = []
+    in_string = False
+    escape = False
+    # True se la stringa corrente è una chiave (in un oggetto, prima dei due punti)
+    is_key = False
+    expect_key = False
+    # chiave chiusa ma non ancora seguita dai due punti
+    awaiting_colon = False
+    i, n = start, len(text)
+    while i < n:
+        ch = text[i]
+        if in_string:
+            if escape:
+                escape = False
+                out.append(ch)
+            elif ch == "\\":
+                escape = True
+                out.append(ch)
+            elif ch == '"':
+                if _closes_string(text, i + 1, is_key, stack):
+                    in_string = False
+                    awaiting_colon = is_key
+                    out.append(ch)
+                else:
+                    # virgoletta dentro il testo: va escapata
+                    out.append('\\"')
+            elif ch < " ":
+                out.append(_CONTROL_ESCAPES.get(ch, ""))
+            else:
+                out.append(ch)
+            i += 1
+            continue
+
+        if ch == '"':
+            in_string = True
+            is_key = expect_key
+            expect_key = False
+            out.append(ch)
+        elif ch in "{[":
+            stack.append(ch)
+            expect_key = ch == "{"
+            out.append(ch)
+        elif ch in "}]":
+            if not stack:
+                break
+            _drop_trailing_comma(out)
+            # chiude anche le liste/oggetti interni lasciati aperti
+            while stack and _CLOSERS[stack[-1]] != ch:
+                out.append(_CLOSERS[stack.pop()])
+            if stack:
+                stack.pop()
+            out.append(ch)
+            if not stack:
+                # oggetto completo: il testo che segue (fence, commenti) viene ignorato
+                break
+        elif ch == ",":
+            expect_key = bool(stack) and stack[-1] == "{"
+            out.append(ch)
+        elif ch == ":":
+            awaiting_colon = False
+            out.append(ch)
+        else:
+            out.append(ch)
+        i += 1
+
+    if in_string:
+        if escape:
+            out.pop()
+        out.append('"')
+        awaiting_colon = is_key
+    # risposta troncata dopo una chiave, i due punti o una virgola
+    _drop_trailing_comma(out)
+    if awaiting_colon:
+        out.append(":")
+    if _last_char(out) == ":":
+        out.append("null")
+    while stack:
+        out.append(_CLOSERS[stack.pop()])
+    return "".join(out)
+
+
+def _closes_string(text: str, i: int, is_key: bool, stack: list) -> bool:
+    """
+    Decide se la virgoletta prima di text[i] chiude la stringa, guardando il primo carattere significativo
+    che segue: i due punti per una chiave, ',', '}' o ']' (o la fine del testo) per un valore.
+    """
+    n = len(text)
+    while i < n and text[i].isspace():
+        i += 1
+    if i >= n:
+        return True
+    ch = text[i]
+    if is_key:
+        return ch == _KEY_END
+    if ch not in _VALUE_END:
+        return False
+    if ch == "," and stack and stack[-1] == "{":
+        # in un oggetto dopo la virgola deve iniziare una nuova chiave
+        i += 1
+        while i < n and text[i].isspace():
+            i += 1
+        return i >= n or text[i] in '"}'
+    return True
+
+
+def _last_index(out: list) -> int:
+    # indice dell'ultimo elemento non di spaziatura (-1 se nessuno)
+    j = len(out) - 1
+    while j >= 0 and out[j].isspace():
+        j -= 1
+    return j
+
+
+def _last_char(out: list) -> str:
+    j = _last_index(out)
+    return out[j] if j >= 0 else ""
+
+
+def _drop_trailing_comma(out: list):
+    # rimuove la virgola finale (e gli spazi che la seguono) prima di una chiusura
+    j = _last_index(out)
+    if j >= 0 and out[j] == ",":
+        del out[j:]
@@ -0,0 +1,93 @@
+import json
+
+
+class IncrementalJsonScanner:
+    """
+    Scanner incrementale di un oggetto JSON ricevuto a frammenti (streaming dell'LLM).
+    Estrae i valori stringa delle chiavi di primo livello indicate appena sono completi,
+    senza attendere la fine della risposta. Il testo prima della prima '{' (es. ```json) viene ignorato.
+    Ogni carattere viene esaminato una sola volta.
+    """
+
+    def __init__(self, keys=("mossa_proposta",)):
+        self.keys = set(keys)
+        self.values = {}
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._chars = []
+        # ultima stringa chiusa a profondità 1, candidata a essere una chiave
+        self._last_string = None
+        # chiave in attesa del suo valore (dopo i due punti)
+        self._pending_key = None
+        self._value_pending = False
+
+    def feed(self, chunk: str) -> dict:
+        """
+        Elabora un frammento e ritorna {chiave: valore} per le chiavi completate in questo frammento.
+        """
+        found = {}
+        for ch in chunk:
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                    self._chars.append(ch)
+                elif ch == '\\':
+                    self._escape = True
+                    self._chars.append(ch)
+                elif ch == '"':
+                    self._in_string = False
+                    self._close_string(found)
+                else:
+                    self._chars.append(ch)
+                continue
+
+            if ch == '"':
+                if self._depth >= 1:
+                    self._in_string = True
+                    self._chars = []
+            elif ch in '{[':
+                self._depth += 1
+                self._reset_key()
+            elif ch in '}]':
+                self._depth -= 1
+                self._reset_key()
+            elif ch == ':':
+                if self._depth == 1 and self._last_string is not None:
+                    self._pending_key = self._last_string
+                    self._value_pending = True
+                self._last_string = None
+            elif ch == ',':
+                self._reset_key()
+            elif not ch.isspace():
+                # valore non stringa (numero, true, null...): la chiave in attesa non interessa
+                self._value_pending = False
+        return found
+
+    def _close_string(self, found):
+        raw = "".join(self._chars)
+        if self._depth != 1:
+            return
+        if self._value_pending:
+            key = self._pending_key
+            self._reset_key()
+            if key in self.keys and key not in self.values:
+                value = _decode(raw)
+                self.values[key] = value
+                found[key] = value
+            return
+        self._last_string = _decode(raw)
+
+    def _reset_key(self):
+        self._last_string = None
+        self._pending_key = None
+        self._value_pending = False
+
+
+def _decode(raw: str) -> str:
+    if '\\' not in raw:
+        return raw
+    try:
+        return json.loads(f'"{raw}"')
+    except json.JSONDecodeError:
+        return raw
@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Ampiezza dei bucket di temperatura: 0.71 e 0.74 producono la stessa chiave
+TEMPERATURE_BUCKET = 0.1
+
+
+def make_cache_key(model: str, messages: list, temperature: float, bucket: float = TEMPERATURE_BUCKET) -> str:
+    """
+    Chiave content-addressed della richiesta: sha256 di modello, messaggi e bucket di temperatura.
+    """
+    temperature_bucket = round(round(float(temperature or 0) / bucket) * bucket, 4)
+    payload = json.dumps(
+        {"model": model, "messages": messages, "temperature": temperature_bucket},
+        ensure_ascii=False, sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """
+    Cache delle risposte LLM a due livelli:
+    - LRU in memoria (max_entries risposte)
+    - SQLite su disco (opzionale, se path è impostato), limitato a max_disk_entries righe;
+      sopravvive ai riavvii del proxy.
+    Le voci più vecchie di ttl secondi sono considerate scadute in entrambi i livelli.
+    """
+
+    def __init__(self, max_entries: int = 1024, path: str = None, ttl: float = 7 * 24 * 3600,
+                 max_disk_entries: int = 100000):
+        self.max_entries = max_entries
+        self.path = path
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0}
+        self._db = None
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_responses_created ON responses(created)")
+            self._db.commit()
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, key: str):
+        """
+        Restituisce la risposta in cache per la chiave, oppure None.
+        """
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                response, created = entry
+                if not self._expired(created):
+                    self._memory.move_to_end(key)
+                    self._stats["hits"] += 1
+                    self._stats["memory_hits"] += 1
+                    return response
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None and not self._expired(row[1]):
+                    # promuove la voce nel livello in memoria
+                    self._remember(key, row[0], row[1])
+                    self._stats["hits"] += 1
+                    self._stats["disk_hits"] += 1
+                    return row[0]
+
+            self._stats["misses"] += 1
+            return None
+
+    def put(self, key: str, response: str):
+        created = time.time()
+        with self._lock:
+            self._remember(key, response, created)
+            self._stats["stores"] += 1
+            if self._db is None:
+                return
+            try:
+                self._db.execute("INSERT OR REPLACE INTO responses (key, response, created) VALUES (?, ?, ?)",
+                                 (key, response, created))
+                self._prune_disk()
+                self._db.commit()
+            except sqlite3.Error as e:
+                logger.error(f"Errore salvando la risposta in cache su disco: {e}")
+
+    def _remember(self, key, response, created):
+        self._memory[key] = (response, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _prune_disk(self):
+        if self.ttl is not None:
+            self._db.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+        count = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if count > self.max_disk_entries:
+            self._db.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY created LIMIT ?)",
+                (count - self.max_disk_entries,)
+            )
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            disk_entries = 0
+            if self._db is not None:
+                disk_entries = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                **self._stats,
+                "hit_rate": round(self._stats["hits"] / lookups, 3) if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "disk_entries": disk_entries
+            }
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+def cache_from_env() -> LLMCache:
+    """
+    Crea la cache leggendo LLM_CACHE_MAX_ENTRIES, LLM_CACHE_PATH (file SQLite; vuoto = solo memoria),
+    LLM_CACHE_TTL (secondi) e LLM_CACHE_MAX_DISK_ENTRIES.
+    """
+    return LLMCache(
+        max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", 1024)),
+        path=os.getenv("LLM_CACHE_PATH") or None,
+        ttl=float(os.getenv("LLM_CACHE_TTL", 7 * 24 * 3600)),
+        max_disk_entries=int(os.getenv("LLM_CACHE_MAX_DISK_ENTRIES", 100000))
+    )
@@ -0,0 +1,299 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Limiti dei bucket degli istogrammi (secondi di latenza, token, messaggi)
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0)
+TOKEN_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536)
+HISTORY_BUCKETS = (2, 4, 8, 16, 32, 64, 128, 256)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_labels(labelnames, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """
+    Contatore monotono, eventualmente con etichette (es. model).
+    """
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def render(self) -> list:
+        with self._lock:
+            values = sorted(self._values.items())
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in values
+        ]
+
+
+class Gauge(Counter):
+    """
+    Valore istantaneo (può scendere).
+    """
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """
+    Istogramma a bucket cumulativi (formato Prometheus): _bucket, _sum e _count per combinazione di etichette.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # conteggi per bucket (l'ultimo è +Inf), somma, numero di osservazioni
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            return state[2] if state else 0
+
+    def render(self) -> list:
+        with self._lock:
+            values = sorted((key, ([*state[0]], state[1], state[2])) for key, state in self._values.items())
+        lines = self.header()
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(round(total, 6))}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Registro delle metriche esposte in formato testo Prometheus (endpoint /metrics).
+    - Contatori e istogrammi vengono aggiornati nel percorso delle richieste (un lock e poche operazioni).
+    - I collector sono funzioni chiamate solo alla lettura di /metrics, per esporre statistiche già
+      mantenute altrove (cache, pianificatore, registro delle sessioni) senza costi aggiuntivi per richiesta.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, help_text: str, labelnames: tuple = ()) -> Counter:
+        return self._register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name: str, help_text: str, labelnames: tuple = ()) -> Gauge:
+        return self._register(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self, collectors=()) -> str:
+        """
+        Testo delle metriche registrate più quelle prodotte dai collector indicati:
+        funzioni senza argomenti che ritornano metriche (Counter, Gauge o Histogram) costruite alla lettura.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        for collector in collectors:
+            for metric in collector():
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Registro globale del processo e metriche delle chiamate all'LLM
+REGISTRY = MetricsRegistry()
+
+LLM_LATENCY = REGISTRY.histogram(
+    "promptchess_llm_request_seconds", "Latenza delle chiamate all'LLM (fino alla risposta o all'inizio dello stream)",
+    ("model", "stream"))
+LLM_PROMPT_TOKENS = REGISTRY.counter(
+    "promptchess_llm_prompt_tokens_total", "Token del prompt inviati all'LLM", ("model",))
+LLM_COMPLETION_TOKENS = REGISTRY.counter(
+    "promptchess_llm_completion_tokens_total", "Token generati dall'LLM", ("model",))
+LLM_COMPLETION_SIZE = REGISTRY.histogram(
+    "promptchess_llm_completion_tokens", "Token per risposta dell'LLM", ("model",), TOKEN_BUCKETS)
+LLM_ERRORS = REGISTRY.counter(
+    "promptchess_llm_errors_total", "Errori delle chiamate all'LLM per tipo (RateLimitError = 429)", ("model", "error"))
+
+
+@contextmanager
+def track_llm_call(model: str, stream: bool = False):
+    """
+    Misura la durata di una chiamata all'LLM e conta gli errori per tipo.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        LLM_ERRORS.inc(model=model, error=type(e).__name__)
+        raise
+    finally:
+        LLM_LATENCY.observe(time.perf_counter() - started, model=model, stream=str(bool(stream)).lower())
+
+
+def record_llm_usage(model: str, prompt_tokens: int, completion_tokens: int):
+    LLM_PROMPT_TOKENS.inc(prompt_tokens, model=model)
+    LLM_COMPLETION_TOKENS.inc(completion_tokens, model=model)
+    LLM_COMPLETION_SIZE.observe(completion_tokens, model=model)
+
+
+def usage_tokens(completion, prompt_estimate, completion_estimate):
+    """
+    Token (prompt, risposta) riportati dall'API nel campo usage, oppure le stime se non disponibili.
+    prompt_estimate e completion_estimate possono essere funzioni, chiamate solo quando serve la stima.
+    """
+    usage = getattr(completion, "usage", None)
+    prompt_tokens = getattr(usage, "prompt_tokens", None)
+    completion_tokens = getattr(usage, "completion_tokens", None)
+    if not isinstance(prompt_tokens, int):
+        prompt_tokens = prompt_estimate() if callable(prompt_estimate) else prompt_estimate
+    if not isinstance(completion_tokens, int):
+        completion_tokens = completion_estimate() if callable(completion_estimate) else completion_estimate
+    return prompt_tokens, completion_tokens
+
+
+# -- collector per i componenti del proxy ---------------------------------
+
+def cache_collector(cache):
+    """
+    Collector delle statistiche di LLMCache (hit per livello, miss, voci memorizzate).
+    """
+    def collect():
+        stats = cache.stats()
+        lookups = Counter("promptchess_cache_lookups_total", "Ricerche nella cache delle risposte per esito",
+                          ("result",))
+        lookups.inc(stats.get("memory_hits", 0), result="memory_hit")
+        lookups.inc(stats.get("disk_hits", 0), result="disk_hit")
+        lookups.inc(stats.get("misses", 0), result="miss")
+        hit_rate = Gauge("promptchess_cache_hit_ratio", "Frazione di ricerche servite dalla cache")
+        hit_rate.set(stats.get("hit_rate", 0.0))
+        stores = Counter("promptchess_cache_stores_total", "Risposte salvate nella cache")
+        stores.inc(stats.get("stores", 0))
+        return [lookups, hit_rate, stores]
+    return collect
+
+
+def scheduler_collector(scheduler):
+    """
+    Collector del pianificatore dei limiti di rate (richieste, 429, retry, attese, code per modello).
+    """
+    def collect():
+        stats = scheduler.stats()
+        requests = Counter("promptchess_scheduler_requests_total", "Richieste avviate dal pianificatore")
+        requests.inc(stats["requests"])
+        rate_limited = Counter("promptchess_rate_limited_total", "Risposte 429 (RateLimitError) ricevute")
+        rate_limited.inc(stats["rate_limited"])
+        retries = Counter("promptchess_retries_total", "Nuovi tentativi dopo un 429")
+        retries.inc(stats["retries"])
+        waited = Counter("promptchess_scheduler_wait_seconds_total", "Secondi passati in attesa dei limiti di rate")
+        waited.inc(stats["waited_seconds"])
+        queued = Gauge("promptchess_scheduler_queued", "Richieste in coda per modello", ("model",))
+        for model, depth in stats["queued"].items():
+            queued.set(depth, model=model)
+        return [requests, rate_limited, retries, waited, queued]
+    return collect
+
+
+def session_collector(session_registry):
+    """
+    Collector del registro delle sessioni: sessioni attive, memoria e distribuzione delle dimensioni della storia.
+    """
+    def collect():
+        snapshot = session_registry.snapshot()
+        active = Gauge("promptchess_active_sessions", "Sessioni di chat in memoria")
+        active.set(len(snapshot))
+        size = Gauge("promptchess_sessions_bytes", "Dimensione stimata delle sessioni in memoria (byte)")
+        size.set(sum(s["size_bytes"] for s in snapshot.values()))
+        history = Histogram("promptchess_session_history_messages", "Messaggi nella storia delle sessioni",
+                            buckets=HISTORY_BUCKETS)
+        for s in snapshot.values():
+            history.observe(s["history_size"])
+        return [active, size, history]
+    return collect
+
+
+def summarizer_collector(summarizer):
+    """
+    Collector della sintesi in background (avviate, applicate, scartate, fallite).
+    """
+    def collect():
+        summaries = Counter("promptchess_summaries_total", "Sintesi in background per esito", ("result",))
+        for result, count in summarizer.stats().items():
+            summaries.inc(count, result=result)
+        return [summaries]
+    return collect
@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import threading
+from openai import OpenAIError, RateLimitError
+from modules.chess_core import FEN_PATTERN, json_to_board, board_to_json, fen_to_board, apply_move, legal_moves, warn_if_in_check
+from modules.chat_session import count_tokens, count_message_tokens
+from modules.move_protocol import message_moves, reconstruct_board
+
+logger = logging.getLogger(__name__)
+
+# Valore di LLM_BACKEND che sostituisce OpenAI con il backend locale
+MOCK_BACKEND = "mock"
+
+
+class MockRateLimitError(RateLimitError):
+    # 429 simulato (senza risposta HTTP reale)
+
+    def __init__(self, message="Mock rate limit"):
+        Exception.__init__(self, message)
+
+
+class MockServerError(OpenAIError):
+    pass
+
+
+class _Obj:
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+def _message_board(content: str):
+    # ultima scacchiera (JSON neri/bianchi o FEN) contenuta nel testo del messaggio
+    for match in reversed(FEN_PATTERN.findall(content)):
+        try:
+            return board_to_json(fen_to_board(match))
+        except ValueError:
+            continue
+    decoder = json.JSONDecoder()
+    start = content.find("{")
+    while start != -1:
+        try:
+            value, _ = decoder.raw_decode(content, start)
+        except json.JSONDecodeError:
+            value = None
+        if isinstance(value, dict) and "neri" in value and "bianchi" in value:
+            return {"neri": value["neri"], "bianchi": value["bianchi"]}
+        start = content.find("{", start + 1)
+    return None
+
+
+def find_board(messages: list):
+    """
+    Cerca, dall'ultimo messaggio al primo, un oggetto JSON con le chiavi 'neri' e 'bianchi'
+    oppure una posizione FEN (restituita nello stesso formato JSON).
+    Le mosse dei messaggi successivi (protocollo a delta) vengono applicate alla posizione trovata.
+    """
+    for index in range(len(messages) - 1, -1, -1):
+        board_json = _message_board(messages[index].get("content") or "")
+        if board_json is None:
+            continue
+        later = messages[index + 1:]
+        if not any(message_moves(message) for message in later):
+            return board_json
+        try:
+            return board_to_json(reconstruct_board(json_to_board(board_json), later))
+        except ValueError as e:
+            logger.warning(f"Mosse non ricostruibili dopo l'ultima scacchiera: {e}")
+            return board_json
+    return None
+
+
+class MockOpenAIClient:
+    """
+    Sostituto locale dell'API chat completions di OpenAI, per test di carico offline e riproducibili.
+    - Risposte generate dal motore: trova l'ultima scacchiera nei messaggi e gioca una mossa legale
+      dei Neri (scelta con un generatore seedato), restituendo il JSON atteso (mossa_proposta, neri, bianchi...).
+      Senza scacchiera risponde con un JSON generico; 'script' (lista o funzione messages -> str) le sostituisce.
+    - latency: secondi di attesa per risposta (più un jitter casuale fino a 'jitter' secondi).
+    - error_rate: probabilità di errore (429 o errore del server); malformed_rate: probabilità di JSON non valido.
+    Espone client.chat.completions.create(...) come il client OpenAI, anche con stream=True e n > 1.
+    """
+
+    def __init__(self, seed: int = 0, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 malformed_rate: float = 0.0, rate_limit_share: float = 0.5, script=None):
+        self.rng = random.Random(seed)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.rate_limit_share = rate_limit_share
+        self.script = list(script) if isinstance(script, (list, tuple)) else script
+        self.calls = 0
+        self._lock = threading.Lock()
+        self.chat = _Obj(completions=_Obj(create=self.create))
+
+    @classmethod
+    def from_env(cls, **overrides):
+        """
+        Configurazione da MOCK_LLM_SEED, MOCK_LLM_LATENCY, MOCK_LLM_JITTER, MOCK_LLM_ERROR_RATE e MOCK_LLM_MALFORMED_RATE.
+        """
+        options = {
+            "seed": int(os.getenv("MOCK_LLM_SEED", 0)),
+            "latency": float(os.getenv("MOCK_LLM_LATENCY", 0)),
+            "jitter": float(os.getenv("MOCK_LLM_JITTER", 0)),
+            "error_rate": float(os.getenv("MOCK_LLM_ERROR_RATE", 0)),
+            "malformed_rate": float(os.getenv("MOCK_LLM_MALFORMED_RATE", 0)),
+        }
+        options.update(overrides)
+        return cls(**options)
+
+    def _plan(self, messages: list, n: int):
+        """
+        Decide (in modo deterministico dato il seed) ritardo, eventuale errore e le risposte.
+        """
+        with self._lock:
+            self.calls += 1
+            delay = self.latency + self.rng.random() * self.jitter
+            if self.rng.random() < self.error_rate:
+                if self.rng.random() < self.rate_limit_share:
+                    return delay, MockRateLimitError(), None
+                return delay, MockServerError("Mock server error"), None
+            answers = [self._answer(messages) for _ in range(n)]
+        return delay, None, answers
+
+    def _answer(self, messages: list) -> str:
+        if self.script is not None:
+            if callable(self.script):
+                answer = self.script(messages)
+            else:
+                answer = self.script[(self.calls - 1) % len(self.script)]
+        else:
+            answer = self._engine_answer(messages)
+        if self.rng.random() < self.malformed_rate:
+            # JSON troncato o preceduto da testo libero, come capita con i modelli reali
+            if self.rng.random() < 0.5:
+                return answer[: max(1, len(answer) // 2)]
+            return f"Ecco la mia mossa:\n{answer}"
+        return answer
+
+    def _engine_answer(self, messages: list) -> str:
+        board_json = find_board(messages)
+        if board_json is None:
+            last_user = next((m["content"] for m in reversed(messages) if m.get("role") == "user"), "")
+            return json.dumps({
+                "request": last_user[:200], "request_type": "other", "products": [], "category": "",
+                "result": "Risposta simulata dal backend mock.", "suggestion": "", "completed": True
+            }, ensure_ascii=False)
+        board = json_to_board(board_json)
+        moves = [move for move in legal_moves(board, "black")
+                 if warn_if_in_check(apply_move(*move, board), "black", move) is None]
+        if not moves:
+            return json.dumps({**board_json, "mossa_proposta": "", "commento_giocatore": "Nessuna mossa legale."})
+        piece, from_sq, to_sq = moves[self.rng.randrange(len(moves))]
+        board_next = board_to_json(apply_move(piece, from_sq, to_sq, board))
+        return json.dumps({
+            "mossa_proposta": f"{from_sq}-{to_sq}",
+            **board_next,
+            "commento_giocatore": f"Mossa simulata {piece} {from_sq}-{to_sq}.",
+            "messaggio_avversario": "Tocca a te."
+        }, ensure_ascii=False)
+
+    def _completion(self, model, messages, answers):
+        prompt_tokens = count_message_tokens(messages, model)
+        completion_tokens = sum(count_tokens(a, model) for a in answers)
+        choices = [_Obj(index=i, message=_Obj(role="assistant", content=a), finish_reason="stop")
+                   for i, a in enumerate(answers)]
+        usage = _Obj(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                     total_tokens=prompt_tokens + completion_tokens)
+        return _Obj(model=model, choices=choices, usage=usage)
+
+    @staticmethod
+    def _chunks(answer: str, size: int = 8):
+        for i in range(0, len(answer), size):
+            yield _Obj(choices=[_Obj(index=0, delta=_Obj(content=answer[i:i + size]), finish_reason=None)])
+
+    def create(self, model: str = None, messages: list = None, stream: bool = False, n: int = 1, **kwargs):
+        delay, error, answers = self._plan(messages or [], n)
+        if delay:
+            time.sleep(delay)
+        if error is not None:
+            raise error
+        if stream:
+            return self._chunks(answers[0])
+        return self._completion(model, messages or [], answers)
+
+
+class MockAsyncOpenAIClient(MockOpenAIClient):
+    """
+    Variante asincrona (come AsyncOpenAI): la latenza simulata non blocca l'event loop.
+    """
+
+    async def create(self, model: str = None, messages: list = None, stream: bool = False, n: int = 1, **kwargs):
+        delay, error, answers = self._plan(messages or [], n)
+        if delay:
+            await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        if stream:
+            return self._achunks(answers[0])
+        return self._completion(model, messages or [], answers)
+
+    async def _achunks(self, answer: str):
+        for chunk in self._chunks(answer):
+            await asyncio.sleep(0)
+            yield chunk
+
+
+def use_mock_backend() -> bool:
+    """
+    True se LLM_BACKEND=mock: proxy e webapp usano il backend locale al posto di OpenAI.
+    """
+    return os.getenv("LLM_BACKEND", "").lower() == MOCK_BACKEND
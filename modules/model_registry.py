@@ -0,0 +1,189 @@
+import time
+import math
+import threading
+from collections import deque
+
+DEFAULT_MODEL = "gpt-4.1-nano"
+
+# Modelli disponibili: finestra di contesto (token), token massimi della risposta (max_tokens accettato
+# dall'API) e prezzi in USD per milione di token (input, output)
+MODELS = {
+    "gpt-4.1-nano": {"context_tokens": 1047576, "max_output_tokens": 32768, "input_price": 0.10, "output_price": 0.40},
+    "gpt-4o-mini": {"context_tokens": 128000, "max_output_tokens": 16384, "input_price": 0.15, "output_price": 0.60},
+    "gpt-4.1-mini": {"context_tokens": 1047576, "max_output_tokens": 32768, "input_price": 0.40, "output_price": 1.60},
+    "o4-mini": {"context_tokens": 200000, "max_output_tokens": 100000, "input_price": 1.10, "output_price": 4.40},
+    "gpt-4.1": {"context_tokens": 1047576, "max_output_tokens": 32768, "input_price": 2.00, "output_price": 8.00},
+    "gpt-4o": {"context_tokens": 128000, "max_output_tokens": 16384, "input_price": 2.50, "output_price": 10.00},
+}
+
+
+# Finestra di contesto e token massimi della risposta assunti per i modelli non presenti in MODELS
+DEFAULT_CONTEXT_TOKENS = 16384
+DEFAULT_MAX_OUTPUT_TOKENS = 4096
+
+
+def context_tokens(model: str) -> int:
+    """
+    Finestra di contesto del modello in token (DEFAULT_CONTEXT_TOKENS se il modello non è in MODELS).
+    """
+    info = MODELS.get(model)
+    return info["context_tokens"] if info else DEFAULT_CONTEXT_TOKENS
+
+
+def max_output_tokens(model: str) -> int:
+    """
+    Token massimi della risposta accettati dall'API per il modello (DEFAULT_MAX_OUTPUT_TOKENS se non è in MODELS).
+    """
+    info = MODELS.get(model)
+    return info["max_output_tokens"] if info else DEFAULT_MAX_OUTPUT_TOKENS
+
+
+def model_info(model: str) -> dict:
+    """
+    Caratteristiche del modello (context_tokens, max_output_tokens, input_price, output_price);
+    ValueError se sconosciuto.
+    """
+    if model not in MODELS:
+        raise ValueError(f"Modello sconosciuto: {model}. Modelli disponibili: {', '.join(MODELS)}")
+    return MODELS[model]
+
+
+def model_ladder(models=None) -> list:
+    """
+    Modelli ordinati dal più economico al più costoso (prezzo di input, poi di output).
+    """
+    models = list(models) if models else list(MODELS)
+    for model in models:
+        model_info(model)
+    return sorted(models, key=lambda m: (MODELS[m]["input_price"], MODELS[m]["output_price"]))
+
+
+def request_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """
+    Costo stimato in USD di una richiesta.
+    """
+    info = model_info(model)
+    return (prompt_tokens * info["input_price"] + completion_tokens * info["output_price"]) / 1_000_000
+
+
+class ModelRouter:
+    """
+    Sceglie il modello per ogni richiesta in base alle statistiche recenti di ciascun modello
+    (finestra mobile di 'window' esiti): frazione di risposte valide (mosse legali), latenza p95 e costo.
+    - Si parte dal modello più economico della scala (o da start_model).
+    - Dopo un fallimento si sale al primo modello più costoso idoneo.
+    - Dopo downgrade_after successi consecutivi si riprova il modello idoneo immediatamente più economico.
+    Un modello è idoneo se ha meno di min_samples esiti, oppure se rispetta target_success e max_p95_latency;
+    un modello non idoneo viene riprovato se non è stato usato negli ultimi cooldown secondi.
+    """
+
+    def __init__(self, models=None, start_model: str = None, window: int = 20, min_samples: int = 5,
+                 target_success: float = 0.8, max_p95_latency: float = None, downgrade_after: int = 3,
+                 cooldown: float = 300, clock=time.monotonic):
+        self.ladder = model_ladder(models)
+        self.window = window
+        self.min_samples = min_samples
+        self.target_success = target_success
+        self.max_p95_latency = max_p95_latency
+        self.downgrade_after = downgrade_after
+        self.cooldown = cooldown
+        self.clock = clock
+        self._lock = threading.Lock()
+        # modello -> deque di (successo, latenza, costo)
+        self._history = {model: deque(maxlen=window) for model in self.ladder}
+        self._last_used = {}
+        self._streak = 0
+        self.current = start_model if start_model in self.ladder else self.ladder[0]
+
+    def choose(self) -> str:
+        """
+        Modello da usare per la prossima richiesta.
+        """
+        with self._lock:
+            return self.current
+
+    def record(self, model: str, success: bool, latency: float = 0.0,
+               prompt_tokens: int = 0, completion_tokens: int = 0) -> str:
+        """
+        Registra l'esito di una richiesta e ritorna il modello scelto per la successiva.
+        """
+        cost = request_cost(model, prompt_tokens, completion_tokens) if model in MODELS else 0.0
+        with self._lock:
+            if model in self._history:
+                self._history[model].append((bool(success), latency, cost))
+            self._last_used[model] = self.clock()
+            if model != self.current:
+                return self.current
+            previous = self.current
+            if success:
+                self._streak += 1
+                if self._streak >= self.downgrade_after:
+                    self._streak = 0
+                    self.current = self._cheaper() or self.current
+            else:
+                self._streak = 0
+                self.current = self._pricier() or self.current
+            if self.current != previous:
+                direction = "più economico" if success else "più capace"
+                print(f"[DEBUG] Router dei modelli: passaggio a un modello {direction}: {previous} -> {self.current}")
+            return self.current
+
+    def _eligible(self, model) -> bool:
+        # chiamato con self._lock acquisito
+        stats = self._model_stats(model)
+        if stats["samples"] < self.min_samples:
+            return True
+        if stats["success_rate"] >= self.target_success and (
+                self.max_p95_latency is None or stats["p95_latency"] <= self.max_p95_latency):
+            return True
+        # statistiche ormai vecchie: il modello viene rimesso alla prova
+        return self.clock() - self._last_used.get(model, -math.inf) >= self.cooldown
+
+    def _pricier(self):
+        index = self.ladder.index(self.current)
+        candidates = self.ladder[index + 1:]
+        for model in candidates:
+            if self._eligible(model):
+                return model
+        if not candidates:
+            return None
+        # nessun modello idoneo: quello con la miglior frazione di successi (a parità il più economico)
+        return max(candidates, key=lambda m: (self._model_stats(m)["success_rate"], -candidates.index(m)))
+
+    def _cheaper(self):
+        index = self.ladder.index(self.current)
+        if index > 0 and self._eligible(self.ladder[index - 1]):
+            return self.ladder[index - 1]
+        return None
+
+    def _model_stats(self, model) -> dict:
+        history = list(self._history.get(model, ()))
+        if not history:
+            return {"samples": 0, "success_rate": 0.0, "p95_latency": 0.0, "avg_cost": 0.0}
+        latencies = sorted(latency for _, latency, _ in history)
+        p95_index = min(len(latencies) - 1, math.ceil(0.95 * len(latencies)) - 1)
+        return {
+            "samples": len(history),
+            "success_rate": round(sum(1 for success, _, _ in history if success) / len(history), 3),
+            "p95_latency": round(latencies[p95_index], 3),
+            "avg_cost": round(sum(cost for _, _, cost in history) / len(history), 6)
+        }
+
+    def stats(self) -> dict:
+        """
+        Statistiche della finestra mobile per modello e modello corrente.
+        """
+        with self._lock:
+            return {
+                "current": self.current,
+                "models": {model: self._model_stats(model) for model in self.ladder}
+            }
+
+
+def router_from_config(config: dict, start_model: str = DEFAULT_MODEL) -> ModelRouter:
+    """
+    Crea il router dalla configurazione: MODEL_ROUTER = {"models": [...], "window", "min_samples",
+    "target_success", "max_p95_latency", "downgrade_after", "cooldown"} (tutti opzionali).
+    """
+    options = dict((config or {}).get("MODEL_ROUTER", {}))
+    return ModelRouter(start_model=options.pop("start_model", start_model), **options)
@@ -0,0 +1,99 @@
+import re
+
+from modules.chess_core import legal_moves
+
+# Notazione a coordinate / algebrica estesa: "e7-e5", "e7xe5", "Ng8-f6", "e7e8=Q"
+_COORD_RE = re.compile(r'^([KQRBNP])?([a-h][1-8])[-x:]?([a-h][1-8])(?:=?([QRBN]))?$', re.IGNORECASE)
+# Notazione algebrica abbreviata (SAN): "Nf6", "exd5", "Rad1", "e8=Q"
+_SAN_RE = re.compile(r'^([KQRBN])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([QRBN]))?$')
+# Arrocco: "O-O", "0-0-0", "o-o"
+_CASTLE_RE = re.compile(r'^[O0](-[O0]){1,2}$', re.IGNORECASE)
+# Separatori e annotazioni che non cambiano il significato della mossa
+_NOISE_RE = re.compile(r'\s+|->|→|e\.p\.|[+#!?]+$')
+_DASHES = str.maketrans({'–': '-', '—': '-', '−': '-', '×': 'x'})
+
+
+def parse_move_string(move_str: str) -> dict:
+    """
+    Analizza una mossa testuale senza conoscere la posizione.
+    Restituisce un dict con le chiavi:
+      - piece: lettera del pezzo in maiuscolo (o None se non indicata)
+      - from_file, from_rank, from_sq: disambiguazione/origine, se presenti
+      - to_sq: casella di destinazione (o None per l'arrocco)
+      - promotion: pezzo di promozione in maiuscolo (o None)
+      - castling: 'short', 'long' o None
+    Solleva ValueError se la stringa non è riconducibile a nessuna notazione nota.
+    """
+    if not isinstance(move_str, str):
+        raise ValueError(f"Move must be a string, got {type(move_str).__name__}.")
+
+    raw = _NOISE_RE.sub('', move_str.strip().translate(_DASHES))
+    if not raw:
+        raise ValueError("Empty move string.")
+
+    spec = {'piece': None, 'from_file': None, 'from_rank': None, 'from_sq': None,
+            'to_sq': None, 'promotion': None, 'castling': None}
+
+    if _CASTLE_RE.match(raw):
+        spec['piece'] = 'K'
+        spec['castling'] = 'long' if raw.count('-') == 2 else 'short'
+        return spec
+
+    match = _COORD_RE.match(raw)
+    if match:
+        piece, from_sq, to_sq, promotion = match.groups()
+        spec.update(piece=piece.upper() if piece else None,
+                    from_sq=from_sq.lower(), from_file=from_sq[0].lower(), from_rank=from_sq[1],
+                    to_sq=to_sq.lower(),
+                    promotion=promotion.upper() if promotion else None)
+        return spec
+
+    match = _SAN_RE.match(raw)
+    if match:
+        piece, from_file, from_rank, to_sq, promotion = match.groups()
+        spec.update(piece=piece or 'P', from_file=from_file, from_rank=from_rank,
+                    to_sq=to_sq, promotion=promotion)
+        return spec
+
+    raise ValueError(f"Unrecognized move notation: '{move_str}'.")
+
+
+def resolve_move(move_str: str, board, player_color: str, moves: list = None):
+    """
+    Risolve una mossa in notazione a coordinate, algebrica estesa o SAN
+    contro l'elenco delle mosse legali della posizione.
+
+    - moves: elenco precalcolato di legal_moves(board, player_color), opzionale.
+
+    Restituisce la tupla (piece, from_sq, to_sq) dell'unica mossa compatibile,
+    altrimenti solleva ValueError (mossa illegale o ambigua).
+    Arrocco e promozione vengono riconosciuti ma rifiutati: chess_core non li genera né li applica.
+    """
+    spec = parse_move_string(move_str)
+    if spec['castling']:
+        raise ValueError(f"Castling ('{move_str}') is not supported by the engine.")
+    if spec['promotion']:
+        raise ValueError(f"Promotion ('{move_str}') is not supported by the engine.")
+    if moves is None:
+        moves = legal_moves(board, player_color)
+
+    candidates = []
+    for piece, from_sq, to_sq in moves:
+        if to_sq != spec['to_sq']:
+            continue
+        if spec['from_sq'] and from_sq != spec['from_sq']:
+            continue
+        if spec['from_file'] and from_sq[0] != spec['from_file']:
+            continue
+        if spec['from_rank'] and from_sq[1] != spec['from_rank']:
+            continue
+        if spec['piece'] and piece.upper() != spec['piece']:
+            continue
+        candidates.append((piece, from_sq, to_sq))
+
+    if not candidates:
+        raise ValueError(f"Move '{move_str}' is not legal for {player_color} in this position.")
+    if len(candidates) > 1:
+        options = ", ".join(f"{c[1]}-{c[2]}" for c in candidates)
+        raise ValueError(f"Move '{move_str}' is ambiguous for {player_color}: {options}.")
+    return candidates[0]
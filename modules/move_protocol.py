@@ -0,0 +1,102 @@
+import os
+import re
+from modules.chess_core import replay_moves
+from modules.move_parser import resolve_move
+
+# Protocolli di conversazione con l'LLM:
+# - full: ogni turno dell'utente e ogni risposta contengono la scacchiera completa;
+# - delta: la posizione viaggia solo nel messaggio di sistema iniziale (e nei checkpoint periodici),
+#   i turni successivi contengono solo le mosse e la scacchiera viene ricostruita localmente.
+FULL_PROTOCOL = "full"
+DELTA_PROTOCOL = "delta"
+PROMPT_PROTOCOLS = (FULL_PROTOCOL, DELTA_PROTOCOL)
+DEFAULT_PROMPT_PROTOCOL = FULL_PROTOCOL
+
+# Ogni quante mosse dei Neri il protocollo a delta reinvia la posizione completa
+DEFAULT_CHECKPOINT_EVERY = 10
+
+# Le mosse dei Bianchi sono scritte dal sistema (delta_turn_prompt), sempre nel formato "origine-destinazione"
+HUMAN_MOVE_PATTERN = re.compile(r"Mossa dei Bianchi: ([a-h][1-8]-[a-h][1-8])")
+# mossa_proposta è scritta dal modello: qualunque notazione accettata da move_parser (anche SAN, es. "Nf6"),
+# risolta contro la posizione da reconstruct_board
+PROPOSED_MOVE_PATTERN = re.compile(r'"mossa_proposta"\s*:\s*"([^"]+)"')
+COORDINATE_MOVE_PATTERN = re.compile(r"[a-h][1-8]-[a-h][1-8]")
+
+DELTA_RULES = """- Ad ogni turno riceverai solo la mossa dei Bianchi (nel formato "origine-destinazione"): aggiorna tu la posizione \
+applicando alla posizione iniziale tutte le mosse della partita, nell'ordine in cui sono state giocate.
+- Periodicamente riceverai un "Checkpoint" con la posizione completa: da quel momento riparti da quella posizione."""
+
+DELTA_OUTPUT = """Output: Restituisci esclusivamente un oggetto JSON con:
+- "mossa_proposta" (es. "e7-e5"), come prima chiave
+- "commento_giocatore" e "messaggio_avversario" (opzionali)
+Non includere le liste "bianchi" e "neri": la scacchiera viene aggiornata dal sistema."""
+
+
+def check_protocol(protocol: str) -> str:
+    protocol = (protocol or DEFAULT_PROMPT_PROTOCOL).lower()
+    if protocol not in PROMPT_PROTOCOLS:
+        raise ValueError(f"Protocollo non supportato: {protocol} (valori ammessi: {', '.join(PROMPT_PROTOCOLS)})")
+    return protocol
+
+
+def protocol_from_env(default: str = DEFAULT_PROMPT_PROTOCOL) -> str:
+    """
+    Protocollo scelto con la variabile d'ambiente PROMPT_PROTOCOL (full | delta).
+    """
+    return check_protocol(os.getenv("PROMPT_PROTOCOL") or default)
+
+
+def checkpoint_every_from_env(default: int = DEFAULT_CHECKPOINT_EVERY) -> int:
+    """
+    Intervallo dei checkpoint (in mosse dei Neri) dalla variabile d'ambiente PROMPT_CHECKPOINT_EVERY.
+    """
+    return int(os.getenv("PROMPT_CHECKPOINT_EVERY") or default)
+
+
+def delta_turn_prompt(human_move: str, checkpoint: str = None) -> str:
+    """
+    Messaggio dell'utente nel protocollo a delta: la sola mossa dei Bianchi,
+    più la posizione completa (già codificata) quando è il turno di un checkpoint.
+    """
+    lines = [f"Mossa dei Bianchi: {human_move}"]
+    if checkpoint is not None:
+        lines.append(f"Checkpoint, posizione dopo la mossa dei Bianchi: {checkpoint}")
+    lines.append("Rispondi in JSON con: mossa_proposta (come prima chiave), commento_giocatore, messaggio_avversario.")
+    return "\n".join(lines)
+
+
+def message_moves(message: dict) -> list:
+    """
+    Mosse contenute in un messaggio della conversazione: la mossa dei Bianchi nei turni dell'utente
+    ("origine-destinazione"), mossa_proposta nelle risposte dell'assistente (così come scritta dal modello).
+    """
+    content = message.get("content") or ""
+    if message.get("role") == "user":
+        return HUMAN_MOVE_PATTERN.findall(content)
+    if message.get("role") == "assistant":
+        return PROPOSED_MOVE_PATTERN.findall(content)[:1]
+    return []
+
+
+def reconstruct_board(board, messages: list):
+    """
+    Ricostruisce la posizione corrente a partire da 'board' (la posizione dell'ultimo checkpoint)
+    applicando e verificando le mosse dei messaggi successivi: le mosse dell'utente sono dei Bianchi,
+    quelle dell'assistente dei Neri. Le mosse non in formato "origine-destinazione" (es. SAN) vengono
+    risolte con move_parser.resolve_move. Solleva ValueError su una mossa non valida.
+    """
+    color = None
+    for message in messages:
+        for index, move in enumerate(message_moves(message)):
+            if color is None:
+                color = "white" if message.get("role") == "user" else "black"
+            move = move.strip()
+            if not COORDINATE_MOVE_PATTERN.fullmatch(move):
+                try:
+                    _, from_sq, to_sq = resolve_move(move, board, color)
+                except ValueError as e:
+                    raise ValueError(f"Move '{move}' cannot be resolved for {color}: {e}")
+                move = f"{from_sq}-{to_sq}"
+            board = replay_moves(board, [move], color)
+            color = "black" if color == "white" else "white"
+    return board
@@ -0,0 +1,89 @@
+import os
+import sys
+import json
+from modules.chess_core import json_to_board, board_to_json, board_to_fen, fen_to_board
+from modules.chat_session import DEFAULT_MODEL, count_tokens
+
+# Codifiche disponibili per la scacchiera inviata nei prompt (le risposte restano nello schema JSON neri/bianchi)
+JSON_ENCODING = "json"
+FEN_ENCODING = "fen"
+PROMPT_ENCODINGS = (JSON_ENCODING, FEN_ENCODING)
+DEFAULT_PROMPT_ENCODING = JSON_ENCODING
+
+INITIAL_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w - - 0 1"
+
+# Descrizione della codifica da inserire nelle regole del prompt di sistema
+BOARD_FORMAT_DESCRIPTIONS = {
+    JSON_ENCODING: "una codifica in formato JSON che mostra lo stato dell'organizzazione dei pezzi neri e bianchi sulla scacchiera",
+    FEN_ENCODING: ("una stringa FEN (traverse dall'8 all'1 separate da '/', pezzi bianchi in maiuscolo e neri in minuscolo, "
+                   "le cifre indicano caselle vuote consecutive)")
+}
+
+
+def check_encoding(encoding: str) -> str:
+    encoding = (encoding or DEFAULT_PROMPT_ENCODING).lower()
+    if encoding not in PROMPT_ENCODINGS:
+        raise ValueError(f"Codifica del prompt non supportata: {encoding} (valori ammessi: {', '.join(PROMPT_ENCODINGS)})")
+    return encoding
+
+
+def encode_board(board_json, encoding: str = DEFAULT_PROMPT_ENCODING, indent: int = None, side_to_move: str = "b") -> str:
+    """
+    Rappresentazione testuale della scacchiera da inserire nel prompt.
+    - json: json.dumps del dizionario neri/bianchi (con l'indentazione richiesta);
+    - fen: "FEN: <posizione>", poche decine di token invece di centinaia.
+    board_json può essere il dizionario oppure la sua stringa JSON: la stringa viene letta e riscritta
+    (con indent), quindi l'output non coincide con la stringa ricevuta.
+    """
+    encoding = check_encoding(encoding)
+    if isinstance(board_json, str):
+        board_json = json.loads(board_json)
+    if encoding == FEN_ENCODING:
+        return f"FEN: {board_to_fen(json_to_board(board_json), side_to_move)}"
+    return json.dumps(board_json, indent=indent)
+
+
+def board_format_description(encoding: str = DEFAULT_PROMPT_ENCODING) -> str:
+    return BOARD_FORMAT_DESCRIPTIONS[check_encoding(encoding)]
+
+
+def encoding_from_env(default: str = DEFAULT_PROMPT_ENCODING) -> str:
+    """
+    Codifica scelta con la variabile d'ambiente PROMPT_ENCODING (json | fen).
+    """
+    return check_encoding(os.getenv("PROMPT_ENCODING") or default)
+
+
+def compare_encodings(board_json, model: str = DEFAULT_MODEL) -> dict:
+    """
+    Token per messaggio della stessa scacchiera nelle varie rappresentazioni:
+    {"json_indent4": .., "json_compact": .., "fen": ..}.
+    """
+    variants = {
+        "json_indent4": encode_board(board_json, JSON_ENCODING, indent=4),
+        "json_compact": json.dumps(json.loads(encode_board(board_json, JSON_ENCODING)), separators=(",", ":")),
+        "fen": encode_board(board_json, FEN_ENCODING)
+    }
+    return {name: count_tokens(text, model) for name, text in variants.items()}
+
+
+def main(argv: list[str]):
+    """
+    Uso: python -m modules.prompt_codec [file_scacchiera.json] [modello]
+    Senza file usa la posizione iniziale.
+    """
+    board_json = board_to_json(fen_to_board(INITIAL_FEN))
+    if len(argv) >= 1:
+        with open(argv[0], "r", encoding="utf-8") as file:
+            board_json = json.load(file)
+    model = argv[1] if len(argv) >= 2 else DEFAULT_MODEL
+
+    counts = compare_encodings(board_json, model)
+    baseline = counts["json_indent4"]
+    print(f"Token per scacchiera ({model}):")
+    for name, tokens in counts.items():
+        print(f"  {name:<13} {tokens:>5}  ({tokens / baseline:.0%})")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
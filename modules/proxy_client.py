@@ -0,0 +1,307 @@
+import os
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from openai import RateLimitError, OpenAIError
+from modules.chat_session import DEFAULT_SUMMARY_PROMPT
+from modules.sse import iter_sse
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASE_URL = "http://localhost:5000"
+DEFAULT_TIMEOUT = 60
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+# Trasporti disponibili: "http" (proxy remoto) o "inprocess" (ChatSession nello stesso processo)
+TRANSPORT_HTTP = "http"
+TRANSPORT_INPROCESS = "inprocess"
+
+
+class ProxyError(Exception):
+    """
+    Errore restituito dal proxy OpenAI (status HTTP diverso da 2xx o proxy non raggiungibile).
+    """
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(f"{status_code}: {message}")
+        self.status_code = status_code
+        self.message = message
+
+
+def collect_stream(chunks, on_delta=None) -> str:
+    """
+    Consuma uno stream di frammenti (chat_stream) e ritorna la risposta completa;
+    on_delta, se indicato, viene chiamata su ogni frammento appena arriva.
+    """
+    parts = []
+    for delta in chunks:
+        parts.append(delta)
+        if on_delta is not None:
+            on_delta(delta)
+    return "".join(parts)
+
+
+class ProxyClient:
+    """
+    Client del proxy OpenAI (openai_proxy_service.py / openai_proxy_asgi.py).
+    - Usa una requests.Session con pool di connessioni keep-alive: la connessione TCP
+      viene riutilizzata per tutte le chiamate della partita.
+    - Ritenta con backoff esponenziale gli errori di connessione e le risposte 503 (proxy non pronto
+      o sovraccarico, rispettando Retry-After): in entrambi i casi la richiesta non è stata elaborata,
+      quindi è sicuro ritentare anche /chat senza duplicare il prompt.
+    - Ogni richiesta porta il session id, così più partite condividono lo stesso proxy.
+    """
+
+    def __init__(self, base_url: str = None, session_id: str = None, timeout: float = DEFAULT_TIMEOUT,
+                 retries: int = DEFAULT_RETRIES, backoff: float = DEFAULT_BACKOFF, pool_size: int = 4):
+        self.base_url = (base_url or os.getenv("PROXY_BASE_URL") or DEFAULT_BASE_URL).rstrip("/")
+        self.session_id = session_id
+        self.timeout = timeout
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=(503,),
+            allowed_methods=frozenset({"GET", "POST"}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=pool_size)
+        self.http = requests.Session()
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+        self.http.headers.update({"Content-Type": "application/json"})
+        if session_id:
+            self.http.headers.update({"X-Session-Id": session_id})
+        # Token dell'ultima risposta di chat()/chat_stream() riportati dal proxy (None se non disponibili)
+        self.last_usage = None
+
+    @classmethod
+    def from_config(cls, config: dict = None, session_id: str = None) -> "ProxyClient":
+        """
+        Crea il client dalla configurazione (chiavi PROXY_BASE_URL, PROXY_TIMEOUT, PROXY_RETRIES);
+        la variabile d'ambiente PROXY_BASE_URL ha la precedenza sul file di configurazione.
+        """
+        config = config or {}
+        return cls(
+            base_url=os.getenv("PROXY_BASE_URL") or config.get("PROXY_BASE_URL"),
+            session_id=session_id,
+            timeout=float(config.get("PROXY_TIMEOUT", DEFAULT_TIMEOUT)),
+            retries=int(config.get("PROXY_RETRIES", DEFAULT_RETRIES)),
+        )
+
+    def close(self):
+        self.http.close()
+
+    def _request(self, method: str, path: str, payload: dict = None) -> dict:
+        url = f"{self.base_url}{path}"
+        try:
+            resp = self.http.request(method, url, json=payload, timeout=self.timeout)
+        except requests.RequestException as e:
+            logger.error(f"Proxy non raggiungibile ({url}): {e}")
+            raise ProxyError(0, str(e)) from e
+        try:
+            data = resp.json()
+        except ValueError:
+            data = {"error": resp.text}
+        if not resp.ok:
+            message = data.get("error", resp.text) if isinstance(data, dict) else resp.text
+            raise ProxyError(resp.status_code, message)
+        return data
+
+    def init(self, system_messages: list, **extra) -> dict:
+        return self._request("POST", "/chat/init", {"system_messages": system_messages, **extra})
+
+    def chat(self, prompt: str, model: str = None, temperature: float = None, **extra) -> str:
+        payload = {"prompt": prompt, "model": model, "temperature": temperature, **extra}
+        self.last_usage = None
+        data = self._request("POST", "/chat", payload)
+        self.last_usage = data.get("usage")
+        return data["response"]
+
+    def chat_stream(self, prompt: str, model: str = None, temperature: float = None, **extra):
+        """
+        Generatore dei frammenti della risposta ricevuti da /chat/stream (server-sent events).
+        Chiudere il generatore chiude la connessione e interrompe la generazione sul proxy.
+        """
+        url = f"{self.base_url}/chat/stream"
+        payload = {"prompt": prompt, "model": model, "temperature": temperature, **extra}
+        self.last_usage = None
+        try:
+            resp = self.http.post(url, json=payload, timeout=self.timeout, stream=True)
+        except requests.RequestException as e:
+            logger.error(f"Proxy non raggiungibile ({url}): {e}")
+            raise ProxyError(0, str(e)) from e
+        with resp:
+            if not resp.ok:
+                try:
+                    message = resp.json().get("error", resp.text)
+                except ValueError:
+                    message = resp.text
+                raise ProxyError(resp.status_code, message)
+            for event, data in iter_sse(resp.iter_lines(decode_unicode=True)):
+                if event == "error":
+                    raise ProxyError(data.get("status", 500), data.get("error", ""))
+                if event == "done":
+                    self.last_usage = data.get("usage")
+                    return
+                yield data["delta"]
+
+    def append(self, role: str, content: str) -> dict:
+        return self._request("POST", "/chat/append", {"role": role, "content": content})
+
+    def pop_user(self) -> dict:
+        return self._request("POST", "/chat/pop/user")["popped"]
+
+    def pop_assistant(self) -> dict:
+        return self._request("POST", "/chat/pop/assistant")["popped"]
+
+    def last_assistant(self) -> dict:
+        return self._request("POST", "/chat/last/assistant")["last"]
+
+    def last_user(self) -> dict:
+        return self._request("POST", "/chat/last/user")["last"]
+
+    def summarize(self, **options) -> dict:
+        return self._request("POST", "/chat/summarize", options)
+
+    def history(self) -> list:
+        return self._request("GET", "/chat/history")
+
+
+class InProcessProxyClient:
+    """
+    Stessa interfaccia di ProxyClient, ma chiama direttamente i metodi di ChatSession
+    senza passare da HTTP e JSON. Da usare quando il gioco gira sullo stesso host del proxy.
+    Se non viene passato un registro, condivide quello di openai_proxy_service
+    (stessi limiti, stesso client OpenAI e stesso dump della cronologia a chiusura).
+    Gli errori sono mappati sugli stessi status code del proxy HTTP.
+    """
+
+    def __init__(self, session_id: str = None, registry=None, user_id: str = None):
+        if registry is None:
+            from openai_proxy_service import session_registry as registry
+        self.registry = registry
+        self.session_id = session_id
+        # Utente a cui attribuire i consumi: come nel proxy HTTP, in mancanza è il session id
+        self.user_id = user_id or session_id
+        self.last_usage = None
+
+    def close(self):
+        pass
+
+    def init(self, system_messages: list, **extra) -> dict:
+        if not isinstance(system_messages, list) or not system_messages:
+            raise ProxyError(400, "Il campo 'system_messages' è mancante o non è una lista valida.")
+        added = []
+        skipped = []
+        with self.registry.acquire(self.session_id) as chat_session:
+            for msg in system_messages:
+                if chat_session.add_initial_system(msg, force=True):
+                    added.append(msg)
+                else:
+                    skipped.append(msg)
+            history_size = len(chat_session)
+        return {"added_system_messages": added, "skipped_system_messages": skipped, "history_size": history_size}
+
+    def chat(self, prompt: str, model: str = None, temperature: float = None, **extra) -> str:
+        prompt = (prompt or "").strip()
+        if not prompt:
+            raise ProxyError(400, "Prompt mancante")
+        self.last_usage = None
+        try:
+            with self.registry.acquire(self.session_id, self.user_id) as chat_session:
+                answer = chat_session.chat(prompt, model, temperature, use_cache=bool(extra.get("cache", False)),
+                                           priority=int(extra.get("priority", 0)))
+                self.last_usage = chat_session.last_usage
+                return answer
+        except RateLimitError as e:
+            raise ProxyError(429, "Quota esaurita o troppe richieste. Riprova più tardi.") from e
+        except OpenAIError as e:
+            raise ProxyError(502, f"OpenAI API error: {e}") from e
+        except Exception as e:
+            logger.exception("Errore imprevisto")
+            raise ProxyError(500, str(e)) from e
+
+    def chat_stream(self, prompt: str, model: str = None, temperature: float = None, **extra):
+        prompt = (prompt or "").strip()
+        if not prompt:
+            raise ProxyError(400, "Prompt mancante")
+        self.last_usage = None
+        try:
+            with self.registry.acquire(self.session_id, self.user_id) as chat_session:
+                yield from chat_session.chat_stream(prompt, model, temperature,
+                                                    use_cache=bool(extra.get("cache", False)),
+                                                    priority=int(extra.get("priority", 0)))
+                self.last_usage = chat_session.last_usage
+        except RateLimitError as e:
+            raise ProxyError(429, "Quota esaurita o troppe richieste. Riprova più tardi.") from e
+        except OpenAIError as e:
+            raise ProxyError(502, f"OpenAI API error: {e}") from e
+        except Exception as e:
+            logger.exception("Errore imprevisto")
+            raise ProxyError(500, str(e)) from e
+
+    def append(self, role: str, content: str) -> dict:
+        if role not in ("user", "assistant") or not isinstance(content, str):
+            raise ProxyError(400, "Richiesta non valida: 'role' deve essere 'user' o 'assistant' e 'content' una stringa.")
+        with self.registry.acquire(self.session_id, self.user_id) as chat_session:
+            if role == "assistant":
+                # come /chat/append: conferma anche l'eventuale prompt di una richiesta di candidati
+                chat_session.commit_answer(content)
+            else:
+                chat_session.put_message(role, content)
+            history_size = len(chat_session)
+        return {"appended": {"role": role, "content": content}, "history_size": history_size}
+
+    def _call(self, method: str, error: str):
+        with self.registry.acquire(self.session_id) as chat_session:
+            result = getattr(chat_session, method)()
+        if not result:
+            raise ProxyError(400, error)
+        return result
+
+    def pop_user(self) -> dict:
+        return self._call("pop_last_message", "Nessun messaggio da rimuovere")
+
+    def pop_assistant(self) -> dict:
+        return self._call("pop_last_assistant", "Nessun messaggio da rimuovere")
+
+    def last_assistant(self) -> dict:
+        return self._call("get_last_assistant", "Nessun messaggio da assistant")
+
+    def last_user(self) -> dict:
+        return self._call("get_last_user", "Nessun messaggio da user")
+
+    def summarize(self, **options) -> dict:
+        prompt = options.get("prompt", DEFAULT_SUMMARY_PROMPT).strip()
+        with self.registry.acquire(self.session_id) as chat_session:
+            try:
+                result = chat_session.summarize(prompt, model=options.get("model", "gpt-4.1-nano"),
+                                                temperature=float(options.get("temperature", 0.5)))
+            except ValueError as e:
+                raise ProxyError(400, str(e)) from e
+            except Exception as e:
+                print(f"[ERROR] Sintesi fallita: {e}")
+                raise ProxyError(500, "Errore durante la sintesi.") from e
+            return {"status": "ok", **result, "history_size": len(chat_session)}
+
+    def history(self) -> list:
+        with self.registry.acquire(self.session_id) as chat_session:
+            return chat_session.messages
+
+
+def make_proxy_client(config: dict = None, session_id: str = None, registry=None):
+    """
+    Crea il client del proxy secondo il trasporto configurato: variabile d'ambiente
+    PROXY_TRANSPORT oppure chiave omonima del file di configurazione ("http" di default, o "inprocess").
+    """
+    config = config or {}
+    transport = (os.getenv("PROXY_TRANSPORT") or config.get("PROXY_TRANSPORT") or TRANSPORT_HTTP).lower()
+    if transport == TRANSPORT_INPROCESS:
+        return InProcessProxyClient(session_id=session_id, registry=registry)
+    if transport != TRANSPORT_HTTP:
+        raise ValueError(f"Trasporto proxy non valido: {transport} (usa '{TRANSPORT_HTTP}' o '{TRANSPORT_INPROCESS}')")
+    return ProxyClient.from_config(config, session_id=session_id)
@@ -0,0 +1,278 @@
+import os
+import json
+import time
+import heapq
+import random
+import asyncio
+import logging
+import itertools
+import threading
+from openai import RateLimitError
+
+logger = logging.getLogger(__name__)
+
+
+def _wake(future):
+    # eseguita nel loop del task in attesa (call_soon_threadsafe): l'attesa potrebbe essere già scaduta
+    if not future.done():
+        future.set_result(True)
+
+
+class TokenBucket:
+    """
+    Token bucket: capacity unità, ricaricate linearmente in 60 secondi (limiti "al minuto").
+    Il saldo può diventare negativo quando il consumo reale supera la stima (debito da ripagare).
+    """
+
+    def __init__(self, per_minute: float, clock=time.monotonic):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """
+        Secondi da attendere prima di poter consumare amount unità (0 se disponibili ora).
+        """
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float):
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+    def charge(self, amount: float):
+        # addebito a posteriori (es. token effettivi della risposta)
+        self._refill()
+        self.tokens -= amount
+
+
+class RateLimitScheduler:
+    """
+    Pianificatore delle richieste verso OpenAI con limiti per modello:
+    - rpm (richieste al minuto) e tpm (token al minuto) come token bucket per modello;
+    - coda a priorità per modello (priorità più bassa = servita prima, FIFO a parità);
+    - su RateLimitError (429) backoff esponenziale con jitter, e pausa del modello
+      per tutte le richieste in coda, così da non generare tempeste di retry.
+    Un modello senza limiti configurati non viene rallentato (resta solo il backoff sui 429).
+    """
+
+    def __init__(self, limits: dict = None, default_rpm: float = None, default_tpm: float = None,
+                 max_retries: int = 4, base_backoff: float = 1.0, max_backoff: float = 30.0,
+                 clock=time.monotonic, sleep=time.sleep, rng=random.random):
+        # limits: {modello: {"rpm": ..., "tpm": ...}}
+        self.limits = limits or {}
+        self.default_rpm = default_rpm
+        self.default_tpm = default_tpm
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.sleep = sleep
+        self.rng = rng
+        self._lock = threading.Condition()
+        self._buckets = {}
+        self._queues = {}
+        # ticket delle richieste asincrone in attesa -> (loop, future) risolto quando il ticket va in testa
+        self._waiters = {}
+        self._paused_until = {}
+        self._seq = itertools.count()
+        self._stats = {"requests": 0, "rate_limited": 0, "retries": 0, "waited_seconds": 0.0}
+
+    def _model_buckets(self, model):
+        if model not in self._buckets:
+            limits = self.limits.get(model, {})
+            rpm = limits.get("rpm", self.default_rpm)
+            tpm = limits.get("tpm", self.default_tpm)
+            self._buckets[model] = (
+                TokenBucket(rpm, self.clock) if rpm else None,
+                TokenBucket(tpm, self.clock) if tpm else None
+            )
+        return self._buckets[model]
+
+    def _enqueue(self, model, priority):
+        ticket = (priority, next(self._seq))
+        with self._lock:
+            heapq.heappush(self._queues.setdefault(model, []), ticket)
+        return ticket
+
+    def _poll(self, model, ticket, tokens):
+        """
+        Con il lock acquisito: se il ticket è in testa alla coda e i bucket lo consentono
+        consuma la capacità e ritorna 0, altrimenti i secondi da attendere (None = attendere il proprio turno).
+        """
+        queue = self._queues[model]
+        if queue[0] != ticket:
+            return None
+        wait = max(0.0, self._paused_until.get(model, 0.0) - self.clock())
+        rpm_bucket, tpm_bucket = self._model_buckets(model)
+        if rpm_bucket is not None:
+            wait = max(wait, rpm_bucket.wait_time(1))
+        if tpm_bucket is not None:
+            wait = max(wait, tpm_bucket.wait_time(tokens))
+        if wait > 0:
+            return wait
+        if rpm_bucket is not None:
+            rpm_bucket.consume(1)
+        if tpm_bucket is not None:
+            tpm_bucket.consume(tokens)
+        heapq.heappop(queue)
+        self._stats["requests"] += 1
+        self._head_changed(model)
+        return 0.0
+
+    def _head_changed(self, model):
+        # con il lock acquisito: sveglia il nuovo ticket in testa (thread tramite la Condition, task tramite il future)
+        queue = self._queues.get(model)
+        waiter = self._waiters.pop(queue[0], None) if queue else None
+        if waiter is not None:
+            loop, future = waiter
+            loop.call_soon_threadsafe(_wake, future)
+        self._lock.notify_all()
+
+    def _cancel(self, model, ticket):
+        with self._lock:
+            self._waiters.pop(ticket, None)
+            queue = self._queues.get(model, [])
+            if ticket in queue:
+                queue.remove(ticket)
+                heapq.heapify(queue)
+                self._head_changed(model)
+
+    def acquire(self, model: str, tokens: int = 0, priority: int = 0):
+        """
+        Blocca finché la richiesta non può partire rispettando priorità e limiti del modello.
+        """
+        ticket = self._enqueue(model, priority)
+        started = self.clock()
+        try:
+            with self._lock:
+                while True:
+                    wait = self._poll(model, ticket, tokens)
+                    if wait == 0:
+                        break
+                    self._lock.wait(timeout=wait)
+        except BaseException:
+            self._cancel(model, ticket)
+            raise
+        with self._lock:
+            self._stats["waited_seconds"] += self.clock() - started
+
+    async def aacquire(self, model: str, tokens: int = 0, priority: int = 0):
+        """
+        Come acquire(), senza bloccare l'event loop: finché il ticket non è in testa alla coda il task
+        attende un future risolto da chi lo porta in testa; in testa attende solo il tempo richiesto dai bucket.
+        """
+        loop = asyncio.get_running_loop()
+        ticket = self._enqueue(model, priority)
+        started = self.clock()
+        try:
+            while True:
+                with self._lock:
+                    wait = self._poll(model, ticket, tokens)
+                    if wait == 0:
+                        break
+                    turn = loop.create_future()
+                    self._waiters[ticket] = (loop, turn)
+                try:
+                    await asyncio.wait_for(turn, wait)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    with self._lock:
+                        self._waiters.pop(ticket, None)
+        except BaseException:
+            self._cancel(model, ticket)
+            raise
+        with self._lock:
+            self._stats["waited_seconds"] += self.clock() - started
+
+    def backoff_delay(self, attempt: int) -> float:
+        # backoff esponenziale con "full jitter"
+        return self.rng() * min(self.max_backoff, self.base_backoff * (2 ** attempt))
+
+    def _on_rate_limited(self, model, attempt):
+        delay = self.backoff_delay(attempt)
+        with self._lock:
+            self._stats["rate_limited"] += 1
+            self._stats["retries"] += 1
+            # ferma anche le altre richieste in coda per lo stesso modello
+            self._paused_until[model] = max(self._paused_until.get(model, 0.0), self.clock() + delay)
+        logger.warning(f"Rate limit su {model}: nuovo tentativo tra {delay:.2f}s (tentativo {attempt + 1})")
+        return delay
+
+    def _charge_usage(self, model, tokens, result):
+        usage = getattr(result, "usage", None)
+        total = getattr(usage, "total_tokens", None)
+        if not isinstance(total, int) or total <= tokens:
+            return
+        with self._lock:
+            tpm_bucket = self._model_buckets(model)[1]
+            if tpm_bucket is not None:
+                tpm_bucket.charge(total - tokens)
+
+    def run(self, model: str, tokens: int, func, priority: int = 0):
+        """
+        Esegue func() (chiamata a OpenAI) rispettando i limiti; ritenta sui 429 fino a max_retries volte.
+        tokens è la stima dei token della richiesta; se la risposta riporta l'uso effettivo, la differenza viene addebitata.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire(model, tokens, priority)
+            try:
+                result = func()
+            except RateLimitError:
+                if attempt >= self.max_retries:
+                    raise
+                self.sleep(self._on_rate_limited(model, attempt))
+                continue
+            self._charge_usage(model, tokens, result)
+            return result
+
+    async def arun(self, model: str, tokens: int, coro_func, priority: int = 0):
+        """
+        Variante asincrona di run(): coro_func() restituisce la coroutine della chiamata a OpenAI.
+        """
+        for attempt in range(self.max_retries + 1):
+            await self.aacquire(model, tokens, priority)
+            try:
+                result = await coro_func()
+            except RateLimitError:
+                if attempt >= self.max_retries:
+                    raise
+                await asyncio.sleep(self._on_rate_limited(model, attempt))
+                continue
+            self._charge_usage(model, tokens, result)
+            return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **self._stats,
+                "waited_seconds": round(self._stats["waited_seconds"], 3),
+                "queued": {model: len(queue) for model, queue in self._queues.items() if queue}
+            }
+
+
+def scheduler_from_env() -> RateLimitScheduler:
+    """
+    Crea il pianificatore leggendo PROXY_RATE_LIMITS (JSON {modello: {"rpm": .., "tpm": ..}}),
+    PROXY_DEFAULT_RPM, PROXY_DEFAULT_TPM e PROXY_RATE_LIMIT_RETRIES.
+    """
+    limits = json.loads(os.getenv("PROXY_RATE_LIMITS") or "{}")
+    default_rpm = os.getenv("PROXY_DEFAULT_RPM")
+    default_tpm = os.getenv("PROXY_DEFAULT_TPM")
+    return RateLimitScheduler(
+        limits=limits,
+        default_rpm=float(default_rpm) if default_rpm else None,
+        default_tpm=float(default_tpm) if default_tpm else None,
+        max_retries=int(os.getenv("PROXY_RATE_LIMIT_RETRIES", 4))
+    )
@@ -0,0 +1,373 @@
+import os
+import asyncio
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from contextlib import contextmanager, asynccontextmanager
+
+from modules.session_wal import wal_from_env
+from modules.usage_ledger import ledger_from_env
+from modules.session_store import SessionConflict, store_from_env
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SESSION_ID = "default"
+
+
+class _SessionEntry:
+
+    def __init__(self, session):
+        self.session = session
+        self.lock = threading.RLock()
+        # lock asyncio, creato al primo uso dal proxy asincrono
+        self.async_lock = None
+        self.last_access = time.monotonic()
+        self.size_bytes = 0
+        # numero di richieste che stanno usando (o attendono) la sessione: non va sfrattata
+        self.pins = 0
+        # versione della sessione nello store condiviso e revisione della sessione a quella versione
+        self.version = 0
+        self.saved_revision = 0
+
+
+class SessionRegistry:
+    """
+    Registro limitato di sessioni di chat indicizzate per session id.
+    - Ogni sessione ha il proprio lock: richieste su sessioni diverse procedono in parallelo.
+    - Le sessioni meno usate di recente (LRU) vengono sfrattate quando si supera
+      max_sessions, max_memory_bytes oppure restano inattive oltre idle_ttl secondi.
+    - Se spill_dir è impostata, le sessioni sfrattate vengono salvate su disco
+      e ricaricate in modo trasparente alla richiesta successiva.
+    - Se wal (SessionWAL) è impostato, ogni modifica delle sessioni viene registrata nel write-ahead log:
+      le sessioni sopravvivono anche a un crash del processo e vengono ricostruite al primo accesso.
+    - Se ledger (UsageLedger) è impostato, i consumi di ogni completion vengono registrati per sessione
+      e per l'utente indicato ad acquire().
+    - Se store (vedi session_store) è impostato, lo stato delle sessioni vive nello store condiviso:
+      all'inizio di ogni richiesta la sessione viene ricaricata se un altro worker l'ha modificata, alla
+      fine viene salvata con versionamento ottimistico (SessionConflict se un altro worker l'ha salvata prima).
+    """
+
+    def __init__(self, factory, max_sessions: int = 64, idle_ttl: float = 3600,
+                 max_memory_bytes: int = 64 * 1024 * 1024, spill_dir: str = None, wal=None, ledger=None,
+                 store=None):
+        self.factory = factory
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.max_memory_bytes = max_memory_bytes
+        self.spill_dir = spill_dir
+        self.wal = wal
+        self.ledger = ledger
+        self.store = store
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # sessioni sfrattate in corso di salvataggio (fuori dal lock): session_id -> evento di fine salvataggio
+        self._saving = {}
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    @contextmanager
+    def acquire(self, session_id: str = None, user_id: str = None):
+        """
+        Restituisce (creandola o ricaricandola se necessario) la sessione indicata,
+        tenendo il suo lock per tutta la durata del blocco with.
+        I consumi delle completion eseguite nel blocco vengono attribuiti a user_id.
+        """
+        entry = self._pin(session_id)
+        try:
+            with entry.lock:
+                self._bind_usage(session_id, entry, user_id)
+                self._refresh_from_store(session_id, entry)
+                yield entry.session
+                entry.size_bytes = estimate_session_size(entry.session)
+                self._maybe_snapshot(session_id, entry)
+                self._save_to_store(session_id, entry)
+        finally:
+            self._unpin(entry)
+
+    @asynccontextmanager
+    async def acquire_async(self, session_id: str = None, user_id: str = None):
+        """
+        Come acquire(), ma con un lock asyncio: l'attesa sulla sessione non blocca l'event loop.
+        Da usare solo dal proxy asincrono (un solo event loop per processo).
+        """
+        entry = self._pin(session_id)
+        try:
+            if entry.async_lock is None:
+                entry.async_lock = asyncio.Lock()
+            async with entry.async_lock:
+                self._bind_usage(session_id, entry, user_id)
+                self._refresh_from_store(session_id, entry)
+                yield entry.session
+                entry.size_bytes = estimate_session_size(entry.session)
+                self._maybe_snapshot(session_id, entry)
+                self._save_to_store(session_id, entry)
+        finally:
+            self._unpin(entry)
+
+    def __contains__(self, session_id):
+        with self._lock:
+            return session_id in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def snapshot(self) -> dict:
+        """
+        Restituisce {session_id: {"history_size", "size_bytes", "idle_seconds"}} per le sessioni in memoria.
+        """
+        now = time.monotonic()
+        with self._lock:
+            return {
+                sid: {
+                    "history_size": len(entry.session),
+                    "size_bytes": entry.size_bytes,
+                    "idle_seconds": round(now - entry.last_access, 1)
+                }
+                for sid, entry in self._entries.items()
+            }
+
+    def items(self):
+        """
+        Elenca le coppie (session_id, sessione) attualmente in memoria.
+        """
+        with self._lock:
+            return [(sid, entry.session) for sid, entry in self._entries.items()]
+
+    def drop(self, session_id: str) -> bool:
+        """
+        Rimuove la sessione dalla memoria e dall'eventuale copia su disco.
+        """
+        with self._lock:
+            removed = self._entries.pop(session_id, None) is not None
+        path = self._spill_path(session_id)
+        if path and os.path.exists(path):
+            os.remove(path)
+            removed = True
+        if self.wal is not None and self.wal.has(session_id):
+            self.wal.drop(session_id)
+            removed = True
+        if self.store is not None and self.store.delete(session_id):
+            removed = True
+        return removed
+
+    def recover(self) -> list:
+        """
+        Ricarica in memoria tutte le sessioni presenti nel write-ahead log (da chiamare all'avvio).
+        Ritorna gli id delle sessioni recuperate.
+        """
+        if self.wal is None:
+            return []
+        recovered = []
+        for sid in self.wal.session_ids():
+            with self._lock:
+                if sid in self._entries:
+                    continue
+                self._entries[sid] = _SessionEntry(self._load_or_create(sid))
+                recovered.append(sid)
+                evicted = self._enforce_limits()
+            self._save_evicted(evicted)
+        logger.info(f"Recuperate {len(recovered)} sessioni dal write-ahead log")
+        return recovered
+
+    def evict_idle(self):
+        with self._lock:
+            evicted = self._enforce_limits()
+        self._save_evicted(evicted)
+
+    # -- internals -------------------------------------------------------
+
+    def _pin(self, session_id):
+        session_id = session_id or DEFAULT_SESSION_ID
+        while True:
+            with self._lock:
+                saving = self._saving.get(session_id)
+                if saving is None:
+                    entry = self._entries.get(session_id)
+                    if entry is None:
+                        entry = _SessionEntry(self._load_or_create(session_id))
+                        self._entries[session_id] = entry
+                    self._entries.move_to_end(session_id)
+                    entry.pins += 1
+                    return entry
+            # la sessione è stata appena sfrattata: si ricarica quando il suo salvataggio è completo
+            saving.wait()
+
+    def _unpin(self, entry):
+        with self._lock:
+            entry.pins -= 1
+            entry.last_access = time.monotonic()
+            evicted = self._enforce_limits()
+        self._save_evicted(evicted)
+
+    def _enforce_limits(self) -> list:
+        # chiamato con self._lock acquisito; scorre dalla sessione meno recente e toglie dal registro le sessioni
+        # da sfrattare, che il chiamante salva con _save_evicted dopo aver rilasciato il lock
+        evicted = []
+        now = time.monotonic()
+        total_bytes = sum(e.size_bytes for e in self._entries.values())
+        for sid in list(self._entries.keys()):
+            entry = self._entries[sid]
+            over_count = len(self._entries) > self.max_sessions
+            over_memory = total_bytes > self.max_memory_bytes
+            idle = self.idle_ttl is not None and now - entry.last_access > self.idle_ttl
+            if not (over_count or over_memory or idle):
+                continue
+            if entry.pins > 0:
+                continue
+            del self._entries[sid]
+            self._saving[sid] = threading.Event()
+            evicted.append((sid, entry))
+            total_bytes -= entry.size_bytes
+        return evicted
+
+    def _save_evicted(self, evicted: list):
+        # senza il lock del registro: il disco non blocca le richieste sulle altre sessioni
+        for sid, entry in evicted:
+            try:
+                self._evict(sid, entry)
+            finally:
+                with self._lock:
+                    self._saving.pop(sid).set()
+
+    def _bind_usage(self, session_id, entry, user_id):
+        # chiamato con il lock della sessione: i consumi della richiesta vanno alla sessione e al suo utente
+        if self.ledger is not None:
+            entry.session.usage_sink = self.ledger.sink(session_id or DEFAULT_SESSION_ID, user_id)
+
+    def _maybe_snapshot(self, session_id, entry):
+        # chiamato con il lock della sessione acquisito: nessuna modifica può sfuggire allo snapshot
+        session_id = session_id or DEFAULT_SESSION_ID
+        if self.wal is not None and self.wal.needs_snapshot(session_id):
+            try:
+                self.wal.snapshot(session_id, entry.session.to_dict())
+            except Exception as e:
+                logger.error(f"Errore salvando lo snapshot della sessione {session_id}: {e}")
+
+    def _refresh_from_store(self, session_id, entry):
+        # chiamato con il lock della sessione: ricarica lo stato se un altro worker ha salvato una versione più recente
+        if self.store is None:
+            return
+        session_id = session_id or DEFAULT_SESSION_ID
+        if self.store.version(session_id) == entry.version:
+            return
+        version, data = self.store.load(session_id)
+        entry.session.load_dict(data or {})
+        entry.version = version
+        entry.saved_revision = entry.session.revision
+
+    def _save_to_store(self, session_id, entry):
+        # chiamato con il lock della sessione a fine richiesta: salva solo se la storia è cambiata
+        if self.store is None or entry.session.revision == entry.saved_revision:
+            return
+        session_id = session_id or DEFAULT_SESSION_ID
+        try:
+            entry.version = self.store.save(session_id, entry.session.to_dict(), entry.version)
+        except SessionConflict:
+            # un altro worker ha salvato prima: la copia locale viene scartata alla richiesta successiva
+            logger.warning(f"Conflitto di versione sulla sessione {session_id}: la richiesta va ripetuta")
+            entry.version = -1
+            raise
+        entry.saved_revision = entry.session.revision
+
+    def _evict(self, session_id, entry):
+        if self.store is not None:
+            # lo stato è già nello store condiviso
+            logger.info(f"Sessione {session_id} sfrattata dalla memoria (stato nello store)")
+            return
+        if self.wal is not None:
+            # con il write-ahead log la sessione è già su disco: basta uno snapshot per accorciare il log
+            entry.session.journal = None
+            try:
+                self.wal.snapshot(session_id, entry.session.to_dict())
+                logger.info(f"Sessione {session_id} sfrattata dalla memoria (snapshot nel write-ahead log)")
+            except Exception as e:
+                logger.error(f"Errore salvando lo snapshot della sessione {session_id}: {e}")
+            return
+        path = self._spill_path(session_id)
+        if path is None:
+            logger.info(f"Sessione {session_id} sfrattata dalla memoria")
+            return
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump({"session_id": session_id, **entry.session.to_dict()}, f, ensure_ascii=False)
+            logger.info(f"Sessione {session_id} salvata su disco in {path}")
+        except Exception as e:
+            logger.error(f"Errore salvando la sessione {session_id} su disco: {e}")
+
+    def _load_or_create(self, session_id):
+        session = self.factory()
+        if self.store is not None:
+            # lo stato viene letto dallo store all'inizio di ogni richiesta (_refresh_from_store)
+            return session
+        if self.wal is not None:
+            try:
+                if self.wal.load(session_id, session):
+                    logger.info(f"Sessione {session_id} ricostruita dal write-ahead log")
+            except Exception as e:
+                logger.error(f"Errore ricostruendo la sessione {session_id} dal write-ahead log: {e}")
+            session.journal = self.wal.journal(session_id)
+            return session
+        path = self._spill_path(session_id)
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    session.load_dict(json.load(f))
+                os.remove(path)
+            except Exception as e:
+                logger.error(f"Errore ricaricando la sessione {session_id} dal disco: {e}")
+        return session
+
+    def _spill_path(self, session_id):
+        if not self.spill_dir:
+            return None
+        safe = re.sub(r'[^A-Za-z0-9_.-]', '_', session_id)[:64]
+        digest = hashlib.sha1(session_id.encode('utf-8')).hexdigest()[:12]
+        return os.path.join(self.spill_dir, f"session_{safe}_{digest}.json")
+
+
+def estimate_session_size(session) -> int:
+    """
+    Stima approssimativa dell'occupazione in memoria di una sessione (byte del contenuto dei messaggi).
+    """
+    return session.size_bytes
+
+
+def registry_from_env(factory) -> SessionRegistry:
+    """
+    Crea il registro delle sessioni leggendo i limiti dalle variabili d'ambiente
+    PROXY_MAX_SESSIONS, PROXY_SESSION_IDLE_TTL, PROXY_SESSION_MAX_MEMORY_MB e PROXY_SESSION_SPILL_DIR,
+    più il write-ahead log (PROXY_SESSION_WAL_DIR, vedi wal_from_env) e il registro dei consumi
+    (USAGE_LEDGER_PATH, vedi ledger_from_env) e lo store condiviso (PROXY_SESSION_STORE, vedi store_from_env).
+    """
+    return SessionRegistry(
+        factory=factory,
+        max_sessions=int(os.getenv("PROXY_MAX_SESSIONS", 64)),
+        idle_ttl=float(os.getenv("PROXY_SESSION_IDLE_TTL", 3600)),
+        max_memory_bytes=int(float(os.getenv("PROXY_SESSION_MAX_MEMORY_MB", 64)) * 1024 * 1024),
+        spill_dir=os.getenv("PROXY_SESSION_SPILL_DIR") or None,
+        wal=wal_from_env(),
+        ledger=ledger_from_env(),
+        store=store_from_env()
+    )
+
+
+def dump_registry_history(registry: SessionRegistry, logs_dir: str = 'resources/logs') -> str:
+    """
+    Salva la cronologia di tutte le sessioni non vuote in un file JSON con timestamp.
+    Ritorna il percorso del file creato, oppure None se non c'era nulla da salvare.
+    """
+    history = {sid: session.messages for sid, session in registry.items() if len(session)}
+    if not history:
+        return None
+    os.makedirs(logs_dir, exist_ok=True)
+    now = datetime.now().strftime('%Y%m%d-%H%M%S-%f')[:-3]
+    path = os.path.join(logs_dir, f"history_{now}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(history, f, ensure_ascii=False, indent=2)
+    return path
@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STORE_PATH = "resources/sessions.sqlite"
+
+
+class SessionConflict(Exception):
+    """
+    La sessione è stata modificata da un'altra richiesta (o da un altro worker) dopo essere stata letta.
+    """
+
+
+class MemorySessionStore:
+    """
+    Store delle sessioni in memoria, per un solo processo: stessa interfaccia degli store condivisi.
+    Ogni sessione ha una versione che cresce ad ogni salvataggio (0 = sessione assente).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # session_id -> (versione, dati)
+        self._sessions = {}
+
+    def version(self, session_id: str) -> int:
+        with self._lock:
+            return self._sessions.get(session_id, (0, None))[0]
+
+    def load(self, session_id: str):
+        """
+        Ritorna (versione, dati) della sessione; (0, None) se non esiste.
+        """
+        with self._lock:
+            version, data = self._sessions.get(session_id, (0, None))
+            return version, json.loads(data) if data is not None else None
+
+    def save(self, session_id: str, data: dict, expected_version: int) -> int:
+        """
+        Salva la sessione solo se la versione corrente è expected_version (compare-and-swap)
+        e ritorna la nuova versione; altrimenti solleva SessionConflict.
+        """
+        payload = json.dumps(data, ensure_ascii=False)
+        with self._lock:
+            current = self._sessions.get(session_id, (0, None))[0]
+            if current != expected_version:
+                raise SessionConflict(f"Sessione {session_id} alla versione {current}, attesa {expected_version}")
+            self._sessions[session_id] = (current + 1, payload)
+            return current + 1
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def session_ids(self) -> list:
+        with self._lock:
+            return sorted(self._sessions)
+
+    def close(self):
+        pass
+
+
+class SQLiteSessionStore:
+    """
+    Store delle sessioni su SQLite, condiviso da tutti i worker e i processi dello stesso host.
+    Il database è in modalità WAL (letture concorrenti alle scritture); il salvataggio è un UPDATE
+    condizionato alla versione letta, quindi atomico anche tra processi diversi.
+    """
+
+    def __init__(self, path: str = DEFAULT_STORE_PATH, timeout: float = 30):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=timeout, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, version INTEGER NOT NULL, "
+            "data TEXT NOT NULL, updated REAL NOT NULL)"
+        )
+
+    def version(self, session_id: str) -> int:
+        with self._lock:
+            row = self._db.execute("SELECT version FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return row[0] if row else 0
+
+    def load(self, session_id: str):
+        with self._lock:
+            row = self._db.execute("SELECT version, data FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        if row is None:
+            return 0, None
+        return row[0], json.loads(row[1])
+
+    def save(self, session_id: str, data: dict, expected_version: int) -> int:
+        payload = json.dumps(data, ensure_ascii=False)
+        with self._lock:
+            if expected_version == 0:
+                cursor = self._db.execute(
+                    "INSERT OR IGNORE INTO sessions (session_id, version, data, updated) VALUES (?, 1, ?, ?)",
+                    (session_id, payload, time.time()))
+            else:
+                cursor = self._db.execute(
+                    "UPDATE sessions SET version = version + 1, data = ?, updated = ? "
+                    "WHERE session_id = ? AND version = ?",
+                    (payload, time.time(), session_id, expected_version))
+        if cursor.rowcount != 1:
+            raise SessionConflict(f"Sessione {session_id} modificata da un'altra richiesta (versione attesa {expected_version})")
+        return expected_version + 1
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            return self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,)).rowcount > 0
+
+    def session_ids(self) -> list:
+        with self._lock:
+            return [row[0] for row in self._db.execute("SELECT session_id FROM sessions ORDER BY session_id")]
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+def store_from_env():
+    """
+    Crea lo store delle sessioni da PROXY_SESSION_STORE: 'memory' (un solo processo), 'sqlite'
+    (condiviso tra i worker, file PROXY_SESSION_STORE_PATH) oppure vuoto (nessuno store: le sessioni
+    restano solo nel registro in memoria del processo).
+    """
+    backend = (os.getenv("PROXY_SESSION_STORE") or "").lower()
+    if not backend:
+        return None
+    if backend == "memory":
+        return MemorySessionStore()
+    if backend == "sqlite":
+        return SQLiteSessionStore(os.getenv("PROXY_SESSION_STORE_PATH") or DEFAULT_STORE_PATH)
+    raise ValueError(f"PROXY_SESSION_STORE non valido: {backend}. Valori ammessi: memory, sqlite")
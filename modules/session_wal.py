@@ -0,0 +1,225 @@
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class SessionWAL:
+    """
+    Write-ahead log delle sessioni di chat: un file JSONL per sessione con una riga per modifica
+    (add, evict, pop, replace, reset) e uno snapshot periodico dello stato completo.
+    - Ogni riga è scritta e passata al sistema operativo subito (un crash del processo non perde nulla);
+      l'fsync su disco è a lotti, ogni fsync_interval secondi, da un thread in background.
+    - Dopo snapshot_every modifiche la sessione può essere salvata in uno snapshot e il log troncato;
+      ogni riga ha un numero di sequenza, così il recupero ignora le righe già incluse nello snapshot.
+    - load() ricostruisce lo stato di una sessione da snapshot + log (anche con un'ultima riga troncata).
+    """
+
+    def __init__(self, directory: str, fsync_interval: float = 0.05, snapshot_every: int = 200):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.snapshot_every = snapshot_every
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # session_id -> {"file", "seq", "since_snapshot", "dirty"}
+        self._logs = {}
+        self._closed = threading.Event()
+        self._flusher = None
+        if fsync_interval and fsync_interval > 0:
+            self._flusher = threading.Thread(target=self._flush_loop, name="session-wal-fsync", daemon=True)
+            self._flusher.start()
+
+    # -- percorsi --------------------------------------------------------
+
+    def _base_name(self, session_id: str) -> str:
+        safe = re.sub(r'[^A-Za-z0-9_.-]', '_', session_id)[:64]
+        digest = hashlib.sha1(session_id.encode('utf-8')).hexdigest()[:12]
+        return f"{safe}_{digest}"
+
+    def log_path(self, session_id: str) -> str:
+        return os.path.join(self.directory, f"wal_{self._base_name(session_id)}.jsonl")
+
+    def snapshot_path(self, session_id: str) -> str:
+        return os.path.join(self.directory, f"snap_{self._base_name(session_id)}.json")
+
+    # -- scrittura -------------------------------------------------------
+
+    def _open(self, session_id):
+        # chiamato con self._lock acquisito
+        state = self._logs.get(session_id)
+        if state is None:
+            snapshot, entries = self._read(session_id)
+            seq = max([snapshot.get("seq", 0)] + [e.get("seq", 0) for e in entries])
+            state = {
+                "file": open(self.log_path(session_id), 'a', encoding='utf-8'),
+                "seq": seq,
+                "since_snapshot": len(entries),
+                "dirty": False
+            }
+            self._logs[session_id] = state
+        return state
+
+    def append(self, session_id: str, entry: dict):
+        """
+        Registra una modifica della sessione (una riga JSON con numero di sequenza, timestamp e session id).
+        """
+        with self._lock:
+            state = self._open(session_id)
+            state["seq"] += 1
+            line = json.dumps({"seq": state["seq"], "ts": round(time.time(), 3), "session_id": session_id, **entry},
+                              ensure_ascii=False)
+            state["file"].write(line + "\n")
+            state["file"].flush()
+            state["since_snapshot"] += 1
+            state["dirty"] = True
+            if self._flusher is None:
+                os.fsync(state["file"].fileno())
+                state["dirty"] = False
+
+    def journal(self, session_id: str):
+        """
+        Funzione da assegnare a ChatSession.journal per registrare le modifiche della sessione.
+        """
+        return lambda entry: self.append(session_id, entry)
+
+    def needs_snapshot(self, session_id: str) -> bool:
+        with self._lock:
+            state = self._logs.get(session_id)
+            return state is not None and state["since_snapshot"] >= self.snapshot_every
+
+    def snapshot(self, session_id: str, data: dict):
+        """
+        Salva lo stato completo della sessione (to_dict()) in modo atomico e tronca il log.
+        Da chiamare con il lock della sessione acquisito, così che nessuna modifica vada persa.
+        """
+        with self._lock:
+            state = self._open(session_id)
+            path = self.snapshot_path(session_id)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"session_id": session_id, "seq": state["seq"], **data}, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            state["file"].close()
+            state["file"] = open(self.log_path(session_id), 'w', encoding='utf-8')
+            state["since_snapshot"] = 0
+            state["dirty"] = False
+
+    def sync(self):
+        """
+        Porta su disco (fsync) tutte le righe scritte finora.
+        """
+        with self._lock:
+            for state in self._logs.values():
+                if state["dirty"]:
+                    os.fsync(state["file"].fileno())
+                    state["dirty"] = False
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.fsync_interval):
+            try:
+                self.sync()
+            except Exception as e:
+                logger.error(f"Errore durante l'fsync del write-ahead log: {e}")
+
+    # -- recupero --------------------------------------------------------
+
+    def _read(self, session_id):
+        snapshot = {}
+        path = self.snapshot_path(session_id)
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+        entries = []
+        path = self.log_path(session_id)
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                lines = f.read().splitlines()
+            for number, line in enumerate(lines):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # solo l'ultima riga può essere incompleta (crash durante la scrittura)
+                    if number == len(lines) - 1:
+                        logger.warning(f"Ultima riga del log di {session_id} incompleta: ignorata")
+                        break
+                    raise
+                if entry.get("seq", 0) > snapshot.get("seq", 0):
+                    entries.append(entry)
+        return snapshot, entries
+
+    def has(self, session_id: str) -> bool:
+        return os.path.exists(self.snapshot_path(session_id)) or os.path.exists(self.log_path(session_id))
+
+    def load(self, session_id: str, session) -> bool:
+        """
+        Ricostruisce la sessione (ChatSession) da snapshot e log. Ritorna False se non c'è nulla da recuperare.
+        """
+        if not self.has(session_id):
+            return False
+        snapshot, entries = self._read(session_id)
+        if snapshot:
+            session.load_dict(snapshot)
+        for entry in entries:
+            session.apply_journal(entry)
+        return True
+
+    def session_ids(self) -> list:
+        """
+        Session id presenti su disco (letti dagli snapshot e dalla prima riga utile dei log).
+        """
+        ids = set()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if name.startswith("snap_") and name.endswith(".json"):
+                    with open(path, 'r', encoding='utf-8') as f:
+                        ids.add(json.load(f)["session_id"])
+                elif name.startswith("wal_") and name.endswith(".jsonl"):
+                    with open(path, 'r', encoding='utf-8') as f:
+                        first = f.readline()
+                    if first.strip():
+                        ids.add(json.loads(first)["session_id"])
+            except (OSError, ValueError, KeyError):
+                continue
+        return sorted(ids)
+
+    def drop(self, session_id: str):
+        with self._lock:
+            state = self._logs.pop(session_id, None)
+            if state is not None:
+                state["file"].close()
+            for path in (self.log_path(session_id), self.snapshot_path(session_id)):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def close(self):
+        self._closed.set()
+        self.sync()
+        with self._lock:
+            for state in self._logs.values():
+                state["file"].close()
+            self._logs.clear()
+
+
+def wal_from_env():
+    """
+    Crea il write-ahead log delle sessioni se PROXY_SESSION_WAL_DIR è impostata,
+    con PROXY_WAL_FSYNC_INTERVAL (secondi) e PROXY_WAL_SNAPSHOT_EVERY (modifiche tra due snapshot).
+    """
+    directory = os.getenv("PROXY_SESSION_WAL_DIR")
+    if not directory:
+        return None
+    return SessionWAL(
+        directory,
+        fsync_interval=float(os.getenv("PROXY_WAL_FSYNC_INTERVAL", 0.05)),
+        snapshot_every=int(os.getenv("PROXY_WAL_SNAPSHOT_EVERY", 200))
+    )
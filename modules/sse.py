@@ -0,0 +1,37 @@
+import json
+
+
+def format_sse(payload: dict, event: str = None) -> str:
+    """
+    Serializza un evento server-sent-events (text/event-stream) con payload JSON.
+    """
+    data = json.dumps(payload, ensure_ascii=False)
+    if event:
+        return f"event: {event}\ndata: {data}\n\n"
+    return f"data: {data}\n\n"
+
+
+def iter_sse(lines):
+    """
+    Legge gli eventi da un iterabile di righe (str) di uno stream SSE.
+    Restituisce coppie (event, payload) dove event è "message" se non specificato.
+    """
+    event = "message"
+    data = []
+    for line in lines:
+        if line is None:
+            continue
+        line = line.rstrip("\r\n")
+        if not line:
+            if data:
+                yield event, json.loads("\n".join(data))
+            event = "message"
+            data = []
+        elif line.startswith(":"):
+            continue
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data.append(line[len("data:"):].lstrip())
+    if data:
+        yield event, json.loads("\n".join(data))
@@ -0,0 +1,99 @@
+import os
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Istruzioni per la sintesi in background dei turni più vecchi
+DEFAULT_BACKGROUND_SUMMARY_PROMPT = (
+    "Riassumi in modo conciso la parte di conversazione che segue, conservando richieste, decisioni, "
+    "mosse giocate ed eventuali errori segnalati. Se è presente una sintesi precedente, integrala. "
+    "Rispondi solo con la sintesi."
+)
+# Priorità delle richieste di sintesi nel pianificatore dei limiti di rate (dopo le richieste interattive)
+SUMMARY_PRIORITY = 10
+
+
+class BackgroundSummarizer:
+    """
+    Sintesi automatica delle sessioni di chat in background.
+    Quando i token di una sessione superano high_watermark (frazione del budget della storia del modello),
+    i turni più vecchi necessari a rientrare sotto low_watermark vengono sintetizzati dall'LLM
+    in un thread del pool (o in un task asyncio per le sessioni con solo il client asincrono).
+    La sostituzione del tratto sintetizzato avviene nella sessione alla richiesta successiva,
+    sotto il lock della sessione: le richieste in corso non attendono mai la sintesi.
+    """
+
+    def __init__(self, high_watermark: float = 0.75, low_watermark: float = 0.5, model: str = None,
+                 prompt: str = DEFAULT_BACKGROUND_SUMMARY_PROMPT, keep_turns: int = 4, max_workers: int = 2,
+                 priority: int = SUMMARY_PRIORITY):
+        if not 0 < low_watermark < high_watermark <= 1:
+            raise ValueError("Watermark non validi: serve 0 < low_watermark < high_watermark <= 1")
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        # Modello per la sintesi (None = lo stesso della conversazione)
+        self.model = model
+        self.prompt = prompt
+        # Turni più recenti da non sintetizzare mai
+        self.keep_turns = keep_turns
+        self.priority = priority
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="summarizer")
+        self._lock = threading.Lock()
+        self._stats = {"scheduled": 0, "applied": 0, "discarded": 0, "failed": 0}
+
+    def should_summarize(self, session, model: str) -> bool:
+        return session.total_tokens > self.high_watermark * session.history_budget(model)
+
+    def target_tokens(self, session, model: str) -> int:
+        return int(self.low_watermark * session.history_budget(model))
+
+    def submit(self, session, request: dict):
+        """
+        Avvia la richiesta di sintesi e ritorna il Future (o il Task asyncio) della completion,
+        oppure None se la sessione non ha un client utilizzabile da qui.
+        I consumi vanno al sink della sessione al momento dell'avvio (sessione e utente della richiesta).
+        """
+        sink = session.usage_sink
+        if session.client is not None:
+            future = self._executor.submit(session._summary_completion, request, self.priority, sink)
+        elif session.async_client is not None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return None
+            future = loop.create_task(session._asummary_completion(request, self.priority, sink))
+        else:
+            return None
+        self.record("scheduled")
+        return future
+
+    def record(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+    def shutdown(self, wait: bool = False):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+
+def summarizer_from_env():
+    """
+    Crea il sintetizzatore in background se PROXY_SUMMARY_HIGH_WATERMARK è impostata (es. 0.75),
+    con PROXY_SUMMARY_LOW_WATERMARK, PROXY_SUMMARY_MODEL, PROXY_SUMMARY_KEEP_TURNS e PROXY_SUMMARY_WORKERS.
+    Ritorna None se la sintesi automatica è disattivata.
+    """
+    high_watermark = os.getenv("PROXY_SUMMARY_HIGH_WATERMARK")
+    if not high_watermark or float(high_watermark) <= 0:
+        return None
+    return BackgroundSummarizer(
+        high_watermark=float(high_watermark),
+        low_watermark=float(os.getenv("PROXY_SUMMARY_LOW_WATERMARK", 0.5)),
+        model=os.getenv("PROXY_SUMMARY_MODEL") or None,
+        keep_turns=int(os.getenv("PROXY_SUMMARY_KEEP_TURNS", 4)),
+        max_workers=int(os.getenv("PROXY_SUMMARY_WORKERS", 2))
+    )
@@ -0,0 +1,191 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+from datetime import datetime, timezone
+from modules.model_registry import MODELS, request_cost
+
+logger = logging.getLogger(__name__)
+
+# Campi per cui è possibile filtrare e raggruppare i consumi
+GROUP_FIELDS = ("day", "session_id", "user_id", "model")
+
+
+def usage_day(timestamp: float) -> str:
+    """
+    Giorno (UTC, formato YYYY-MM-DD) a cui viene attribuita una richiesta.
+    """
+    return datetime.fromtimestamp(timestamp, timezone.utc).date().isoformat()
+
+
+class UsageLedger:
+    """
+    Registro dei consumi dell'LLM (richieste, token, costo stimato, latenza) per giorno, sessione, utente e modello.
+    - record() aggiorna solo un aggregato in memoria: nessun I/O sul percorso della richiesta.
+    - Un thread in background scrive gli aggregati su SQLite ogni flush_interval secondi in una sola
+      transazione (upsert che somma ai totali già salvati); flush() li scrive subito.
+    - query() restituisce i totali filtrati per sessione, utente e giorno, raggruppati per i campi richiesti.
+    Senza path il database resta in memoria.
+    """
+
+    def __init__(self, path: str = None, flush_interval: float = 5.0, clock=time.time):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self._lock = threading.Lock()
+        # (giorno, session_id, user_id, modello) -> [richieste, token prompt, token risposta, costo, latenza totale]
+        self._pending = {}
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path or ":memory:", check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS usage (day TEXT NOT NULL, session_id TEXT NOT NULL, user_id TEXT NOT NULL, "
+            "model TEXT NOT NULL, requests INTEGER NOT NULL, prompt_tokens INTEGER NOT NULL, "
+            "completion_tokens INTEGER NOT NULL, cost REAL NOT NULL, latency REAL NOT NULL, "
+            "PRIMARY KEY (day, session_id, user_id, model))"
+        )
+        self._db.commit()
+        self._closed = threading.Event()
+        self._flusher = None
+        if flush_interval and flush_interval > 0:
+            self._flusher = threading.Thread(target=self._flush_loop, name="usage-ledger-flush", daemon=True)
+            self._flusher.start()
+
+    def record(self, session_id: str, model: str, prompt_tokens: int, completion_tokens: int,
+               latency: float = 0.0, user_id: str = None):
+        """
+        Aggiunge una completion agli aggregati in memoria.
+        """
+        cost = request_cost(model, prompt_tokens, completion_tokens) if model in MODELS else 0.0
+        key = (usage_day(self.clock()), session_id or "", user_id or "", model or "")
+        with self._lock:
+            totals = self._pending.get(key)
+            if totals is None:
+                totals = self._pending[key] = [0, 0, 0, 0.0, 0.0]
+            totals[0] += 1
+            totals[1] += prompt_tokens
+            totals[2] += completion_tokens
+            totals[3] += cost
+            totals[4] += latency or 0.0
+
+    def sink(self, session_id: str, user_id: str = None):
+        """
+        Funzione usage_sink(model, prompt_tokens, completion_tokens, latency) per ChatSession e GameSession.
+        """
+        return lambda model, prompt_tokens, completion_tokens, latency=0.0: self.record(
+            session_id, model, prompt_tokens, completion_tokens, latency, user_id)
+
+    def flush(self) -> int:
+        """
+        Scrive su SQLite gli aggregati accumulati; ritorna il numero di righe aggiornate.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            if not pending or self._db is None:
+                return 0
+            try:
+                self._db.executemany(
+                    "INSERT INTO usage (day, session_id, user_id, model, requests, prompt_tokens, completion_tokens, "
+                    "cost, latency) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (day, session_id, user_id, model) DO UPDATE SET "
+                    "requests = requests + excluded.requests, "
+                    "prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                    "completion_tokens = completion_tokens + excluded.completion_tokens, "
+                    "cost = cost + excluded.cost, latency = latency + excluded.latency",
+                    [key + tuple(totals) for key, totals in pending.items()]
+                )
+                self._db.commit()
+            except sqlite3.Error as e:
+                # gli aggregati non scritti tornano in coda per il flush successivo
+                logger.error(f"Errore scrivendo i consumi su disco: {e}")
+                self._db.rollback()
+                for key, totals in pending.items():
+                    current = self._pending.setdefault(key, [0, 0, 0, 0.0, 0.0])
+                    for i, value in enumerate(totals):
+                        current[i] += value
+                return 0
+            return len(pending)
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Errore durante il flush dei consumi: {e}")
+
+    def query(self, session_id: str = None, user_id: str = None, day: str = None,
+              group_by=("session_id",)) -> list:
+        """
+        Totali (richieste, token, costo in USD, latenza media) filtrati per sessione, utente e giorno
+        e raggruppati per i campi di group_by (tra day, session_id, user_id, model), dal più costoso.
+        """
+        group_by = list(group_by or ())
+        for field in group_by:
+            if field not in GROUP_FIELDS:
+                raise ValueError(f"Campo di raggruppamento non valido: {field}. Campi ammessi: {', '.join(GROUP_FIELDS)}")
+        self.flush()
+        filters, params = [], []
+        for field, value in (("session_id", session_id), ("user_id", user_id), ("day", day)):
+            if value is not None:
+                filters.append(f"{field} = ?")
+                params.append(value)
+        where = f"WHERE {' AND '.join(filters)}" if filters else ""
+        group = f"GROUP BY {', '.join(group_by)}" if group_by else ""
+        columns = ", ".join(group_by + ["SUM(requests)", "SUM(prompt_tokens)", "SUM(completion_tokens)",
+                                        "SUM(cost)", "SUM(latency)"])
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT {columns} FROM usage {where} {group} ORDER BY SUM(cost) DESC", params).fetchall()
+        result = []
+        for row in rows:
+            requests, prompt_tokens, completion_tokens, cost, latency = row[len(group_by):]
+            if not requests:
+                continue
+            result.append({
+                **dict(zip(group_by, row)),
+                "requests": requests,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "cost": round(cost, 6),
+                "avg_latency": round(latency / requests, 3)
+            })
+        return result
+
+    def close(self):
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join(timeout=1)
+        self.flush()
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+def ledger_from_env() -> UsageLedger:
+    """
+    Crea il registro dei consumi leggendo USAGE_LEDGER_PATH (file SQLite; vuoto = solo memoria)
+    e USAGE_FLUSH_INTERVAL (secondi tra due scritture, default 5).
+    """
+    return UsageLedger(
+        path=os.getenv("USAGE_LEDGER_PATH") or None,
+        flush_interval=float(os.getenv("USAGE_FLUSH_INTERVAL", 5))
+    )
+
+
+def usage_query_args(args) -> dict:
+    """
+    Parametri di query() letti dalla query string di /usage: session_id, user_id, day e
+    group_by (campi separati da virgola, default session_id).
+    """
+    group_by = args.get("group_by") or "session_id"
+    return {
+        "session_id": args.get("session_id") or None,
+        "user_id": args.get("user_id") or None,
+        "day": args.get("day") or None,
+        "group_by": [field.strip() for field in group_by.split(",") if field.strip()]
+    }
@@ -1,8 +1,6 @@
 import sys
 import os
 import json
-import re
-import requests
 import uuid
 import random
 import time
@@ -11,6 +9,9 @@ from collections import deque
 from datetime import datetime, timedelta
 from modules.version import VERSION
 from utils.app_utils import load_config 
+from modules.proxy_client import ProxyClient, ProxyError, make_proxy_client, collect_stream
+from modules.json_extractor import extract_json_object
+from modules.model_registry import ModelRouter, router_from_config
 from utils.file_utils import save_content_in_file
 from utils.constants import OUT_FOLDER_PARAMETER, DEFAULT_CONFIG_FILE
 from off_catalog import fetch_product_detail, load_categories, search_category, list_products_for_category, SEARCH_URL, PRODUCT_URL
@@ -18,15 +19,9 @@ from off_catalog import fetch_product_detail, load_categories, search_category,
 # TODO porta questo in un file di configurazione config.json
 DEFAULT_MODEL = "gpt-4.1-nano"  # Modello predefinito se non specificato
 
-# Mappa dei modelli con i loro ID
-model_map: dict[int, str] = {
-    0: "gpt-4o-mini",  # 0.15
-    1: "gpt-4o",    #$2.50
-    2: "gpt-4.1-nano", # 0.10
-    3: "gpt-4.1-mini", # $0.40
-    4: "o4-mini",     # $1.10
-    5: "gpt-4.1"   #$2.00
-}
+# Router dei modelli: sceglie il modello per ogni richiesta in base a esiti recenti, latenza p95 e costo
+# (scala dei modelli in modules/model_registry.py), riconfigurato in main() dal file di configurazione (MODEL_ROUTER)
+router = ModelRouter(start_model=DEFAULT_MODEL)
 
 STATE_TEMPERATURES = {
     "search": (0.84, 0.96) ,  # es. per ricerca prodotti
@@ -39,24 +34,19 @@ STATE_TEMPERATURES = {
    # "confirm": (0.2, 0.4),   # es. prima di completare
 }
 
+# Client del proxy OpenAI (connessione keep-alive condivisa), riconfigurato in main() dal file di configurazione
+proxy = ProxyClient()
+# Se True le risposte dell'LLM arrivano in streaming (/chat/stream) e vengono mostrate man mano (config PROXY_STREAM)
+STREAM_REPLIES = False
+
+def print_delta(delta: str):
+    print(delta, end="", flush=True)
+
 #Determina e modula la temperatura in base allo stato
 def get_temperature_for_state(state):
     min_temp, max_temp = STATE_TEMPERATURES.get(state, (0.40, 0.50))
     return round(random.uniform(min_temp, max_temp), 2)
 
-# Data il nome del modello, ritorna il suo indice nella mappa, serve a cambiare modello in caso di errori
-def get_model_gear(name: str) -> int:
-    """
-    Ritorna l'indice del modello dato il suo nome,
-    oppure 0 se name è None o non si trova in inv_model_map.
-    """
-    if not name:
-        return 0
-    for idx, model in model_map.items():
-        if model == name:
-            return idx
-    return 0
-#
 def normalize(text):
     return unicodedata.normalize("NFKC", text.strip().casefold())
     
@@ -151,32 +141,26 @@ def init_chatgpt_session(rules, target, output, language='italiano'):
         ] 
 
     # 2. Chiama l’endpoint /chat/init
-    resp = requests.post(
-        "http://localhost:5000/chat/init",
-        json={"system_messages": system_messages, "language": language},
-        headers={"Content-Type": "application/json"}
-    )
     print("Let's start ChatGPT Session...")
     # 3. Controlla l’esito
-    if resp.status_code == 200:
-        result = resp.json()
+    try:
+        result = proxy.init(system_messages, language=language)
         # print("[DEBUG] System messages added:", result["added_system_messages"])
         # print("[DEBUG] System messages skipped:", result["skipped_system_messages"])
-    else:
-        print(f"Errore {resp.status_code}: {resp.text}")
+    except ProxyError as e:
+        print(f"Errore {e.status_code}: {e.message}")
 
 def get_last_assistant_message():
     """
     Rimuove l’ultimo messaggio (sia user che assistant): 
     se vuoi solo assistant, potresti poi controllare il role di ritorno.
     """
-    resp = requests.post(f"http://localhost:5000/chat/last/assistant")
-    if resp.ok:
-        last = resp.json()["last"]
+    try:
+        last = proxy.last_assistant()
         # print("[DEBUG] ✅ Last message:", last)
         return last
-    else:
-        print(f"❌ Error {resp.status_code}:", resp.text)
+    except ProxyError as e:
+        print(f"❌ Error {e.status_code}:", e.message)
         return None
 
 def get_last_user_message():
@@ -184,13 +168,12 @@ def get_last_user_message():
     Rimuove l’ultimo messaggio (sia user che assistant): 
     se vuoi solo assistant, potresti poi controllare il role di ritorno.
     """
-    resp = requests.post(f"http://localhost:5000/chat/last/user")
-    if resp.ok:
-        last = resp.json()["last"]
+    try:
+        last = proxy.last_user()
         # print("[DEBUG] ✅ Last message:", last)
         return last
-    else:
-        print(f"❌ Error {resp.status_code}:", resp.text)
+    except ProxyError as e:
+        print(f"❌ Error {e.status_code}:", e.message)
         return None
 
 def summarize_messages():
@@ -198,13 +181,12 @@ def summarize_messages():
     Rimuove l’ultimo messaggio (sia user che assistant): 
     se vuoi solo assistant, potresti poi controllare il role di ritorno.
     """
-    resp = requests.post(f"http://localhost:5000/chat/summarize")
-    if resp.ok:
-        status = resp.json()["status"]
+    try:
+        status = proxy.summarize()["status"]
         print("[DEBUG] ✅ summarize status:", status)
         return status
-    else:
-        print(f"❌ Error {resp.status_code}:", resp.text)
+    except ProxyError as e:
+        print(f"❌ Error {e.status_code}:", e.message)
         return None
 
 def remove_last_assistant_message():
@@ -212,72 +194,52 @@ def remove_last_assistant_message():
     Rimuove l’ultimo messaggio (sia user che assistant): 
     se vuoi solo assistant, potresti poi controllare il role di ritorno.
     """
-    resp = requests.post(f"http://localhost:5000/chat/pop/assistant")
-    if resp.ok:
-        popped = resp.json()["popped"]
+    try:
+        popped = proxy.pop_assistant()
         # print("[DEBUG] ✅ Pop Message:", popped)
         return popped
-    else:
-        print(f"❌ Error {resp.status_code}:", resp.text)
+    except ProxyError as e:
+        print(f"❌ Error {e.status_code}:", e.message)
         return None
 
 def append_message_to_chat(role="user", content = ""):
     # Invia un messaggio alla chat e ritorna la dimensione della sessione della chat
-    resp = requests.post(
-        f"http://localhost:5000/chat/append",
-        json={"role": role, "content": content},
-        headers={"Content-Type": "application/json"}
-    )
-    if resp.ok:
-        data = resp.json()
+    try:
+        data = proxy.append(role, content)
         # print("[DEBUG] ✅ Append Message:", data["appended"])
         # print("[DEBUG] 🔢 History Size:", data["history_size"])
-    else:
-        print(f"❌[ERROR] {resp.status_code}:", resp.text)
+    except ProxyError as e:
+        print(f"❌[ERROR] {e.status_code}:", e.message)
+
+def attempt_outcome(model: str, latency: float) -> dict:
+    """
+    Parametri di router.record() per l'ultima richiesta: modello, latenza e token riportati dal proxy
+    (0 se la richiesta è fallita o la risposta è servita dalla cache), da cui il router stima il costo.
+    """
+    usage = proxy.last_usage or {}
+    return {
+        "model": model,
+        "latency": latency,
+        "prompt_tokens": usage.get("prompt_tokens", 0),
+        "completion_tokens": usage.get("completion_tokens", 0)
+    }
 
 def send_message_to_chat(prompt_text, model: str = DEFAULT_MODEL,
              temperature: float = 0.5, language='italiano'):
     # a differenza di append_message_to_chat, questa funzione invia un messaggio specifico e ritorna la risposta del modello.
     
-    # 3. Prepara il payload JSON
-    payload = {
-        "prompt": prompt_text,
-        "model": model,
-        "temperature": temperature, 
-        "language": language
-    }
-
-    # 4. Invia la richiesta al tuo Flask server in ascolto su localhost:5000
-    response = requests.post(
-        "http://localhost:5000/chat",
-        json=payload,
-        headers={"Content-Type": "application/json"}
-    )
-
-    # 5. Gestisci la risposta
-    if response.status_code == 200:
-        response_data = response.json()
-        # print(f"[DEBUG] ChatGPT response: {response_data}")
-        return response_data["response"]
-    else:
-        response_data = response.json()
-        print(f"[DEBUG] ChatGPT error response: {response_data}")
+    # 3. Invia la richiesta al proxy OpenAI e gestisci la risposta
+    try:
+        if STREAM_REPLIES:
+            answer = collect_stream(proxy.chat_stream(prompt_text, model=model, temperature=temperature,
+                                                      language=language), print_delta)
+            print()
+            return answer
+        return proxy.chat(prompt_text, model=model, temperature=temperature, language=language)
+    except ProxyError as e:
+        print(f"[DEBUG] ChatGPT error response: {e}")
         return None
    
-# Carica le categorie dal catalogo OpenFoodFacts: TODO potrebbe essere spostato in un file di utilità
-def sanitize_json_string(json_string):
-    """
-    Tenta di riparare una stringa JSON che contiene virgolette non escapate.
-    ATTENZIONE: È una soluzione euristica, non perfetta.
-    """
-    # Rimuove caratteri di controllo non stampabili
-    json_string = re.sub(r"[\x00-\x1F\x7F]", "", json_string)
-
-    # Sostituisce doppie virgolette erronee (es: "... \" ... \"" --> corretti)
-    json_string = re.sub(r'(?<!\\)"(?![:,{}\[\]\s])', r'\\"', json_string)
-
-    return json_string
-
 # Main chat loop
 def play_match(config, initial_state, execution_id, is_human_turn):
 
@@ -285,7 +247,7 @@ def play_match(config, initial_state, execution_id, is_human_turn):
 
     # TODO: utilizzare config per parametri come modello, temperatura, ecc.
     # print(f"Configurazione partita: {config}")
-    CURRENT_MODEL = DEFAULT_MODEL  # Modello attualmente in uso
+    CURRENT_MODEL = router.choose()  # Modello attualmente in uso (scelto dal router)
     START_TIME = datetime.now()
     TIME_LIMIT = timedelta(minutes=45)
     RETRY_TIME = 3
@@ -524,9 +486,15 @@ def play_match(config, initial_state, execution_id, is_human_turn):
             computer_response = None
             computer_result = None
             computer_completed = False
+            # esito da registrare nel router per l'ultimo tentativo (modello, latenza e token)
+            attempt = None
 
             while computer_response is None and retry_count < max_retries:
+                if attempt is not None:
+                    # il tentativo precedente non ha prodotto una risposta valida: il router può già salire di modello
+                    router.record(success=False, **attempt)
                 retry_count += 1
+                CURRENT_MODEL = router.choose()
                 temperature = get_temperature_for_state(last_request_type)
                 current_temperature = temperature
                 print(f"[DEBUG] temperature {temperature:.2f}")
@@ -545,7 +513,9 @@ def play_match(config, initial_state, execution_id, is_human_turn):
                                     "completed":false
                                 }}
                                """
+                started = time.monotonic()
                 computer_response = send_message_to_chat(prompt_text, model=CURRENT_MODEL, temperature=temperature)
+                attempt = attempt_outcome(CURRENT_MODEL, time.monotonic() - started)
 
                 if computer_response is None:
                     print("[DEBUG] No response from ChatGPT. Retrying...")
@@ -557,24 +527,15 @@ def play_match(config, initial_state, execution_id, is_human_turn):
                     save_content_in_file(computer_response, "resources/responses", f"chatbot-{execution_id}")
 
                     try:
-                        content = json.loads(computer_response)
-                    except json.JSONDecodeError as e:
-                        # potrebbe essere necessario riparare il JSON
-                        print(f"[WARNING] JSONDecodeError: {e}. trying sanification...")
-
-                        # Prova a riparare il JSON
-                        fixed = sanitize_json_string(computer_response)
-
-                        try:
-                            content = json.loads(fixed)
-                            print("[INFO] JSON repaired successfully.")
-                        except json.JSONDecodeError as e2:
-                            print(f"[ERROR] fail to repair: {e2}")
-                            print(f"[DEBUG] Original response was: {computer_response[:500]}")
-                            remove_last_assistant_message()
-                            computer_response = None
-                            time.sleep(RETRY_TIME)
-                            continue
+                        # estrae l'oggetto JSON (fence, testo intorno, virgolette non escapate, troncamenti)
+                        content = extract_json_object(computer_response)
+                    except ValueError as e:
+                        print(f"[ERROR] fail to repair: {e}")
+                        print(f"[DEBUG] Original response was: {computer_response[:500]}")
+                        remove_last_assistant_message()
+                        computer_response = None
+                        time.sleep(RETRY_TIME)
+                        continue
 
                     # Estrai i campi
                     products = content.get("products", [])
@@ -593,24 +554,26 @@ def play_match(config, initial_state, execution_id, is_human_turn):
             else:
                 append_message_to_chat(role="user", content=f"[CONGRATULATIONS! Assistant proposed a great suggestion.]")
        
+            # esito dell'ultimo tentativo per il router: l'unico che può aver prodotto una risposta valida
+            if attempt is not None:
+                router.record(success=computer_response is not None, **attempt)
+
             if computer_response is not None:
                 is_human_turn = True
-                computer_result = {json.loads(computer_response).get('result', '{}')}
-                computer_completed = {json.loads(computer_response).get('completed', '{}')}
+                computer_result = {content.get('result', '{}')}
+                computer_completed = {content.get('completed', '{}')}
             else:
                 # Se non si riesce ad ottenere una risposta forse il proxy opeaai ha terminato i token disponibili
                 # CALL FOR SUMMARIZE MESSAGE
                 summarize_messages()
 
-                # Gear up del modello
-                gear_up = get_model_gear(CURRENT_MODEL)+1
-                CURRENT_MODEL = model_map.get(gear_up, DEFAULT_MODEL)
-                print(f"[DEBUG] Engine cannot retrieve a correct response from ChatGPT, trying to increase model gear to: {CURRENT_MODEL}")
+                print(f"[DEBUG] Engine cannot retrieve a correct response from ChatGPT, next model chosen by the router: {router.choose()}")
                 continue
                 
     return "Assistant complete with result= {computer_result} and completed= {computer_completed} after {retry_count} retries."
 
 def main():
+    global proxy, router, STREAM_REPLIES
     params = validate_params()
 
     if len(params) >= 1 and ('-config' in [param.lower() for param in params]):
@@ -618,10 +581,14 @@ def main():
     else: 
         config = load_config("/mnt/d/DEV/Prj/TEMP/PromptChess/config.json")
     print(f"[DEBUG] Configuration loaded: {config}")
-    # TODO imposta un parametro per la cartella di output
-    output_folder =  os.getcwd() + config.get("folders", {}).get(OUT_FOLDER_PARAMETER, "/out/")
     execution_id = str( uuid.uuid4())
     print(f"\nExecution ID: {execution_id}")
+    # una sessione del proxy per esecuzione: più partite in parallelo non condividono la storia
+    proxy = make_proxy_client(config, session_id=execution_id)
+    STREAM_REPLIES = bool(config.get("PROXY_STREAM", False))
+    router = router_from_config(config, DEFAULT_MODEL)
+    # TODO imposta un parametro per la cartella di output
+    output_folder =  os.getcwd() + config.get("folders", {}).get(OUT_FOLDER_PARAMETER, "/out/")
 
     is_human_turn = False
 
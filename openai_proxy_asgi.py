@@ -0,0 +1,611 @@
+"""
+Variante asincrona (ASGI) di openai_proxy_service.py.
+Espone gli stessi endpoint ma usa il client AsyncOpenAI: le richieste in attesa di OpenAI
+non occupano un thread, per cui un solo processo può servire centinaia di chiamate concorrenti.
+
+Avvio:
+    uvicorn openai_proxy_asgi:app --host 0.0.0.0 --port 5000
+oppure:
+    python openai_proxy_asgi.py
+"""
+import os
+import json
+import asyncio
+import logging
+from urllib.parse import parse_qs
+from dotenv import load_dotenv
+from openai import AsyncOpenAI, RateLimitError, OpenAIError
+from modules.chat_session import ChatSession, DEFAULT_SUMMARY_PROMPT, MAX_CANDIDATES
+from modules.session_registry import registry_from_env, dump_registry_history, DEFAULT_SESSION_ID
+from modules.llm_cache import cache_from_env
+from modules.rate_limiter import scheduler_from_env
+from modules.summarizer import summarizer_from_env
+from modules.usage_ledger import usage_query_args
+from modules.session_store import SessionConflict
+from modules.admission import Overloaded, admission_from_env
+from modules.mock_llm import MockAsyncOpenAIClient, use_mock_backend
+from modules.sse import format_sse
+from modules.metrics import (
+    REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE,
+    cache_collector, scheduler_collector, session_collector, summarizer_collector
+)
+
+# Carica le variabili d'ambiente
+dotenv_path = os.getenv('DOTENV_PATH', None)
+if dotenv_path:
+    load_dotenv(dotenv_path)
+else:
+    load_dotenv()
+
+# Instanzia il client OpenAI asincrono (o il backend locale simulato con LLM_BACKEND=mock)
+api_key = os.getenv("OPENAI_API_KEY")
+if use_mock_backend():
+    print("WARNING: LLM_BACKEND=mock, replies are generated locally by MockAsyncOpenAIClient.")
+    async_client = MockAsyncOpenAIClient.from_env()
+elif not api_key:
+    print("WARNING: OPENAI_API_KEY not found. Set the OPENAI_API_KEY environment variable to enable AI features.")
+    async_client = None
+else:
+    async_client = AsyncOpenAI(api_key=api_key)
+
+# Configura il logger
+logging.basicConfig(level=logging.WARN)
+logger = logging.getLogger(__name__)
+
+# Timeout di default (secondi) di una richiesta verso OpenAI, modificabile per richiesta con il campo 'timeout'
+REQUEST_TIMEOUT = float(os.getenv("PROXY_REQUEST_TIMEOUT", 60))
+# Risposta quando un altro worker ha modificato la sessione durante la richiesta (store condiviso)
+SESSION_CONFLICT_MESSAGE = "Sessione modificata da un'altra richiesta. Riprova."
+# Risposta quando il proxy è saturo (limiti di concorrenza e coda d'attesa pieni)
+OVERLOADED_MESSAGE = "Servizio sovraccarico. Riprova più tardi."
+
+# Cache delle risposte condivisa da tutte le sessioni (usata solo dalle richieste con "cache": true)
+llm_cache = cache_from_env()
+
+# Limiti di rate per modello (richieste e token al minuto) condivisi da tutte le sessioni
+rate_scheduler = scheduler_from_env()
+
+# Sintesi in background delle sessioni oltre la soglia di token (PROXY_SUMMARY_HIGH_WATERMARK), disattivata se None
+summarizer = summarizer_from_env()
+
+# Limiti di concorrenza (per processo e per utente) e coda d'attesa delle richieste verso l'LLM
+admission = admission_from_env()
+
+# Registro delle sessioni di chat, condiviso da tutte le richieste dell'event loop
+session_registry = registry_from_env(
+    lambda: ChatSession(None, async_client=async_client, cache=llm_cache, scheduler=rate_scheduler,
+                        summarizer=summarizer))
+
+# Statistiche dei componenti esposte su /metrics (lette solo al momento dello scrape)
+def metrics_collectors() -> list:
+    collectors = [cache_collector(llm_cache), scheduler_collector(rate_scheduler), session_collector(session_registry)]
+    if summarizer is not None:
+        collectors.append(summarizer_collector(summarizer))
+    return collectors
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class EventStream:
+    """
+    Risposta text/event-stream: 'events' è un async iterator di eventi SSE già serializzati.
+    on_close (opzionale) viene chiamata alla fine dello stream, anche se il client si disconnette.
+    """
+
+    def __init__(self, events, on_close=None):
+        self.events = events
+        self.on_close = on_close
+
+
+class TextResponse:
+    """
+    Risposta testuale non JSON (es. le metriche in formato Prometheus).
+    """
+
+    def __init__(self, text: str, content_type: str = "text/plain; charset=utf-8"):
+        self.text = text
+        self.content_type = content_type
+
+
+class Request:
+
+    def __init__(self, scope, body: bytes, receive):
+        self.method = scope["method"]
+        self.path = scope["path"].rstrip("/") or "/"
+        self.headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+        self.args = {k: v[0] for k, v in parse_qs(scope.get("query_string", b"").decode()).items()}
+        self.receive = receive
+        try:
+            self.json = json.loads(body) if body else {}
+        except json.JSONDecodeError:
+            self.json = {}
+        if not isinstance(self.json, dict):
+            self.json = {}
+
+    @property
+    def session_id(self) -> str:
+        """
+        Session id dal body JSON, dall'header 'X-Session-Id' o dalla query string (come nel proxy Flask).
+        """
+        if self.json.get("session_id"):
+            return str(self.json["session_id"])
+        return self.headers.get("x-session-id") or self.args.get("session_id") or DEFAULT_SESSION_ID
+
+    @property
+    def user_id(self) -> str:
+        """
+        Utente per il limite di concorrenza: 'user_id' nel body JSON o header 'X-User-Id', altrimenti il session id.
+        """
+        if self.json.get("user_id"):
+            return str(self.json["user_id"])
+        return self.headers.get("x-user-id") or self.session_id
+
+
+ROUTES = {}
+
+def route(path: str, methods=("GET",)):
+    def decorator(handler):
+        for method in methods:
+            ROUTES[(method, path)] = handler
+        return handler
+    return decorator
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def run_cancellable(request: Request, coro, timeout: float):
+    """
+    Esegue la chiamata verso OpenAI con timeout; se il client chiude la connessione
+    prima della risposta, la chiamata viene cancellata.
+    """
+    task = asyncio.ensure_future(asyncio.wait_for(coro, timeout))
+    watcher = asyncio.ensure_future(wait_for_disconnect(request.receive))
+    done, _ = await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    if task in done:
+        watcher.cancel()
+        return task.result()
+    task.cancel()
+    try:
+        await task
+    except (asyncio.CancelledError, Exception):
+        pass
+    raise ClientDisconnected()
+
+
+def request_timeout(data: dict) -> float:
+    try:
+        return float(data.get("timeout", REQUEST_TIMEOUT))
+    except (TypeError, ValueError):
+        return REQUEST_TIMEOUT
+
+
+@route("/")
+async def home(request):
+    api_status = "configured" if async_client is not None else "not configured (set OPENAI_API_KEY)"
+    return {
+        "service": "PromptChess OpenAI Proxy (async)",
+        "status": "running",
+        "api_key_status": api_status,
+        "active_sessions": len(session_registry),
+        "endpoints": {
+            "/chat": "POST - Send chat messages ('n' > 1: uncommitted candidate replies)",
+            "/chat/stream": "POST - Send chat messages, reply streamed as server-sent events",
+            "/chat/init": "POST - Initialize chat session",
+            "/chat/history": "GET - Get chat history",
+            "/chat/append": "POST - Append message to chat",
+            "/chat/sessions": "GET - List active chat sessions",
+            "/chat/cache": "GET - Response cache statistics",
+            "/chat/limits": "GET - Rate limit scheduler statistics",
+            "/chat/summaries": "GET - Background summarization statistics",
+            "/chat/admission": "GET - Concurrency limits and wait queue statistics",
+            "/usage": "GET - Token and cost usage per session/user/day/model (filters: session_id, user_id, day; group_by)",
+            "/metrics": "GET - Prometheus metrics (LLM latency, tokens, retries, cache, sessions)"
+        },
+        "session_id": "Send 'session_id' in the JSON body, the 'X-Session-Id' header or the query string",
+        "user_id": "Per-user concurrency limit: 'user_id' in the JSON body or the 'X-User-Id' header (default: session id)"
+    }, 200
+
+
+@route("/chat", methods=("POST",))
+async def chat(request):
+    data = request.json
+    prompt = (data.get("prompt") or "").strip()
+    model = data.get("model", None)
+    temperature = data.get("temperature", None)
+    try:
+        # Con n > 1 vengono restituite n risposte candidate senza aggiungerle alla storia (vedi /chat/append)
+        n = int(data.get("n", 1))
+        priority = int(data.get("priority", 0))
+    except (TypeError, ValueError):
+        return {"error": "'n' e 'priority' devono essere numeri interi"}, 400
+
+    if not prompt:
+        return {"error": "Prompt mancante"}, 400
+    if not 1 <= n <= MAX_CANDIDATES:
+        return {"error": f"'n' deve essere compreso tra 1 e {MAX_CANDIDATES}"}, 400
+
+    try:
+        async with admission.admit_async(request.user_id, timeout=request_timeout(data)), \
+                session_registry.acquire_async(request.session_id, request.user_id) as chat_session:
+            if n > 1:
+                candidates = await run_cancellable(
+                    request, chat_session.achat_candidates(prompt, model, temperature, n=n, priority=priority),
+                    request_timeout(data))
+                return {"candidates": candidates}, 200
+            answer = await run_cancellable(
+                request, chat_session.achat(prompt, model, temperature, use_cache=bool(data.get("cache", False)),
+                                            priority=priority),
+                request_timeout(data))
+            usage = chat_session.last_usage
+        return {"response": answer, "usage": usage}, 200
+
+    except asyncio.TimeoutError:
+        logger.warning("Timeout della richiesta verso OpenAI")
+        return {"error": "Timeout della richiesta verso OpenAI."}, 504
+
+    except RateLimitError as e:
+        logger.warning(f"Rate limit / Quota exhausted: {e}")
+        return {"error": "Quota esaurita o troppe richieste. Riprova più tardi."}, 429
+
+    except OpenAIError as e:
+        logger.error(f"Errore API OpenAI: {e}")
+        return {"error": f"OpenAI API error: {e}"}, 502
+
+
+@route("/chat/stream", methods=("POST",))
+async def chat_stream(request):
+    data = request.json
+    prompt = (data.get("prompt") or "").strip()
+    model = data.get("model", None)
+    temperature = data.get("temperature", None)
+    use_cache = bool(data.get("cache", False))
+    try:
+        priority = int(data.get("priority", 0))
+    except (TypeError, ValueError):
+        return {"error": "'priority' deve essere un numero intero"}, 400
+
+    if not prompt:
+        return {"error": "Prompt mancante"}, 400
+
+    # il posto viene occupato prima di iniziare lo stream (503 se saturo) e liberato alla sua chiusura
+    release = await admission.aacquire(request.user_id, timeout=request_timeout(data))
+
+    async def events():
+        parts = []
+        try:
+            async with session_registry.acquire_async(request.session_id, request.user_id) as chat_session:
+                stream = chat_session.achat_stream(prompt, model, temperature, use_cache=use_cache,
+                                                   priority=priority)
+                try:
+                    async for delta in stream:
+                        parts.append(delta)
+                        yield format_sse({"delta": delta})
+                finally:
+                    await stream.aclose()
+                usage = chat_session.last_usage
+            yield format_sse({"response": "".join(parts), "usage": usage}, event="done")
+
+        except SessionConflict:
+            yield format_sse({"error": SESSION_CONFLICT_MESSAGE, "status": 409}, event="error")
+
+        except RateLimitError as e:
+            logger.warning(f"Rate limit / Quota exhausted: {e}")
+            yield format_sse({"error": "Quota esaurita o troppe richieste. Riprova più tardi.", "status": 429}, event="error")
+
+        except OpenAIError as e:
+            logger.error(f"Errore API OpenAI: {e}")
+            yield format_sse({"error": f"OpenAI API error: {e}", "status": 502}, event="error")
+
+        except Exception:
+            logger.exception("Errore imprevisto")
+            yield format_sse({"error": "Errore interno del server", "status": 500}, event="error")
+
+    return EventStream(events(), on_close=release), 200
+
+
+@route("/chat/init", methods=("POST",))
+async def chat_init(request):
+    system_messages = request.json.get("system_messages")
+    if not isinstance(system_messages, list) or not system_messages:
+        return {"error": "Il campo 'system_messages' è mancante o non è una lista valida."}, 400
+
+    added = []
+    skipped = []
+    async with session_registry.acquire_async(request.session_id) as chat_session:
+        for msg in system_messages:
+            if chat_session.add_initial_system(msg, force=True):
+                added.append(msg)
+            else:
+                skipped.append(msg)
+        history_size = len(chat_session)
+
+    return {
+        "added_system_messages": added,
+        "skipped_system_messages": skipped,
+        "history_size": history_size
+    }, 200
+
+
+@route("/chat/history")
+async def chat_history(request):
+    async with session_registry.acquire_async(request.session_id) as chat_session:
+        return chat_session.messages, 200
+
+
+@route("/chat/sessions")
+async def chat_sessions(request):
+    return session_registry.snapshot(), 200
+
+
+@route("/chat/cache")
+async def chat_cache_stats(request):
+    return llm_cache.stats(), 200
+
+
+@route("/chat/limits")
+async def chat_limits_stats(request):
+    return rate_scheduler.stats(), 200
+
+
+@route("/chat/summaries")
+async def chat_summaries_stats(request):
+    if summarizer is None:
+        return {"enabled": False}, 200
+    return {"enabled": True, **summarizer.stats()}, 200
+
+
+@route("/chat/admission")
+async def chat_admission_stats(request):
+    return admission.stats(), 200
+
+
+@route("/usage")
+async def usage(request):
+    """
+    Consumi dell'LLM dal registro dei consumi (vedi il proxy Flask).
+    """
+    if session_registry.ledger is None:
+        return {"enabled": False}, 200
+    try:
+        return {"enabled": True, "usage": session_registry.ledger.query(**usage_query_args(request.args))}, 200
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+
+@route("/metrics")
+async def metrics(request):
+    return TextResponse(REGISTRY.render(metrics_collectors()), METRICS_CONTENT_TYPE), 200
+
+
+@route("/chat/append", methods=("POST",))
+async def append_message(request):
+    role = request.json.get("role")
+    content = request.json.get("content")
+    if role not in ("user", "assistant") or not isinstance(content, str):
+        return {"error": "Richiesta non valida: 'role' deve essere 'system', 'user' o 'assistant' e 'content' una stringa."}, 400
+    async with session_registry.acquire_async(request.session_id, request.user_id) as chat_session:
+        if role == "assistant":
+            # conferma anche l'eventuale prompt di una richiesta di candidati (vedi /chat con n > 1)
+            chat_session.commit_answer(content)
+        else:
+            chat_session.put_message(role, content)
+        history_size = len(chat_session)
+    return {"appended": {"role": role, "content": content}, "history_size": history_size}, 200
+
+
+@route("/chat/pop/user", methods=("POST",))
+async def pop_last_user_message(request):
+    async with session_registry.acquire_async(request.session_id) as chat_session:
+        popped = chat_session.pop_last_message()
+    if popped:
+        return {"popped": popped}, 200
+    return {"error": "Nessun messaggio da rimuovere"}, 400
+
+
+@route("/chat/pop/assistant", methods=("POST",))
+async def pop_last_assistant_message(request):
+    async with session_registry.acquire_async(request.session_id) as chat_session:
+        popped = chat_session.pop_last_assistant()
+    if popped:
+        return {"popped": popped}, 200
+    return {"error": "Nessun messaggio da rimuovere"}, 400
+
+
+@route("/chat/last/assistant", methods=("POST",))
+async def get_last_assistant_message(request):
+    async with session_registry.acquire_async(request.session_id) as chat_session:
+        last = chat_session.get_last_assistant()
+    if last:
+        return {"last": last}, 200
+    return {"error": "Nessun messaggio da assistant"}, 400
+
+
+@route("/chat/last/user", methods=("POST",))
+async def get_last_user_message(request):
+    async with session_registry.acquire_async(request.session_id) as chat_session:
+        last = chat_session.get_last_user()
+    if last:
+        return {"last": last}, 200
+    return {"error": "Nessun messaggio da user"}, 400
+
+
+@route("/chat/summarize", methods=("POST",))
+async def summarize_messages(request):
+    data = request.json
+    model = data.get("model", "gpt-4.1-nano")
+    temperature = float(data.get("temperature", 0.5))
+    prompt = data.get("prompt", DEFAULT_SUMMARY_PROMPT).strip()
+
+    async with admission.admit_async(request.user_id, timeout=request_timeout(data)), \
+            session_registry.acquire_async(request.session_id, request.user_id) as chat_session:
+        try:
+            result = await run_cancellable(
+                request, chat_session.asummarize(prompt, model=model, temperature=temperature),
+                request_timeout(data))
+        except ValueError as e:
+            return {"error": str(e)}, 400
+        except ClientDisconnected:
+            raise
+        except Exception as e:
+            print(f"[ERROR] Sintesi fallita: {e}")
+            return {"error": "Errore durante la sintesi."}, 500
+        history_size = len(chat_session)
+
+    return {"status": "ok", **result, "history_size": history_size}, 200
+
+
+async def send_json(send, payload, status: int, headers=()):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"access-control-allow-origin", b"*"),
+            *headers,
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_text(send, response: TextResponse, status: int):
+    body = response.text.encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", response.content_type.encode()),
+            (b"content-length", str(len(body)).encode()),
+            (b"access-control-allow-origin", b"*"),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_event_stream(send, request: Request, stream: EventStream):
+    """
+    Invia gli eventi man mano che vengono prodotti; se il client si disconnette
+    il generatore viene chiuso, interrompendo lo stream verso OpenAI.
+    """
+    watcher = asyncio.ensure_future(wait_for_disconnect(request.receive))
+    try:
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream; charset=utf-8"),
+                (b"cache-control", b"no-cache"),
+                (b"access-control-allow-origin", b"*"),
+            ],
+        })
+        async for event in stream.events:
+            if watcher.done():
+                logger.info("Client disconnesso: stream annullato")
+                return
+            await send({"type": "http.response.body", "body": event.encode("utf-8"), "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        watcher.cancel()
+        await stream.events.aclose()
+        if stream.on_close is not None:
+            stream.on_close()
+
+
+async def read_body(receive) -> bytes:
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ClientDisconnected()
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            return body
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # ricostruisce le sessioni dal write-ahead log (PROXY_SESSION_WAL_DIR) dopo un riavvio o un crash
+            session_registry.recover()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            try:
+                path = dump_registry_history(session_registry)
+                if path:
+                    logger.info(f"Cronologia chat salvata in {path}")
+            except Exception as e:
+                logger.error(f"Errore salvando cronologia: {e}")
+            if session_registry.wal is not None:
+                session_registry.wal.close()
+            if session_registry.ledger is not None:
+                session_registry.ledger.close()
+            if session_registry.store is not None:
+                session_registry.store.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    if scope["method"] == "OPTIONS":
+        # Preflight CORS: tutte le origini sono ammesse, come nel proxy Flask
+        await send({
+            "type": "http.response.start",
+            "status": 204,
+            "headers": [
+                (b"access-control-allow-origin", b"*"),
+                (b"access-control-allow-methods", b"GET, POST, OPTIONS"),
+                (b"access-control-allow-headers", b"Content-Type, X-Session-Id, X-User-Id"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": b""})
+        return
+
+    try:
+        request = Request(scope, await read_body(receive), receive)
+        handler = ROUTES.get((request.method, request.path))
+        if handler is None:
+            await send_json(send, {"error": "Not found"}, 404)
+            return
+        payload, status = await handler(request)
+        if isinstance(payload, EventStream):
+            await send_event_stream(send, request, payload)
+            return
+        if isinstance(payload, TextResponse):
+            await send_text(send, payload, status)
+            return
+    except ClientDisconnected:
+        logger.info("Client disconnesso: richiesta annullata")
+        return
+    except SessionConflict:
+        payload, status = {"error": SESSION_CONFLICT_MESSAGE}, 409
+    except Overloaded as e:
+        await send_json(send, {"error": OVERLOADED_MESSAGE, "retry_after": e.retry_after}, 503,
+                        headers=[(b"retry-after", str(e.retry_after).encode())])
+        return
+    except Exception:
+        logger.exception("Errore imprevisto")
+        payload, status = {"error": "Errore interno del server"}, 500
+    await send_json(send, payload, status)
+
+
+if __name__ == "__main__":
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit("uvicorn non installato: esegui 'pip install uvicorn' per avviare il proxy asincrono.")
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", 5000)))
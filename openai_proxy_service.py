@@ -2,12 +2,27 @@ import os
 import atexit
 import json
 import logging
-import tiktoken
-from datetime import datetime
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 from dotenv import load_dotenv
 from openai import OpenAI, RateLimitError, OpenAIError
+from modules.chat_session import (
+    ChatSession, DEFAULT_MODEL, DEFAULT_SUMMARY_PROMPT, MAX_CANDIDATES,
+    get_encoding, count_tokens, count_message_tokens, dynamic_max_tokens
+)
+from modules.session_registry import registry_from_env, dump_registry_history, DEFAULT_SESSION_ID
+from modules.llm_cache import cache_from_env
+from modules.rate_limiter import scheduler_from_env
+from modules.summarizer import summarizer_from_env
+from modules.usage_ledger import usage_query_args
+from modules.session_store import SessionConflict
+from modules.admission import Overloaded, admission_from_env
+from modules.mock_llm import MockOpenAIClient, use_mock_backend
+from modules.sse import format_sse
+from modules.metrics import (
+    REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE,
+    cache_collector, scheduler_collector, session_collector, summarizer_collector
+)
 
 # Carica le variabili d'ambiente
 dotenv_path = os.getenv('DOTENV_PATH', None)
@@ -16,9 +31,12 @@ if dotenv_path:
 else:
     load_dotenv()
 
-# Instanzia il client OpenAI
+# Instanzia il client OpenAI (o il backend locale simulato con LLM_BACKEND=mock)
 api_key = os.getenv("OPENAI_API_KEY")
-if not api_key:
+if use_mock_backend():
+    print("WARNING: LLM_BACKEND=mock, replies are generated locally by MockOpenAIClient.")
+    client = MockOpenAIClient.from_env()
+elif not api_key:
     print("WARNING: OPENAI_API_KEY not found. Set the OPENAI_API_KEY environment variable to enable AI features.")
     client = None
 else:
@@ -28,216 +46,90 @@ else:
 logging.basicConfig(level=logging.WARN)
 logger = logging.getLogger(__name__)
 
-# Definisci la lunghezza massima del contesto per ciascun modello
-DEFAULT_MAX_TOKENS = 16384  # Valore di default se il modello non è specificato
-MODEL_MAX_TOKENS = {
-    "gpt-4o": 16384,
-    "gpt-4o-mini": 16384,
-    "gpt-4": 32768,      # o 32768 se usi la variante 32k
-    "gpt-4-turbo": 32768,
-    "gpt-4.1": 32768,
-    "gpt-4.1-mini": 32768,
-    "gpt-4.1-nano": 32768
-    # aggiungi altri modelli se serve…
-}
-
-def count_message_tokens(messages: list[dict], model: str) -> int:
-    """
-    Conta i token usati dalla lista di messages, includendo qualche overhead per
-    i metadati dei messaggi (13 token per messaggio su cl100k_base).
-    """
-    enc = tiktoken.encoding_for_model(model)
-    total = 0
-    for m in messages:
-        # conteggia i token del content
-        total += len(enc.encode(m["content"]))
-        # aggiungi overhead fisso per ruolo + delimitatori
-        total += 13
-    return total
-
-def dynamic_max_tokens(model: str, messages: list[dict], margin: int = 100) -> int:
-    """
-    Restituisce quanti token puoi allocare per la risposta:
-      max = modello.contesto_max - token_usati - margin
-    Assicura almeno un valore minimo di 0.
-    """
-    try:
-        used = count_message_tokens(messages, model)
-    except Exception:
-        # stima approssimativa: 1 token ≃ 4 caratteri
-        total_chars = sum(len(m.get("content", "")) for m in messages)
-        used = total_chars // 4 + len(messages) * 2  # +2 token di overhead per messaggio
-
-    context_max = MODEL_MAX_TOKENS.get(model, DEFAULT_MAX_TOKENS)
-    available = context_max - used - margin
-    return max(0, available)
-
-class ChatSession:
-
-    def __init__(self, client, max_history=128):
-        self.client = client
-        # Messaggio di sistema iniziale
-        self.messages = []
-        # Numero massimo di messaggi (escluso il system)
-        self.max_history = max_history
-
-        self.system_message_count = 0
-
-    def has_message(self, role: str, content: str) -> bool:
-        """
-        Verifica se un messaggio con il dato role e content è già presente nella storia.
-        """
-        return any(
-            m.get("role") == role and m.get("content") == content
-            for m in self.messages
-        )
-    
-    def put_message(self, role: str, content: str):
-        # Aggiunge un messaggio e mantiene la storia entro max_history
-        self.messages.append({"role": role, "content": content})
-        # Rimuovi il messaggio più vecchio (dopo il system) se superiamo la storia massima
-        if len(self.messages) - 1 > self.max_history:
-            # pop l'elemento immediatamente dopo il system
-            self.messages.pop(self.system_message_count + 1)
-    
-    def prepend_message(self, role: str, content: str):
-        # Aggiunge un messaggio subito dopo il system (in testa alla storia)
-        # Mantiene il sistema al primo posto
-        self.messages.insert(1, {"role": role, "content": content})
-        # Se eccede la history, rimuove l'ultimo
-        if len(self.messages) - 1 > self.max_history:
-            self.messages.pop()
-
-    def pop_last_message(self):
-        # Rimuove l'ultimo messaggio (se non è il system)
-        if len(self.messages) > 1:
-            return self.messages.pop()
-        return None
-    
-    def pop_last_assistant(self):
-        """
-        Rimuove e restituisce l'ultimo messaggio con role 'assistant'.
-        Se non trova messaggi assistant (oltre al system), ritorna None.
-        """
-        # scorri la lista al contrario alla ricerca di un assistant
-        for idx in range(len(self.messages) - 1, 0, -1):
-            if self.messages[idx]["role"] == "assistant":
-                return self.messages.pop(idx)
-        return None
-
-    def clear_messages(self):
-        """
-        Rimuove tutti i messaggi dalla sessione.
-        """
-        self.messages.clear()
-        self.system_message_count = 0
-    
-    def get_last_assistant(self):
-        """
-        Rimuove e restituisce l'ultimo messaggio con role 'assistant'.
-        Se non trova messaggi assistant (oltre al system), ritorna None.
-        """
-        # scorri la lista al contrario alla ricerca di un assistant
-        for idx in range(len(self.messages) - 1, 0, -1):
-            if self.messages[idx]["role"] == "assistant":
-                return self.messages[idx]
-        return None
-    
-    def get_last_user(self):
-        """
-        Rimuove e restituisce l'ultimo messaggio con role 'user'.
-        Se non trova messaggi user (oltre al system), ritorna None.
-        """
-        # scorri la lista al contrario alla ricerca di un user
-        for idx in range(len(self.messages) - 1, 0, -1):
-            if self.messages[idx]["role"] == "user":
-                return self.messages[idx]
-        return None
-
-    def add_initial_system(self, content: str, force : bool) -> bool:
-        """
-        Aggiunge un messaggio di sistema solo se NON sono ancora stati inviati
-        né messaggi user né assistant.
-        Ritorna True se il messaggio è stato aggiunto, False altrimenti.
-        """
-        # cerca in messages eventuali role 'user' o 'assistant'
-        has_interaction = any(m["role"] in ("user", "assistant") for m in self.messages)
-        if not has_interaction:
-            # Se non ci sono interazioni, aggiunge il system solo se non esiste già
-            if not self.has_message("system", content):
-                self.messages.append({"role": "system", "content": content})
-            return True
-        else:
-            if force:
-                # Se forzato, rimuove tutti i messaggi precedenti
-                self.clear_messages()
-                # Aggiunge il nuovo system come primo messaggio
-                self.messages.append({"role": "system", "content": content})
-                return True
-        return False
-
-    def chat(self, prompt: str, model: str = "gpt-4.1-nano",
-             temperature: float = 0.5, margin: int = 100) -> str:
-        
-        if self.client is None:
-            raise RuntimeError("OPENAI_API_KEY not configured. Set the environment variable to enable AI features.")
-        
-        if self.system_message_count == 0:
-            raise RuntimeError("Nessun messaggio di sistema iniziale. Usa /chat/init per aggiungerne uno.")
-
-        # 1) append utente
-        last_user = self.get_last_user()
-        if last_user is not None and last_user.get('content') == prompt:
-            print("[DEBUG] Messaggio utente già presente, non lo aggiungo.")
-        else:
-            self.put_message("user", prompt)
-
-        # 2) calcola max_tokens in base alla storia
-        max_tokens = dynamic_max_tokens(model, self.messages, margin=margin)
-
-        print(f"[DEBUG] Model: {model} - Token disponibili per la risposta: {max_tokens}")
-       
-        # impedisce di eseguire una richiesta che sarebbe respinta dall'API per superamento del limite token complessivo
-        if max_tokens <= 0:
-            raise RuntimeError("Max tokens exceeded.")
-
-        # Chiama l'API
-        completion = self.client.chat.completions.create(
-            model=model,
-            messages=self.messages,
-            temperature=temperature,
-            max_tokens=max_tokens
-        )
-        answer = completion.choices[0].message.content
-        
-        # Aggiunge la risposta del modello
-        self.put_message("assistant", answer)
-
-        print(f"[DEBUG] dimensione chat: {len(chat_session.messages)}")
-        return answer
-
 # Funzione per salvare la cronologia a chiusura
 def dump_history_on_exit():
     try:
-        logs_dir = 'resources/logs'
-        os.makedirs(logs_dir, exist_ok=True)
-        now = datetime.now().strftime('%Y%m%d-%H%M%S-%f')[:-3]
-        filename = f"history_{now}.json"
-        path = os.path.join(logs_dir, filename)
-        with open(path, 'w', encoding='utf-8') as f:
-            json.dump(chat_session.messages, f, ensure_ascii=False, indent=2)
-        logger.info(f"Cronologia chat salvata in {path}")
+        path = dump_registry_history(session_registry)
+        if path:
+            logger.info(f"Cronologia chat salvata in {path}")
     except Exception as e:
         logger.error(f"Errore salvando cronologia: {e}")
+    if session_registry.wal is not None:
+        session_registry.wal.close()
+    if session_registry.ledger is not None:
+        session_registry.ledger.close()
+    if session_registry.store is not None:
+        session_registry.store.close()
 
 # Registra il dump alla chiusura del programma
 atexit.register(dump_history_on_exit)
 
+# Cache delle risposte condivisa da tutte le sessioni (usata solo dalle richieste con "cache": true)
+llm_cache = cache_from_env()
+
+# Limiti di rate per modello (richieste e token al minuto) condivisi da tutte le sessioni
+rate_scheduler = scheduler_from_env()
+
+# Sintesi in background delle sessioni oltre la soglia di token (PROXY_SUMMARY_HIGH_WATERMARK), disattivata se None
+summarizer = summarizer_from_env()
+
+# Limiti di concorrenza (per processo e per utente) e coda d'attesa delle richieste verso l'LLM
+admission = admission_from_env()
+
+# Registro delle sessioni di chat, una per partita/cliente (identificata dal session id)
+session_registry = registry_from_env(
+    lambda: ChatSession(client, cache=llm_cache, scheduler=rate_scheduler, summarizer=summarizer))
+# Ricostruisce le sessioni dal write-ahead log (PROXY_SESSION_WAL_DIR) dopo un riavvio o un crash
+session_registry.recover()
+
+# Statistiche dei componenti esposte su /metrics (lette solo al momento dello scrape)
+def metrics_collectors() -> list:
+    collectors = [cache_collector(llm_cache), scheduler_collector(rate_scheduler), session_collector(session_registry)]
+    if summarizer is not None:
+        collectors.append(summarizer_collector(summarizer))
+    return collectors
+
+
+def get_session_id(data: dict = None) -> str:
+    """
+    Ricava il session id dalla richiesta: campo 'session_id' del body JSON,
+    header 'X-Session-Id' o parametro di query; altrimenti la sessione di default.
+    """
+    if data and data.get("session_id"):
+        return str(data["session_id"])
+    return request.headers.get("X-Session-Id") or request.args.get("session_id") or DEFAULT_SESSION_ID
+
+
+def get_user_id(data: dict = None) -> str:
+    """
+    Utente a cui applicare il limite di concorrenza: campo 'user_id' del body JSON,
+    header 'X-User-Id'; altrimenti il session id.
+    """
+    if data and data.get("user_id"):
+        return str(data["user_id"])
+    return request.headers.get("X-User-Id") or get_session_id(data)
+
 # Instanzia e configura Flask
-chat_session = ChatSession(client)
 app = Flask(__name__, template_folder='webapp/templates', static_folder='webapp/static')
 CORS(app, resources={r"/*": {"origins": "*"}})
 
+# Risposta quando un altro worker ha modificato la sessione durante la richiesta (store condiviso)
+SESSION_CONFLICT_MESSAGE = "Sessione modificata da un'altra richiesta. Riprova."
+
+@app.errorhandler(SessionConflict)
+def session_conflict(e):
+    return jsonify(error=SESSION_CONFLICT_MESSAGE), 409
+
+# Risposta quando il proxy è saturo (limiti di concorrenza e coda d'attesa pieni)
+OVERLOADED_MESSAGE = "Servizio sovraccarico. Riprova più tardi."
+
+@app.errorhandler(Overloaded)
+def overloaded(e):
+    response = jsonify(error=OVERLOADED_MESSAGE, retry_after=e.retry_after)
+    response.status_code = 503
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
+
 @app.route("/")
 def home():
     api_status = "configured" if client is not None else "not configured (set OPENAI_API_KEY)"
@@ -245,12 +137,23 @@ def home():
         "service": "PromptChess OpenAI Proxy",
         "status": "running",
         "api_key_status": api_status,
+        "active_sessions": len(session_registry),
         "endpoints": {
-            "/chat": "POST - Send chat messages",
+            "/chat": "POST - Send chat messages ('n' > 1: uncommitted candidate replies)",
+            "/chat/stream": "POST - Send chat messages, reply streamed as server-sent events",
             "/chat/init": "POST - Initialize chat session",
             "/chat/history": "GET - Get chat history",
-            "/chat/append": "POST - Append message to chat"
-        }
+            "/chat/append": "POST - Append message to chat",
+            "/chat/sessions": "GET - List active chat sessions",
+            "/chat/cache": "GET - Response cache statistics",
+            "/chat/limits": "GET - Rate limit scheduler statistics",
+            "/chat/summaries": "GET - Background summarization statistics",
+            "/chat/admission": "GET - Concurrency limits and wait queue statistics",
+            "/usage": "GET - Token and cost usage per session/user/day/model (filters: session_id, user_id, day; group_by)",
+            "/metrics": "GET - Prometheus metrics (LLM latency, tokens, retries, cache, sessions)"
+        },
+        "session_id": "Send 'session_id' in the JSON body, the 'X-Session-Id' header or the query string",
+        "user_id": "Per-user concurrency limit: 'user_id' in the JSON body or the 'X-User-Id' header (default: session id)"
     })
 
 @app.route("/chat", methods=["POST"])
@@ -260,13 +163,38 @@ def chat():
     prompt = data.get("prompt", "").strip()
     model = data.get("model", None)
     temperature = data.get("temperature", None)
+    # La cache è opt-in: con temperatura > 0 risposte diverse allo stesso prompt sono attese
+    use_cache = bool(data.get("cache", False))
+    try:
+        # Priorità nella coda del pianificatore dei limiti di rate (più bassa = servita prima)
+        priority = int(data.get("priority", 0))
+        # Con n > 1 vengono restituite n risposte candidate (una sola chiamata) senza aggiungerle alla storia:
+        # il client conferma quella scelta con /chat/append
+        n = int(data.get("n", 1))
+    except (TypeError, ValueError):
+        return jsonify({"error": "'n' e 'priority' devono essere numeri interi"}), 400
 
     if not prompt:
         return jsonify({"error": "Prompt mancante"}), 400
+    if not 1 <= n <= MAX_CANDIDATES:
+        return jsonify({"error": f"'n' deve essere compreso tra 1 e {MAX_CANDIDATES}"}), 400
 
     try:
-        answer = chat_session.chat(prompt, model, temperature)
-        return jsonify({"response": answer})
+        user_id = get_user_id(data)
+        with admission.admit(user_id), session_registry.acquire(get_session_id(data), user_id) as chat_session:
+            if n > 1:
+                candidates = chat_session.chat_candidates(prompt, model, temperature, n=n, priority=priority)
+                return jsonify({"candidates": candidates})
+            answer = chat_session.chat(prompt, model, temperature, use_cache=use_cache, priority=priority)
+            # token della completion (None se servita dalla cache), usati dal router dei modelli dei client
+            usage = chat_session.last_usage
+        return jsonify({"response": answer, "usage": usage})
+
+    except SessionConflict:
+        return jsonify(error=SESSION_CONFLICT_MESSAGE), 409
+
+    except Overloaded as e:
+        return overloaded(e)
 
     except RateLimitError as e:
         logger.warning(f"Rate limit / Quota exhausted: {e}")
@@ -280,6 +208,64 @@ def chat():
         logger.exception("Errore imprevisto")
         return jsonify(error="Errore interno del server"), 500
 
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    """
+    Come /chat, ma inoltra la risposta come server-sent events man mano che i token arrivano:
+    eventi 'data: {"delta": ...}', poi 'event: done' con la risposta completa
+    (oppure 'event: error' con error e status). La risposta completa viene aggiunta alla storia.
+    """
+    data = request.get_json() or {}
+    prompt = data.get("prompt", "").strip()
+    model = data.get("model", None)
+    temperature = data.get("temperature", None)
+    use_cache = bool(data.get("cache", False))
+    session_id = get_session_id(data)
+    try:
+        priority = int(data.get("priority", 0))
+    except (TypeError, ValueError):
+        return jsonify({"error": "'priority' deve essere un numero intero"}), 400
+
+    if not prompt:
+        return jsonify({"error": "Prompt mancante"}), 400
+
+    # il posto viene occupato prima di iniziare lo stream (503 se saturo) e liberato alla sua chiusura
+    user_id = get_user_id(data)
+    release = admission.acquire(user_id)
+
+    def events():
+        parts = []
+        try:
+            with session_registry.acquire(session_id, user_id) as chat_session:
+                for delta in chat_session.chat_stream(prompt, model, temperature, use_cache=use_cache,
+                                                           priority=priority):
+                    parts.append(delta)
+                    yield format_sse({"delta": delta})
+                usage = chat_session.last_usage
+            yield format_sse({"response": "".join(parts), "usage": usage}, event="done")
+
+        except SessionConflict:
+            yield format_sse({"error": SESSION_CONFLICT_MESSAGE, "status": 409}, event="error")
+
+        except RateLimitError as e:
+            logger.warning(f"Rate limit / Quota exhausted: {e}")
+            yield format_sse({"error": "Quota esaurita o troppe richieste. Riprova più tardi.", "status": 429}, event="error")
+
+        except OpenAIError as e:
+            logger.error(f"Errore API OpenAI: {e}")
+            yield format_sse({"error": f"OpenAI API error: {e}", "status": 502}, event="error")
+
+        except Exception as e:
+            logger.exception("Errore imprevisto")
+            yield format_sse({"error": "Errore interno del server", "status": 500}, event="error")
+
+        finally:
+            release()
+
+    response = Response(events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    response.call_on_close(release)
+    return response
+
 @app.route("/chat/init", methods=["POST"])
 def chat_init():
     data = request.get_json() or {}
@@ -289,19 +275,20 @@ def chat_init():
 
     added = []
     skipped = []
-    # Prova ad aggiungere ogni system message solo se non ci sono ancora interazioni
-    for msg in system_messages:
-        if chat_session.add_initial_system(msg, force=True):
-            added.append(msg)
-        else:
-            skipped.append(msg)
+    with session_registry.acquire(get_session_id(data)) as chat_session:
+        # Prova ad aggiungere ogni system message solo se non ci sono ancora interazioni
+        for msg in system_messages:
+            if chat_session.add_initial_system(msg, force=True):
+                added.append(msg)
+            else:
+                skipped.append(msg)
 
-    chat_session.system_message_count += len(added)
+        history_size = len(chat_session)
 
     return jsonify({
         "added_system_messages": added,
         "skipped_system_messages": skipped,
-        "history_size": len(chat_session.messages)
+        "history_size": history_size
     }), 200
 
 @app.route("/chat/history", methods=["GET"])
@@ -309,7 +296,66 @@ def chat_history():
     """
     Restituisce la cronologia dei messaggi della sessione di chat.
     """
-    return jsonify(chat_session.messages), 200
+    with session_registry.acquire(get_session_id()) as chat_session:
+        return jsonify(chat_session.messages), 200
+
+@app.route("/chat/sessions", methods=["GET"])
+def chat_sessions():
+    """
+    Elenca le sessioni di chat attualmente in memoria con la loro dimensione.
+    """
+    return jsonify(session_registry.snapshot()), 200
+
+@app.route("/chat/cache", methods=["GET"])
+def chat_cache_stats():
+    """
+    Statistiche della cache delle risposte (hit/miss e voci in memoria e su disco).
+    """
+    return jsonify(llm_cache.stats()), 200
+
+@app.route("/chat/limits", methods=["GET"])
+def chat_limits_stats():
+    """
+    Statistiche del pianificatore dei limiti di rate (richieste, 429, attese e code per modello).
+    """
+    return jsonify(rate_scheduler.stats()), 200
+
+@app.route("/chat/summaries", methods=["GET"])
+def chat_summaries_stats():
+    """
+    Statistiche della sintesi in background (avviate, applicate, scartate, fallite).
+    """
+    if summarizer is None:
+        return jsonify({"enabled": False}), 200
+    return jsonify({"enabled": True, **summarizer.stats()}), 200
+
+@app.route("/chat/admission", methods=["GET"])
+def chat_admission_stats():
+    """
+    Statistiche del controllo di ammissione (richieste ammesse, rifiutate, in corso e in coda).
+    """
+    return jsonify(admission.stats()), 200
+
+@app.route("/usage", methods=["GET"])
+def usage():
+    """
+    Consumi dell'LLM (richieste, token, costo stimato, latenza media) dal registro dei consumi,
+    filtrabili per session_id, user_id e day (YYYY-MM-DD) e raggruppati con group_by (es. day,model).
+    """
+    if session_registry.ledger is None:
+        return jsonify({"enabled": False}), 200
+    try:
+        return jsonify({"enabled": True, "usage": session_registry.ledger.query(**usage_query_args(request.args))}), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Metriche in formato testo Prometheus: latenza e token delle chiamate all'LLM per modello,
+    errori e 429, retry, cache, sessioni attive e dimensione della storia.
+    """
+    return Response(REGISTRY.render(metrics_collectors()), content_type=METRICS_CONTENT_TYPE)
 
 # Endpoint per appendere un messaggio in coda (ultimo)
 @app.route("/chat/append", methods=["POST"])
@@ -320,13 +366,20 @@ def append_message():
     # Verifica che il ruolo sia valido e il contenuto sia una stringa
     if role not in ("user", "assistant") or not isinstance(content, str):
         return jsonify({"error": "Richiesta non valida: 'role' deve essere 'system', 'user' o 'assistant' e 'content' una stringa."}), 400
-    chat_session.put_message(role, content)
-    return jsonify({"appended": {"role": role, "content": content}, "history_size": len(chat_session.messages)}), 200
+    with session_registry.acquire(get_session_id(data), get_user_id(data)) as chat_session:
+        if role == "assistant":
+            # conferma anche l'eventuale prompt di una richiesta di candidati (vedi /chat con n > 1)
+            chat_session.commit_answer(content)
+        else:
+            chat_session.put_message(role, content)
+        history_size = len(chat_session)
+    return jsonify({"appended": {"role": role, "content": content}, "history_size": history_size}), 200
 
 # Endpoint per aggiungere un messaggio in testa (subito dopo il system)
 @app.route("/chat/pop/user", methods=["POST"])
 def pop_last_user_message():
-    popped = chat_session.pop_last_message()
+    with session_registry.acquire(get_session_id(request.get_json(silent=True))) as chat_session:
+        popped = chat_session.pop_last_message()
     if popped:
         return jsonify({"popped": popped}), 200
     return jsonify({"error": "Nessun messaggio da rimuovere"}), 400
@@ -334,7 +387,8 @@ def pop_last_user_message():
 # Endpoint per rimuovere l'ultimo messaggio assistant
 @app.route("/chat/pop/assistant", methods=["POST"])
 def pop_last_assistant_message():
-    popped = chat_session.pop_last_assistant()
+    with session_registry.acquire(get_session_id(request.get_json(silent=True))) as chat_session:
+        popped = chat_session.pop_last_assistant()
     # Se è stato rimosso un messaggio assistant, lo restituisce
     if popped:
         return jsonify({"popped": popped}), 200
@@ -343,7 +397,8 @@ def pop_last_assistant_message():
 # Endpoint per l'ultimo messaggio assistant
 @app.route("/chat/last/assistant", methods=["POST"])
 def get_last_assistant_message():
-    last = chat_session.get_last_assistant()
+    with session_registry.acquire(get_session_id(request.get_json(silent=True))) as chat_session:
+        last = chat_session.get_last_assistant()
     # lo restituisce
     if last:
         return jsonify({"last": last}), 200
@@ -352,7 +407,8 @@ def get_last_assistant_message():
 # Endpoint per l'ultimo messaggio utente
 @app.route("/chat/last/user", methods=["POST"])
 def get_last_user_message():
-    last = chat_session.get_last_user()
+    with session_registry.acquire(get_session_id(request.get_json(silent=True))) as chat_session:
+        last = chat_session.get_last_user()
     # lo restituisce
     if last:
         return jsonify({"last": last}), 200
@@ -362,64 +418,28 @@ def get_last_user_message():
 def summarize_messages():
     print("[DEBUG] Eseguo sintesi della cronologia ...")
 
-    data = request.get_json() or {}
+    data = request.get_json(silent=True) or {}
     model = data.get("model", "gpt-4.1-nano")
     temperature = float(data.get("temperature", 0.5))
    # Prompt minimal per richiedere la sintesi del contesto
-    prompt = data.get("prompt", (
-        "Fornisci una sintesi strutturata e concisa delle richieste dell'utente emerse nella conversazione finora. "
-        "Evidenzia le intenzioni principali e riassumi i contenuti in forma sintetica e professionale."
-    )).strip()
-
-    messages = chat_session.messages
-
-    # Estrai tutti i messaggi user
-    user_messages = [m for m in messages if m.get("role") == "user"]
-
-    if len(user_messages) < 2:
-        return jsonify({"error": "Sono necessari almeno 2 messaggi utente per eseguire la sintesi."}), 400
-
-    # Separa l'ultimo messaggio utente
-    last_user_message = user_messages[-1]
-    user_messages_to_summarize = user_messages[:-1]
-
-    # Costruisci nuova cronologia ridotta (senza i messaggi user da sintetizzare)
-    preserved_messages = [
-        m for m in messages if m.get("role") != "user" or m == last_user_message
-    ]
-
-    # Temporaneamente imposta la nuova cronologia per la richiesta di sintesi
-    chat_session.messages = [
-        m for m in messages if m not in user_messages_to_summarize
-    ]
-
-    try:
-        # Richiedi sintesi all'LLM
-        summary = chat_session.chat(prompt, model=model, temperature=temperature)
-
-        # Ricostruisci la chat session:
-        # 1. Rimuove tutti i messaggi user tranne l’ultimo
-        # 2. Inserisce la sintesi come messaggio system
-        # 3. Reinserisce l’ultimo messaggio utente
-
-        chat_session.clear_messages()
-        chat_session.messages = [
-            m for m in preserved_messages if m != last_user_message
-        ]
-
-        chat_session.put_message("system", f"Richiesta originale del cliente:\n{summary}")
-        chat_session.put_message("user", last_user_message["content"])
+    prompt = data.get("prompt", DEFAULT_SUMMARY_PROMPT).strip()
+
+    user_id = get_user_id(data)
+    with admission.admit(user_id), session_registry.acquire(get_session_id(data), user_id) as chat_session:
+        try:
+            # Richiedi sintesi all'LLM e ricostruisci la cronologia
+            result = chat_session.summarize(prompt, model=model, temperature=temperature)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except Exception as e:
+            print(f"[ERROR] Sintesi fallita: {e}")
+            return jsonify({"error": "Errore durante la sintesi."}), 500
 
         return jsonify({
             "status": "ok",
-            "summary": summary,
-            "preserved_user": last_user_message["content"],
-            "history_size": len(chat_session.messages)
+            **result,
+            "history_size": len(chat_session)
         }), 200
 
-    except Exception as e:
-        print(f"[ERROR] Sintesi fallita: {e}")
-        return jsonify({"error": "Errore durante la sintesi."}), 500
-
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=int(os.getenv("PORT", 5000)), debug=True)
@@ -0,0 +1,188 @@
+"""
+Test Controllo di Ammissione
+Verifica i limiti di concorrenza per processo e per utente, la coda limitata con rifiuto anticipato
+e le risposte 503 con Retry-After dei proxy
+"""
+import pytest
+import sys
+import os
+import asyncio
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import openai_proxy_asgi
+import openai_proxy_service
+from modules.admission import AdmissionController, Overloaded, ADMISSION_SHED
+from modules.metrics import REGISTRY
+from tests.test_proxy import FakeOpenAIClient, call_asgi, proxy_client, registry
+
+
+def wait_until(condition, timeout=2.0):
+    event = threading.Event()
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return True
+        event.wait(0.01)
+    return condition()
+
+
+class TestAdmissionController:
+
+    def test_full_queue_is_shed_immediately(self):
+        admission = AdmissionController(max_concurrent=1, max_queue=0, scope='test-full')
+        release = admission.acquire('mario')
+        with pytest.raises(Overloaded) as e:
+            admission.acquire('luigi')
+        assert e.value.reason == 'queue_full' and e.value.retry_after >= 1
+        assert ADMISSION_SHED.value(scope='test-full', reason='queue_full') == 1
+        release()
+        release()
+        assert admission.stats()['in_flight'] == 0
+        admission.acquire('luigi')()
+
+    def test_queued_request_is_admitted_when_a_slot_frees(self):
+        admission = AdmissionController(max_concurrent=1, max_queue=4, max_wait=5)
+        release = admission.acquire('mario')
+        admitted = []
+        waiter = threading.Thread(target=lambda: admitted.append(admission.acquire('luigi')))
+        waiter.start()
+        assert wait_until(lambda: admission.stats()['queued'] == 1)
+        assert not admitted
+        release()
+        waiter.join(timeout=2)
+        assert len(admitted) == 1
+        assert admission.stats()['in_flight'] == 1
+        assert 'promptchess_admission_queue_depth{scope="proxy"}' in REGISTRY.render()
+        admitted[0]()
+
+    def test_wait_is_bounded_by_max_wait(self):
+        admission = AdmissionController(max_concurrent=1, max_queue=4, max_wait=0.05)
+        release = admission.acquire('mario')
+        with pytest.raises(Overloaded) as e:
+            admission.acquire('luigi')
+        assert e.value.reason == 'timeout'
+        assert admission.stats()['queued'] == 0
+        release()
+
+    def test_per_user_limit_does_not_block_other_users(self):
+        admission = AdmissionController(max_concurrent=4, max_per_user=1, max_queue=4, max_wait=5)
+        release = admission.acquire('mario')
+        admitted = []
+        waiter = threading.Thread(target=lambda: admitted.append(admission.acquire('mario')))
+        waiter.start()
+        assert wait_until(lambda: admission.stats()['queued'] == 1)
+        # la seconda richiesta di mario è in coda, ma luigi ha posto e passa subito
+        admission.acquire('luigi', timeout=0)()
+        release()
+        waiter.join(timeout=2)
+        assert len(admitted) == 1
+        admitted[0]()
+
+    def test_request_is_shed_when_estimated_wait_exceeds_deadline(self):
+        now = [0.0]
+        admission = AdmissionController(max_concurrent=1, max_queue=4, max_wait=30, clock=lambda: now[0])
+        release = admission.acquire('mario')
+        now[0] += 10
+        release()
+        release = admission.acquire('mario')
+        # con 10s di servizio medio e un solo posto, un client disposto ad attendere 1s viene rifiutato subito
+        with pytest.raises(Overloaded) as e:
+            admission.acquire('luigi', timeout=1)
+        assert e.value.reason == 'deadline' and e.value.retry_after == 10
+        release()
+
+    def test_async_admission(self):
+        admission = AdmissionController(max_concurrent=1, max_queue=4, max_wait=5)
+
+        async def scenario():
+            order = []
+
+            async def worker(name, hold):
+                async with admission.admit_async(name):
+                    order.append(name)
+                    await asyncio.sleep(hold)
+
+            await asyncio.gather(worker('mario', 0.05), worker('luigi', 0))
+            return order
+
+        assert asyncio.run(scenario()) == ['mario', 'luigi']
+        assert admission.stats()['admitted'] == 2 and admission.stats()['in_flight'] == 0
+
+    def test_async_wait_is_bounded(self):
+        admission = AdmissionController(max_concurrent=1, max_queue=4, max_wait=5)
+        release = admission.acquire('mario')
+        with pytest.raises(Overloaded):
+            asyncio.run(admission.aacquire('luigi', timeout=0.05))
+        assert admission.stats()['queued'] == 0
+        release()
+
+    def test_async_waiter_is_woken_by_a_release_from_another_thread(self):
+        admission = AdmissionController(max_concurrent=1, max_queue=4, max_wait=5)
+        release = admission.acquire('mario')
+
+        async def scenario():
+            waiter = asyncio.ensure_future(admission.aacquire('luigi'))
+            await asyncio.sleep(0)
+            assert admission.stats()['queued'] == 1 and not waiter.done()
+            threading.Timer(0.02, release).start()
+            return await asyncio.wait_for(waiter, 2)
+
+        asyncio.run(scenario())()
+        assert admission.stats()['in_flight'] == 0 and admission.stats()['admitted'] == 2
+
+    def test_cancelled_async_waiter_leaves_the_queue(self):
+        admission = AdmissionController(max_concurrent=1, max_queue=4, max_wait=5)
+        release = admission.acquire('mario')
+
+        async def scenario():
+            waiter = asyncio.ensure_future(admission.aacquire('luigi'))
+            await asyncio.sleep(0)
+            waiter.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiter
+
+        asyncio.run(scenario())
+        assert admission.stats()['queued'] == 0
+        release()
+        assert admission.stats()['in_flight'] == 0
+
+
+class TestOverloadedResponse:
+
+    def test_flask_proxy_returns_503_with_retry_after(self, proxy_client, registry, monkeypatch):
+        admission = AdmissionController(max_concurrent=1, max_queue=0)
+        monkeypatch.setattr(openai_proxy_service, 'admission', admission)
+        with registry.acquire('a') as session:
+            session.client = FakeOpenAIClient()
+            session.add_initial_system('Regole', force=True)
+        release = admission.acquire('altro utente')
+        r = proxy_client.post('/chat', json={'prompt': 'e2-e4', 'session_id': 'a'})
+        assert r.status_code == 503
+        assert r.headers['Retry-After'] == '1' and r.get_json()['retry_after'] == 1
+        assert proxy_client.post('/chat/stream', json={'prompt': 'e2-e4', 'session_id': 'a'}).status_code == 503
+        release()
+        assert proxy_client.post('/chat', json={'prompt': 'e2-e4', 'session_id': 'a'}).status_code == 200
+        assert admission.stats()['in_flight'] == 0
+
+    def test_flask_stream_releases_its_slot(self, proxy_client, registry, monkeypatch):
+        admission = AdmissionController(max_concurrent=1, max_queue=0)
+        monkeypatch.setattr(openai_proxy_service, 'admission', admission)
+        with registry.acquire('a') as session:
+            session.client = FakeOpenAIClient()
+            session.add_initial_system('Regole', force=True)
+        r = proxy_client.post('/chat/stream', json={'prompt': 'e2-e4', 'session_id': 'a'})
+        assert 'event: done' in r.get_data(as_text=True)
+        r.close()
+        assert admission.stats()['in_flight'] == 0
+
+    def test_asgi_proxy_returns_503(self, monkeypatch):
+        admission = AdmissionController(max_concurrent=1, max_queue=0)
+        monkeypatch.setattr(openai_proxy_asgi, 'admission', admission)
+        release = admission.acquire('mario')
+        status, body = call_asgi('POST', '/chat', {'prompt': 'e2-e4', 'session_id': 'a'}, headers={'X-User-Id': 'luigi'})
+        assert status == 503 and body['retry_after'] == 1
+        status, _ = call_asgi('POST', '/chat/stream', {'prompt': 'e2-e4', 'session_id': 'a'})
+        assert status == 503
+        release()
+        assert call_asgi('GET', '/chat/admission')[1]['shed'] == 2
@@ -0,0 +1,171 @@
+"""
+Test Mosse Candidate
+Verifica che più risposte ottenute con una sola chiamata vengano validate localmente
+e che solo la prima mossa legale entri nella storia
+"""
+import pytest
+import json
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import openai_proxy_asgi
+from modules.chat_session import ChatSession
+from modules.session_registry import SessionRegistry
+from webapp.services.match_controller import MatchController, CANDIDATE_PICKS
+from webapp.services.session_manager import GameSession
+from tests.test_proxy import FakeCompletions, call_asgi, proxy_client, registry
+
+
+def delta_reply(move):
+    return json.dumps({'mossa_proposta': move, 'commento_giocatore': 'Ok'})
+
+
+class FakeSampler:
+    """
+    candidates_func finto: restituisce i candidati preparati per ogni chiamata e registra le conferme.
+    """
+
+    def __init__(self, *rounds):
+        self.rounds = list(rounds)
+        self.calls = []
+        self.committed = []
+
+    def sample(self, prompt, temperature, n):
+        self.calls.append(n)
+        return self.rounds.pop(0)
+
+    def commit(self, prompt, answer):
+        self.committed.append(answer)
+
+
+class FakeCandidateCompletions(FakeCompletions):
+    """
+    Completions finte che rispettano il parametro n restituendo le risposte in ordine.
+    """
+
+    def __init__(self, answers):
+        super().__init__(answers[0])
+        self.answers = answers
+
+    def create(self, **kwargs):
+        self.calls.append(kwargs)
+        choices = []
+        for answer in self.answers[:kwargs.get('n', 1)]:
+            message = type('Message', (), {'content': answer})()
+            choices.append(type('Choice', (), {'message': message})())
+        return type('Completion', (), {'choices': choices, 'usage': None})()
+
+
+class FakeCandidateClient:
+
+    def __init__(self, answers):
+        self.completions = FakeCandidateCompletions(answers)
+        self.chat = type('Chat', (), {'completions': self.completions})()
+
+
+def make_controller(initial_board_json, sampler, candidates=3):
+    controller = MatchController(initial_board_json, llm_func=None, protocol='delta',
+                                 candidates_func=sampler.sample, commit_func=sampler.commit,
+                                 candidates=candidates)
+    assert controller.submit_human_move('P', 'e2', 'e4')['success']
+    return controller
+
+
+class TestCandidateSampling:
+
+    def test_first_legal_candidate_wins_in_one_call(self, initial_board_json):
+        sampler = FakeSampler([delta_reply('e7-e3'), 'non json', delta_reply('d7-d5'), delta_reply('e7-e5')])
+        picks = CANDIDATE_PICKS.value(position='2')
+        result = make_controller(initial_board_json, sampler).request_ai_move()
+        assert result['ai_move'] == 'd7-d5'
+        assert sampler.calls == [3]
+        assert sampler.committed == [delta_reply('d7-d5')]
+        assert CANDIDATE_PICKS.value(position='2') == picks + 1
+
+    def test_no_legal_candidate_commits_first_and_retries(self, initial_board_json):
+        sampler = FakeSampler([delta_reply('e7-e3'), delta_reply('a8-a5')], [delta_reply('e7-e5')])
+        result = make_controller(initial_board_json, sampler, candidates=2).request_ai_move()
+        assert result['ai_move'] == 'e7-e5'
+        assert sampler.calls == [2, 2]
+        assert sampler.committed == [delta_reply('e7-e3'), delta_reply('e7-e5')]
+
+    def test_sampling_requires_commit_func(self, initial_board_json):
+        with pytest.raises(ValueError):
+            MatchController(initial_board_json, llm_func=None, candidates_func=lambda *a: [], candidates=3)
+
+
+class TestChatSessionCandidates:
+
+    def test_candidates_are_not_committed(self):
+        client = FakeCandidateClient(['a', 'b', 'c'])
+        session = ChatSession(client)
+        session.add_initial_system('Regole', force=True)
+        assert session.chat_candidates('e2-e4', n=3) == ['a', 'b', 'c']
+        assert client.completions.calls[0]['n'] == 3
+        assert [m['role'] for m in session.messages] == ['system']
+        session.commit_answer('b')
+        assert [m['content'] for m in session.messages] == ['Regole', 'e2-e4', 'b']
+
+    def test_failed_or_unconfirmed_candidates_leave_no_user_turn(self):
+        client = FakeCandidateClient(['a', 'b'])
+        session = ChatSession(client)
+        session.add_initial_system('Regole', force=True)
+        session.chat_candidates('e2-e4', n=2)
+        client.completions.create = lambda **kwargs: (_ for _ in ()).throw(RuntimeError('upstream'))
+        with pytest.raises(RuntimeError):
+            session.chat_candidates('d2-d4', n=2)
+        assert [m['role'] for m in session.messages] == ['system']
+
+    def test_flask_append_confirms_the_candidate_prompt(self, proxy_client, registry):
+        with registry.acquire('a') as session:
+            session.client = FakeCandidateClient(['a', 'b'])
+            session.add_initial_system('Regole', force=True)
+        proxy_client.post('/chat', json={'prompt': 'e2-e4', 'session_id': 'a', 'n': 2})
+        r = proxy_client.post('/chat/append', json={'role': 'assistant', 'content': 'b', 'session_id': 'a'})
+        assert r.get_json()['history_size'] == 3
+        with registry.acquire('a') as session:
+            assert [m['content'] for m in session.messages] == ['Regole', 'e2-e4', 'b']
+
+    def test_flask_chat_with_n(self, proxy_client, registry):
+        with registry.acquire('a') as session:
+            session.client = FakeCandidateClient(['a', 'b'])
+            session.add_initial_system('Regole', force=True)
+        r = proxy_client.post('/chat', json={'prompt': 'e2-e4', 'session_id': 'a', 'n': 2})
+        assert r.get_json() == {'candidates': ['a', 'b']}
+        assert proxy_client.post('/chat', json={'prompt': 'e2-e4', 'n': 0}).status_code == 400
+
+    def test_non_integer_n_and_priority_are_rejected(self, proxy_client):
+        for body in ({'n': 'tre'}, {'n': None}, {'priority': 'alta'}, {'priority': [1]}):
+            payload = {'prompt': 'e2-e4', **body}
+            assert proxy_client.post('/chat', json=payload).status_code == 400
+            assert call_asgi('POST', '/chat', payload)[0] == 400
+            if 'priority' in body:
+                assert proxy_client.post('/chat/stream', json=payload).status_code == 400
+                assert call_asgi('POST', '/chat/stream', payload)[0] == 400
+
+    def test_asgi_chat_with_n(self, monkeypatch):
+        client = FakeCandidateClient(['a', 'b'])
+
+        async def create(**kwargs):
+            return FakeCandidateCompletions.create(client.completions, **kwargs)
+
+        client.chat = type('Chat', (), {'completions': type('Completions', (), {'create': staticmethod(create)})()})()
+        monkeypatch.setattr(openai_proxy_asgi, 'session_registry',
+                            SessionRegistry(factory=lambda: ChatSession(None, async_client=client), idle_ttl=None))
+        call_asgi('POST', '/chat/init', {'system_messages': ['Regole']})
+        status, body = call_asgi('POST', '/chat', {'prompt': 'e2-e4', 'n': 2})
+        assert status == 200 and body == {'candidates': ['a', 'b']}
+
+
+class TestGameSessionCandidates:
+
+    def test_complete_candidates_uses_one_call(self, monkeypatch):
+        monkeypatch.setenv('LLM_BACKEND', 'mock')
+        game = GameSession('s1', 'u1', 'tester')
+        game.add_system_message('Regole')
+        calls = game.openai_client.calls
+        answers = game.complete_candidates('Mossa dei Bianchi: e2-e4', n=3)
+        assert len(answers) == 3 and game.openai_client.calls == calls + 1
+        assert len(game.messages) == 1
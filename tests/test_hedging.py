@@ -0,0 +1,105 @@
+"""
+Test Richieste con Hedging
+Verifica la seconda richiesta dopo il ritardo, la vittoria della prima mossa valida e l'annullamento dell'altra
+"""
+import pytest
+import json
+import time
+import threading
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from webapp.services.match_controller import MatchController, HEDGE_LAUNCHED, HEDGE_WINS
+from webapp.services.session_manager import GameSession
+
+
+def delta_reply(move):
+    return json.dumps({'mossa_proposta': move, 'commento_giocatore': 'Ok'})
+
+
+class FakeModels:
+    """
+    hedge_func finto: per ogni modello un ritardo e una risposta; registra le richieste annullate.
+    """
+
+    def __init__(self, replies):
+        self.replies = replies
+        self.cancelled = []
+        self.committed = []
+
+    def complete(self, prompt, temperature, model, cancel_event):
+        delay, answer = self.replies[model]
+        if cancel_event.wait(delay):
+            self.cancelled.append(model)
+            return None
+        return answer
+
+    def commit(self, prompt, answer):
+        self.committed.append(answer)
+
+
+def make_controller(initial_board_json, models, delay=0.05):
+    controller = MatchController(initial_board_json, llm_func=None, protocol='delta',
+                                 hedge_func=models.complete, commit_func=models.commit,
+                                 hedge_models=('lento', 'veloce'), hedge_delay=delay)
+    assert controller.submit_human_move('P', 'e2', 'e4')['success']
+    return controller
+
+
+class TestHedgedRequests:
+
+    def test_fast_primary_does_not_hedge(self, initial_board_json):
+        models = FakeModels({'lento': (0, delta_reply('e7-e5')), 'veloce': (0, delta_reply('d7-d5'))})
+        launched = HEDGE_LAUNCHED.value()
+        result = make_controller(initial_board_json, models, delay=1).request_ai_move()
+        assert result['ai_move'] == 'e7-e5'
+        assert HEDGE_LAUNCHED.value() == launched
+        assert models.committed == [delta_reply('e7-e5')]
+
+    def test_hedge_wins_and_primary_is_cancelled(self, initial_board_json):
+        models = FakeModels({'lento': (2, delta_reply('e7-e5')), 'veloce': (0.01, delta_reply('d7-d5'))})
+        wins = HEDGE_WINS.value(winner='hedge')
+        started = time.monotonic()
+        result = make_controller(initial_board_json, models).request_ai_move()
+        assert time.monotonic() - started < 1
+        assert result['ai_move'] == 'd7-d5'
+        assert models.committed == [delta_reply('d7-d5')]
+        assert HEDGE_WINS.value(winner='hedge') == wins + 1
+        for _ in range(100):
+            if models.cancelled:
+                break
+            time.sleep(0.01)
+        assert models.cancelled == ['lento']
+
+    def test_invalid_first_reply_waits_for_the_other(self, initial_board_json):
+        models = FakeModels({'lento': (0.2, delta_reply('e7-e5')), 'veloce': (0.01, delta_reply('e7-e3'))})
+        result = make_controller(initial_board_json, models).request_ai_move()
+        assert result['ai_move'] == 'e7-e5'
+        assert models.committed == [delta_reply('e7-e5')]
+
+    def test_hedging_requires_commit_func(self, initial_board_json):
+        with pytest.raises(ValueError):
+            MatchController(initial_board_json, llm_func=None, hedge_func=lambda *a: None,
+                            hedge_models=('a', 'b'), hedge_delay=1)
+
+
+class TestGameSessionExchange:
+
+    def test_complete_does_not_touch_history_until_commit(self, monkeypatch):
+        monkeypatch.setenv('LLM_BACKEND', 'mock')
+        game = GameSession('s1', 'u1', 'tester')
+        game.add_system_message('Regole')
+        answer = game.complete('Mossa dei Bianchi: e2-e4', model='gpt-4.1-nano')
+        assert answer and len(game.messages) == 1
+        game.commit_exchange('Mossa dei Bianchi: e2-e4', answer)
+        assert [m['role'] for m in game.messages] == ['system', 'user', 'assistant']
+
+    def test_cancelled_completion_returns_none(self, monkeypatch):
+        monkeypatch.setenv('LLM_BACKEND', 'mock')
+        game = GameSession('s1', 'u1', 'tester')
+        game.add_system_message('Regole')
+        cancel_event = threading.Event()
+        cancel_event.set()
+        assert game.complete('Mossa dei Bianchi: e2-e4', cancel_event=cancel_event) is None
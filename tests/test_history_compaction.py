@@ -0,0 +1,128 @@
+"""
+Test Compattazione della Storia
+Verifica la rimozione delle scacchiere superate dai turni mantenendo l'ultima scacchiera e i feedback
+"""
+import pytest
+import json
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.chat_session import ChatSession, count_message_tokens
+from modules.history_compaction import strip_board_payloads, compact_board_history
+from modules.mock_llm import MockOpenAIClient
+from modules.prompt_codec import encode_board
+from webapp.services.match_controller import MatchController
+from webapp.services.session_manager import GameSession
+
+
+def user_turn(move, board_json):
+    return {'role': 'user', 'content': f'Mossa dei Bianchi: {move}\nStato scacchiera:\n{json.dumps(board_json, indent=2)}'}
+
+
+def assistant_turn(move, board_json):
+    return {'role': 'assistant', 'content': json.dumps({'mossa_proposta': move, **board_json, 'commento_giocatore': 'Ok'})}
+
+
+class TestStripBoardPayloads:
+
+    def test_assistant_reply_keeps_move_and_comments(self, initial_board_json):
+        content = strip_board_payloads(assistant_turn('e7-e5', initial_board_json))
+        assert json.loads(content) == {'mossa_proposta': 'e7-e5', 'commento_giocatore': 'Ok'}
+
+    def test_user_board_becomes_move_reference(self, initial_board_json):
+        content = strip_board_payloads(user_turn('e2-e4', initial_board_json))
+        assert content == 'Mossa dei Bianchi: e2-e4\nStato scacchiera:\n[scacchiera omessa, mossa e2-e4]'
+
+    def test_fen_and_plain_messages(self, initial_board_json):
+        fen_turn = {'role': 'user', 'content': f"Mossa dei Bianchi: e2-e4 {encode_board(initial_board_json, 'fen')}"}
+        assert strip_board_payloads(fen_turn) == 'Mossa dei Bianchi: e2-e4 FEN: [scacchiera omessa, mossa e2-e4]'
+        assert strip_board_payloads({'role': 'user', 'content': '[King under attack] riprova'}) is None
+
+
+class TestCompactBoardHistory:
+
+    def test_keeps_latest_board_system_and_feedback(self, initial_board_json):
+        messages = [
+            {'role': 'system', 'content': f'Posizione iniziale: {json.dumps(initial_board_json)}'},
+            user_turn('e2-e4', initial_board_json),
+            assistant_turn('e7-e5', initial_board_json),
+            {'role': 'user', 'content': '[Black king is under attack] Proponi una mossa valida.'},
+            user_turn('g1-f3', initial_board_json)
+        ]
+        original = [dict(m) for m in messages]
+        latest, compacted = compact_board_history(messages)
+        assert (latest, compacted) == (4, 2)
+        assert messages[0] == original[0]
+        assert messages[3] == original[3]
+        assert messages[4] == original[4]
+        assert 'pedoni' not in messages[1]['content'] + messages[2]['content']
+        assert compact_board_history(messages, latest) == (4, 0)
+
+
+class TestChatSessionCompaction:
+
+    def _play(self, initial_board_json, compact_boards):
+        session = ChatSession(MockOpenAIClient(seed=6), compact_boards=compact_boards)
+        session.add_initial_system('Tu giochi con i Neri.', force=True)
+
+        def llm_func(prompt, temperature=0.7):
+            return session.chat(prompt, model='gpt-4o', temperature=temperature)
+
+        controller = MatchController(initial_board_json, llm_func)
+        for human_move in (('P', 'a2', 'a3'), ('P', 'h2', 'h3'), ('P', 'a3', 'a4'), ('P', 'h3', 'h4')):
+            assert controller.submit_human_move(*human_move)['success']
+            assert controller.request_ai_move()['success']
+        return session
+
+    def test_prompt_size_stays_flat(self, initial_board_json):
+        compacted = self._play(initial_board_json, compact_boards=True)
+        full = self._play(initial_board_json, compact_boards=False)
+        assert compacted.total_tokens == count_message_tokens(compacted.messages, compacted.token_model)
+        assert compacted.total_tokens * 3 < full.total_tokens * 2
+        # solo l'ultima risposta e l'ultimo prompt contengono ancora una scacchiera
+        boards = [i for i, m in enumerate(compacted.messages) if 'pedoni' in m['content']]
+        assert boards == [len(compacted.messages) - 2, len(compacted.messages) - 1]
+
+    def test_eviction_keeps_compaction_index_consistent(self, initial_board_json):
+        session = ChatSession(client=None, max_history=3)
+        session.add_initial_system('Regole', force=True)
+        for move in ('e2-e4', 'd2-d4', 'g1-f3', 'b1-c3'):
+            session.put_message('user', user_turn(move, initial_board_json)['content'])
+            session.compact_history()
+        assert session._compacted_until == len(session.messages) - 2
+        assert ['pedoni' in m['content'] for m in session.messages] == [False, False, False, True]
+
+
+    def test_only_new_turns_are_rescanned_and_logged(self, initial_board_json, monkeypatch, capsys, caplog):
+        session = ChatSession(client=None)
+        session.add_initial_system('Regole', force=True)
+        for move in ('e2-e4', 'd2-d4', 'g1-f3'):
+            session.put_message('user', user_turn(move, initial_board_json)['content'])
+            session.compact_history()
+        scanned = []
+
+        def spy(messages, start=0):
+            scanned.append(len(messages))
+            return compact_board_history(messages, start)
+
+        monkeypatch.setattr('modules.chat_session.compact_board_history', spy)
+        session.put_message('user', user_turn('b1-c3', initial_board_json)['content'])
+        with caplog.at_level('DEBUG', logger='modules.chat_session'):
+            assert session.compact_history() == 1
+        # l'ultima scacchiera già nota e il nuovo turno, non l'intera storia
+        assert scanned == [2]
+        assert ['pedoni' in m['content'] for m in session.messages] == [False, False, False, False, True]
+        assert 'Compattati 1 messaggi' in caplog.text and capsys.readouterr().out == ''
+
+
+class TestGameSessionCompaction:
+
+    def test_send_to_llm_compacts_before_completion(self, initial_board_json, monkeypatch):
+        monkeypatch.setenv('LLM_BACKEND', 'mock')
+        game = GameSession('s1', 'u1', 'tester')
+        game.add_system_message('Regole')
+        game.send_to_llm(user_turn('e2-e4', initial_board_json)['content'])
+        game.send_to_llm(user_turn('d2-d4', initial_board_json)['content'])
+        assert ['pedoni' in m['content'] for m in game.messages] == [False, False, False, True, True]
@@ -0,0 +1,45 @@
+"""
+Test Estrazione JSON
+Verifica che l'oggetto JSON venga estratto dalla risposta dell'LLM in una sola passata,
+tollerando code fence, testo intorno, troncamenti e virgolette non escapate
+"""
+import pytest
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.json_extractor import extract_json_object
+
+
+class TestExtractJsonObject:
+
+    def test_valid_json_with_fences_and_trailing_text(self):
+        reply = 'Ecco la mossa:\n```json\n{"mossa_proposta": "e7-e5"}\n```\nBuona partita!'
+        assert extract_json_object(reply) == {'mossa_proposta': 'e7-e5'}
+
+    def test_truncated_reply_is_closed(self):
+        reply = '{"mossa_proposta": "e7-e5", "neri": {"pedoni": ["e5", "d7'
+        assert extract_json_object(reply) == {'mossa_proposta': 'e7-e5', 'neri': {'pedoni': ['e5', 'd7']}}
+
+    def test_truncated_after_key(self):
+        assert extract_json_object('{"mossa_proposta": "e7-e5", "commento_giocatore"') == {
+            'mossa_proposta': 'e7-e5', 'commento_giocatore': None}
+
+    def test_unescaped_quotes_inside_strings(self):
+        reply = '{"mossa_proposta": "d7-d5", "commento_giocatore": "Rispondo con "d5", al centro", "x": 1}'
+        parsed = extract_json_object(reply)
+        assert parsed['commento_giocatore'] == 'Rispondo con "d5", al centro'
+        assert parsed['x'] == 1
+
+    def test_control_characters_and_trailing_commas(self):
+        reply = '{"commento_giocatore": "riga 1\nriga 2", "pedoni": ["a7", "b7",],}'
+        assert extract_json_object(reply) == {'commento_giocatore': 'riga 1\nriga 2', 'pedoni': ['a7', 'b7']}
+
+    def test_mismatched_closing_bracket(self):
+        reply = '{"neri": {"pedoni": ["a7", "b7"}, "bianchi": {}}'
+        assert extract_json_object(reply) == {'neri': {'pedoni': ['a7', 'b7']}, 'bianchi': {}}
+
+    def test_no_object(self):
+        with pytest.raises(ValueError):
+            extract_json_object('Non posso rispondere in JSON')
@@ -0,0 +1,92 @@
+"""
+Test Parsing Incrementale
+Verifica l'estrazione anticipata di mossa_proposta dallo stream e l'interruzione delle risposte illegali
+"""
+import pytest
+import json
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.json_stream import IncrementalJsonScanner
+from webapp.services.match_controller import MatchController
+
+
+def fragments(text, size=4):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class TestIncrementalJsonScanner:
+
+    def test_value_is_found_as_soon_as_complete(self):
+        scanner = IncrementalJsonScanner()
+        text = '```json\n{"mossa_proposta": "e7-e5", "neri": {"pedoni": ["a7"]}}'
+        for i, chunk in enumerate(fragments(text)):
+            found = scanner.feed(chunk)
+            if found:
+                break
+        assert found == {'mossa_proposta': 'e7-e5'}
+        assert (i + 1) * 4 < len(text)
+
+    def test_nested_and_value_strings_are_ignored(self):
+        scanner = IncrementalJsonScanner()
+        scanner.feed('{"neri": {"mossa_proposta": "a1"}, "commento": "mossa_proposta", ')
+        assert scanner.values == {}
+        scanner.feed('"mossa_proposta" : "Nf6"}')
+        assert scanner.values == {'mossa_proposta': 'Nf6'}
+
+    def test_escaped_characters(self):
+        scanner = IncrementalJsonScanner()
+        scanner.feed('{"commento": "dice \\"ciao\\"", "mossa_proposta": "e7\\u002de5"}')
+        assert scanner.values == {'mossa_proposta': 'e7-e5'}
+
+
+class FakeStream:
+    """
+    Stream di frammenti che registra quanti ne sono stati consumati e se è stato chiuso.
+    """
+
+    def __init__(self, text):
+        self.chunks = fragments(text)
+        self.consumed = 0
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.consumed += 1
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+class TestMatchControllerStreaming:
+
+    def _after_e4(self, initial_board_json):
+        board = json.loads(json.dumps(initial_board_json))
+        board['bianchi']['pedoni'][4] = 'e4'
+        return board
+
+    def test_illegal_move_aborts_stream_early(self, initial_board_json):
+        after_e4 = self._after_e4(initial_board_json)
+        after_e5 = json.loads(json.dumps(after_e4))
+        after_e5['neri']['pedoni'][4] = 'e5'
+        replies = [
+            json.dumps({'mossa_proposta': 'e7-e4', **after_e4}),
+            json.dumps({'mossa_proposta': 'e7-e5', **after_e5})
+        ]
+        streams = []
+
+        def stream_func(prompt, temperature=0.7):
+            streams.append(FakeStream(replies[len(streams)]))
+            return streams[-1]
+
+        controller = MatchController(initial_board_json, llm_func=None, stream_func=stream_func)
+        assert controller.submit_human_move('P', 'e2', 'e4')['success']
+        result = controller.request_ai_move()
+        assert result['success']
+        assert result['ai_move'] == 'e7-e5'
+        assert streams[0].closed
+        assert streams[0].consumed < len(streams[0].chunks)
+        assert streams[1].consumed == len(streams[1].chunks)
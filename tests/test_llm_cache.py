@@ -0,0 +1,84 @@
+"""
+Test Cache LLM
+Verifica la cache delle risposte (livelli memoria e SQLite) e il suo uso opt-in da ChatSession
+"""
+import pytest
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.llm_cache import LLMCache, make_cache_key
+from modules.chat_session import ChatSession
+from tests.test_proxy import FakeOpenAIClient
+
+MESSAGES = [{'role': 'system', 'content': 'Regole'}, {'role': 'user', 'content': 'e2-e4'}]
+
+
+class TestCacheKey:
+
+    def test_same_temperature_bucket_same_key(self):
+        assert make_cache_key('gpt-4o', MESSAGES, 0.71) == make_cache_key('gpt-4o', MESSAGES, 0.74)
+        assert make_cache_key('gpt-4o', MESSAGES, 0.7) != make_cache_key('gpt-4o', MESSAGES, 0.9)
+
+    def test_model_and_messages_change_key(self):
+        key = make_cache_key('gpt-4o', MESSAGES, 0.5)
+        assert key != make_cache_key('gpt-4.1', MESSAGES, 0.5)
+        assert key != make_cache_key('gpt-4o', MESSAGES[:1], 0.5)
+
+
+class TestLLMCache:
+
+    def test_lru_eviction_and_stats(self):
+        cache = LLMCache(max_entries=2)
+        for key in ('a', 'b', 'c'):
+            cache.put(key, key.upper())
+        assert cache.get('a') is None
+        assert cache.get('c') == 'C'
+        stats = cache.stats()
+        assert stats['hits'] == 1 and stats['misses'] == 1
+        assert stats['memory_entries'] == 2
+
+    def test_disk_tier_survives_restart(self, tmp_path):
+        path = str(tmp_path / 'llm_cache.sqlite')
+        cache = LLMCache(path=path)
+        cache.put('k', 'risposta')
+        cache.close()
+        reloaded = LLMCache(path=path)
+        assert reloaded.get('k') == 'risposta'
+        assert reloaded.stats()['disk_hits'] == 1
+
+    def test_disk_size_limit(self, tmp_path):
+        cache = LLMCache(max_entries=1, path=str(tmp_path / 'c.sqlite'), max_disk_entries=2)
+        for key in ('a', 'b', 'c'):
+            cache.put(key, key)
+        assert cache.stats()['disk_entries'] == 2
+
+    def test_expired_entries_are_misses(self):
+        cache = LLMCache(ttl=-1)
+        cache.put('k', 'v')
+        assert cache.get('k') is None
+
+
+class TestChatSessionCache:
+
+    def _session(self, client, cache):
+        session = ChatSession(client, cache=cache)
+        session.add_initial_system('Regole', force=True)
+        return session
+
+    def test_cache_hit_skips_api_call(self):
+        client = FakeOpenAIClient()
+        cache = LLMCache()
+        first = self._session(client, cache)
+        second = self._session(client, cache)
+        assert first.chat('e2-e4', model='gpt-4o', use_cache=True) == second.chat('e2-e4', model='gpt-4o', use_cache=True)
+        assert len(client.completions.calls) == 1
+        assert second.get_last_assistant()['content'] == '{"mossa_proposta": "e7-e5"}'
+
+    def test_cache_is_opt_in(self):
+        client = FakeOpenAIClient()
+        cache = LLMCache()
+        self._session(client, cache).chat('e2-e4', model='gpt-4o', use_cache=True)
+        self._session(client, cache).chat('e2-e4', model='gpt-4o')
+        assert len(client.completions.calls) == 2
@@ -0,0 +1,114 @@
+"""
+Test Metriche
+Verifica il formato Prometheus di contatori e istogrammi e l'endpoint /metrics dei proxy
+"""
+import pytest
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import openai_proxy_asgi
+from modules.chat_session import ChatSession
+from modules.metrics import (
+    MetricsRegistry, Histogram, LLM_LATENCY, LLM_ERRORS, LLM_COMPLETION_TOKENS, track_llm_call, usage_tokens
+)
+from modules.session_registry import SessionRegistry
+from tests.test_proxy import FakeOpenAIClient, FakeAsyncOpenAIClient, call_asgi, proxy_client, registry
+
+
+class TestMetricsFormat:
+
+    def test_counter_and_histogram_render(self):
+        metrics = MetricsRegistry()
+        requests = metrics.counter('richieste_total', 'Richieste', ('model',))
+        requests.inc(model='gpt-4o')
+        requests.inc(2, model='gpt-4o')
+        latency = metrics.histogram('latenza_seconds', 'Latenza', buckets=(0.5, 1))
+        for value in (0.2, 0.7, 3):
+            latency.observe(value)
+        lines = metrics.render().splitlines()
+        assert '# TYPE richieste_total counter' in lines
+        assert 'richieste_total{model="gpt-4o"} 3' in lines
+        assert 'latenza_seconds_bucket{le="0.5"} 1' in lines
+        assert 'latenza_seconds_bucket{le="1"} 2' in lines
+        assert 'latenza_seconds_bucket{le="+Inf"} 3' in lines
+        assert 'latenza_seconds_sum 3.9' in lines
+        assert 'latenza_seconds_count 3' in lines
+
+    def test_collectors_are_rendered_on_demand(self):
+        calls = []
+
+        def collector():
+            calls.append(1)
+            history = Histogram('storia_messaggi', 'Storia', buckets=(4,))
+            history.observe(2)
+            return [history]
+
+        metrics = MetricsRegistry()
+        assert calls == []
+        assert 'storia_messaggi_count 1' in metrics.render([collector])
+        assert calls == [1]
+
+    def test_label_values_are_escaped(self):
+        metrics = MetricsRegistry()
+        metrics.counter('errori_total', 'Errori', ('error',)).inc(error='a"b')
+        assert 'errori_total{error="a\\"b"} 1' in metrics.render()
+
+    def test_track_llm_call_counts_errors(self):
+        count = LLM_LATENCY.count(model='test-errori', stream='false')
+        with pytest.raises(TimeoutError):
+            with track_llm_call('test-errori'):
+                raise TimeoutError()
+        assert LLM_LATENCY.count(model='test-errori', stream='false') == count + 1
+        assert LLM_ERRORS.value(model='test-errori', error='TimeoutError') == 1
+
+
+class TestChatSessionMetrics:
+
+    def test_chat_records_latency_and_tokens(self):
+        session = ChatSession(FakeOpenAIClient())
+        session.add_initial_system('Regole', force=True)
+        count = LLM_LATENCY.count(model='gpt-4o', stream='false')
+        tokens = LLM_COMPLETION_TOKENS.value(model='gpt-4o')
+        session.chat('e2-e4', model='gpt-4o')
+        assert LLM_LATENCY.count(model='gpt-4o', stream='false') == count + 1
+        assert LLM_COMPLETION_TOKENS.value(model='gpt-4o') > tokens
+
+    def test_estimates_are_computed_only_without_usage(self):
+        def never():
+            raise AssertionError('stima calcolata nonostante il campo usage')
+
+        usage = type('Usage', (), {'prompt_tokens': 120, 'completion_tokens': 8})()
+        completion = type('Completion', (), {'usage': usage})()
+        assert usage_tokens(completion, never, never) == (120, 8)
+        assert usage_tokens(None, lambda: 50, 3) == (50, 3)
+
+
+class TestMetricsEndpoints:
+
+    def test_flask_metrics(self, proxy_client, registry):
+        with registry.acquire('a') as session:
+            session.client = FakeOpenAIClient()
+            session.add_initial_system('Regole', force=True)
+        proxy_client.post('/chat', json={'prompt': 'e2-e4', 'session_id': 'a'})
+        r = proxy_client.get('/metrics')
+        assert r.status_code == 200
+        assert r.content_type.startswith('text/plain; version=0.0.4')
+        body = r.get_data(as_text=True)
+        assert 'promptchess_active_sessions 1' in body
+        assert 'promptchess_session_history_messages_count 1' in body
+        assert 'promptchess_cache_lookups_total{result="miss"}' in body
+        assert 'promptchess_rate_limited_total' in body
+        assert 'promptchess_llm_request_seconds_bucket{model="gpt-4.1-nano",stream="false",le="+Inf"}' in body
+
+    def test_asgi_metrics(self, monkeypatch):
+        client = FakeAsyncOpenAIClient()
+        monkeypatch.setattr(openai_proxy_asgi, 'session_registry',
+                            SessionRegistry(factory=lambda: ChatSession(None, async_client=client), idle_ttl=None))
+        call_asgi('POST', '/chat/init', {'system_messages': ['Regole']})
+        call_asgi('POST', '/chat', {'prompt': 'e2-e4'})
+        status, body = call_asgi('GET', '/metrics', raw=True)
+        assert status == 200
+        assert 'promptchess_active_sessions 1' in body
+        assert 'promptchess_llm_prompt_tokens_total{model="gpt-4.1-nano"}' in body
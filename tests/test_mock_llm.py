@@ -0,0 +1,86 @@
+"""
+Test Backend LLM Simulato
+Verifica risposte deterministiche, mosse legali e iniezione di errori del backend mock
+"""
+import pytest
+import asyncio
+import json
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from openai import OpenAIError, RateLimitError
+from modules.chess_core import json_to_board, detect_move, is_legal_move
+from modules.chat_session import ChatSession
+from modules.mock_llm import MockOpenAIClient, MockAsyncOpenAIClient, find_board
+from webapp.services.match_controller import MatchController
+
+
+def board_messages(board_json):
+    return [{'role': 'system', 'content': 'Regole'},
+            {'role': 'user', 'content': f'Stato scacchiera:\n{json.dumps(board_json, indent=2)}'}]
+
+
+class TestMockOpenAIClient:
+
+    def test_engine_reply_is_a_legal_black_move(self, initial_board_json):
+        client = MockOpenAIClient(seed=1)
+        completion = client.chat.completions.create(model='gpt-4o', messages=board_messages(initial_board_json))
+        reply = json.loads(completion.choices[0].message.content)
+        board_prev = json_to_board(initial_board_json)
+        piece, from_sq, to_sq = detect_move(board_prev, json_to_board(reply))
+        assert is_legal_move(piece, from_sq, to_sq, board_prev, 'black')
+        assert reply['mossa_proposta'] == f'{from_sq}-{to_sq}'
+        assert completion.usage.total_tokens > 0
+
+    def test_same_seed_same_replies(self, initial_board_json):
+        def replies(seed):
+            client = MockOpenAIClient(seed=seed)
+            return [client.create(model='gpt-4o', messages=board_messages(initial_board_json)).choices[0].message.content
+                    for _ in range(5)]
+        assert replies(7) == replies(7)
+
+    def test_error_injection(self, initial_board_json):
+        client = MockOpenAIClient(error_rate=1.0, rate_limit_share=1.0)
+        with pytest.raises(RateLimitError):
+            client.create(model='gpt-4o', messages=board_messages(initial_board_json))
+        client = MockOpenAIClient(error_rate=1.0, rate_limit_share=0.0)
+        with pytest.raises(OpenAIError):
+            client.create(model='gpt-4o', messages=board_messages(initial_board_json))
+
+    def test_malformed_output(self, initial_board_json):
+        client = MockOpenAIClient(malformed_rate=1.0)
+        content = client.create(model='gpt-4o', messages=board_messages(initial_board_json)).choices[0].message.content
+        with pytest.raises(json.JSONDecodeError):
+            json.loads(content)
+
+    def test_scripted_replies_and_stream(self):
+        client = MockOpenAIClient(script=['{"a": 1}', '{"b": 2}'])
+        assert client.create(model='gpt-4o', messages=[]).choices[0].message.content == '{"a": 1}'
+        chunks = client.create(model='gpt-4o', messages=[], stream=True)
+        assert ''.join(c.choices[0].delta.content for c in chunks) == '{"b": 2}'
+
+    def test_async_client(self, initial_board_json):
+        client = MockAsyncOpenAIClient(seed=3, latency=0.01)
+        completion = asyncio.run(client.chat.completions.create(model='gpt-4o', messages=board_messages(initial_board_json)))
+        assert 'mossa_proposta' in json.loads(completion.choices[0].message.content)
+
+    def test_find_board_skips_other_json(self, initial_board_json):
+        messages = board_messages(initial_board_json) + [{'role': 'user', 'content': '[{"nota": 1}]'}]
+        assert find_board(messages) == initial_board_json
+
+
+class TestMockMatch:
+
+    def test_match_controller_plays_against_mock(self, initial_board_json):
+        session = ChatSession(MockOpenAIClient(seed=5))
+        session.add_initial_system('Tu giochi con i Neri.', force=True)
+
+        def llm_func(prompt, temperature=0.7):
+            return session.chat(prompt, model='gpt-4o', temperature=temperature)
+
+        controller = MatchController(initial_board_json, llm_func)
+        for human_move in (('P', 'a2', 'a3'), ('P', 'h2', 'h3')):
+            assert controller.submit_human_move(*human_move)['success']
+            assert controller.request_ai_move()['success']
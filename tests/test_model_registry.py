@@ -0,0 +1,84 @@
+"""
+Test Registro dei Modelli
+Verifica la scala dei modelli per costo e il router che sale dopo i fallimenti e riscende dopo i successi
+"""
+import pytest
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.model_registry import MODELS, ModelRouter, model_ladder, request_cost, router_from_config
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestModelRegistry:
+
+    def test_ladder_is_ordered_by_price(self):
+        ladder = model_ladder()
+        prices = [MODELS[m]['input_price'] for m in ladder]
+        assert prices == sorted(prices)
+        assert ladder[0] == 'gpt-4.1-nano'
+
+    def test_unknown_model(self):
+        with pytest.raises(ValueError):
+            model_ladder(['gpt-4.1-nano', 'modello-inesistente'])
+
+    def test_request_cost(self):
+        assert request_cost('gpt-4o', 1_000_000, 100_000) == pytest.approx(3.5)
+
+
+class TestModelRouter:
+
+    def test_failure_escalates_to_pricier_model_only(self):
+        router = ModelRouter(models=['gpt-4o', 'gpt-4.1-nano', 'gpt-4o-mini'])
+        assert router.choose() == 'gpt-4.1-nano'
+        assert router.record('gpt-4.1-nano', False, 1.0) == 'gpt-4o-mini'
+        assert router.record('gpt-4o-mini', False, 1.0) == 'gpt-4o'
+        # in cima alla scala resta sul modello più capace, senza tornare a quello di default
+        assert router.record('gpt-4o', False, 1.0) == 'gpt-4o'
+
+    def test_success_streak_downgrades(self):
+        router = ModelRouter(models=['gpt-4.1-nano', 'gpt-4o-mini'], start_model='gpt-4o-mini', downgrade_after=3)
+        for _ in range(2):
+            assert router.record('gpt-4o-mini', True, 0.5) == 'gpt-4o-mini'
+        assert router.record('gpt-4o-mini', True, 0.5) == 'gpt-4.1-nano'
+
+    def test_unreliable_model_is_skipped_until_cooldown(self):
+        clock = FakeClock()
+        router = ModelRouter(models=['gpt-4.1-nano', 'gpt-4o-mini', 'gpt-4.1-mini'], min_samples=2,
+                             downgrade_after=1, cooldown=60, clock=clock)
+        router.record('gpt-4.1-nano', False)
+        router.record('gpt-4o-mini', True)
+        router.record('gpt-4.1-nano', False)
+        assert router.choose() == 'gpt-4o-mini'
+        # gpt-4.1-nano ha 0 successi su 2: non si riscende finché non passa il cooldown
+        assert router.record('gpt-4o-mini', True) == 'gpt-4o-mini'
+        clock.now = 61
+        assert router.record('gpt-4o-mini', True) == 'gpt-4.1-nano'
+
+    def test_slow_model_is_skipped_on_escalation(self):
+        router = ModelRouter(models=['gpt-4.1-nano', 'gpt-4o-mini', 'gpt-4.1-mini'], start_model='gpt-4o-mini',
+                             min_samples=2, max_p95_latency=5.0, downgrade_after=1)
+        router.record('gpt-4o-mini', True, 9.0)
+        router.record('gpt-4.1-nano', True, 1.0)
+        router.record('gpt-4.1-nano', True, 1.0)
+        router.record('gpt-4o-mini', True, 9.0)
+        assert router.record('gpt-4.1-nano', False, 1.0) == 'gpt-4.1-mini'
+
+    def test_stats_and_config(self):
+        router = router_from_config({'MODEL_ROUTER': {'models': ['gpt-4.1-nano', 'gpt-4o'], 'window': 2}})
+        router.record('gpt-4.1-nano', True, 1.0, prompt_tokens=1000, completion_tokens=100)
+        router.record('gpt-4.1-nano', True, 3.0)
+        router.record('gpt-4.1-nano', False, 2.0)
+        stats = router.stats()['models']['gpt-4.1-nano']
+        assert stats == {'samples': 2, 'success_rate': 0.5, 'p95_latency': 3.0, 'avg_cost': 0.0}
+        assert router.choose() == 'gpt-4o'
@@ -0,0 +1,92 @@
+"""
+Test Parser Mosse
+Verifica la risoluzione delle mosse proposte dall'LLM in notazioni diverse
+"""
+import pytest
+import json
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.chess_core import json_to_board, legal_moves
+from modules.move_parser import parse_move_string, resolve_move
+from webapp.services.match_controller import MatchController
+
+
+class TestLegalMoves:
+
+    def test_initial_position_has_twenty_moves(self, initial_board):
+        assert len(legal_moves(initial_board, 'white')) == 20
+        assert len(legal_moves(initial_board, 'black')) == 20
+
+    def test_own_pieces_are_not_captured(self, initial_board):
+        for piece, from_sq, to_sq in legal_moves(initial_board, 'black'):
+            assert initial_board.at[to_sq[0], int(to_sq[1])] == ''
+
+
+class TestParseMoveString:
+
+    def test_castling(self):
+        assert parse_move_string('O-O')['castling'] == 'short'
+        assert parse_move_string('0-0-0')['castling'] == 'long'
+
+    def test_promotion(self):
+        spec = parse_move_string('e7e8=Q')
+        assert spec['to_sq'] == 'e8'
+        assert spec['promotion'] == 'Q'
+
+    def test_unrecognized_notation(self):
+        with pytest.raises(ValueError):
+            parse_move_string('muovo il cavallo')
+
+
+class TestResolveMove:
+
+    @pytest.mark.parametrize('move', ['e7-e5', 'e7xe5', ' E7 - E5 ', 'e7e5', 'e5', 'Pe7-e5', 'e7 -> e5'])
+    def test_pawn_notations(self, initial_board, move):
+        assert resolve_move(move, initial_board, 'black') == ('p', 'e7', 'e5')
+
+    @pytest.mark.parametrize('move', ['Nf6', 'Ng8-f6', 'g8f6', 'Nf6+', 'Ngf6'])
+    def test_knight_notations(self, initial_board, move):
+        assert resolve_move(move, initial_board, 'black') == ('n', 'g8', 'f6')
+
+    @pytest.mark.parametrize('move', ['P e2 e4', 'e2 - e4', 'p E2 E4'])
+    def test_human_input_formats(self, initial_board, move):
+        assert resolve_move(move, initial_board, 'white') == ('P', 'e2', 'e4')
+
+    @pytest.mark.parametrize('move', ['O-O', '0-0-0', 'e7e8=Q'])
+    def test_castling_and_promotion_are_rejected(self, initial_board, move):
+        with pytest.raises(ValueError, match='not supported'):
+            resolve_move(move, initial_board, 'black')
+
+    def test_illegal_move_raises(self, initial_board):
+        with pytest.raises(ValueError):
+            resolve_move('e7-e4', initial_board, 'black')
+
+    def test_ambiguous_move_raises(self):
+        rooks = {
+            'neri': {'pedoni': [], 'alfieri': [], 'cavalli': [], 'torri': ['a5', 'h5'], 'regina': [], 're': ['e8']},
+            'bianchi': {'pedoni': [], 'alfieri': [], 'cavalli': [], 'torri': [], 'regina': [], 're': ['e1']}
+        }
+        board = json_to_board(rooks)
+        with pytest.raises(ValueError):
+            resolve_move('Rd5', board, 'black')
+        assert resolve_move('Rad5', board, 'black') == ('r', 'a5', 'd5')
+
+
+class TestMatchControllerNearMiss:
+
+    def test_unchanged_board_with_san_move_is_accepted(self, initial_board_json):
+        after_e4 = json.loads(json.dumps(initial_board_json))
+        after_e4['bianchi']['pedoni'][4] = 'e4'
+
+        # l'LLM propone la mossa in SAN ma non aggiorna la scacchiera
+        def llm_func(prompt, temperature=0.7):
+            return json.dumps({**after_e4, 'mossa_proposta': 'Nf6'})
+
+        controller = MatchController(initial_board_json, llm_func)
+        assert controller.submit_human_move('P', 'e2', 'e4')['success']
+        result = controller.request_ai_move()
+        assert result['success']
+        assert result['ai_move'] == 'g8-f6'
@@ -0,0 +1,102 @@
+"""
+Test Protocollo a Delta
+Verifica ricostruzione locale della scacchiera dalle mosse, checkpoint periodici e crescita ridotta della storia
+"""
+import pytest
+import json
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.chess_core import json_to_board, board_to_json, apply_move, replay_moves, boards_equal
+from modules.chat_session import ChatSession
+from modules.mock_llm import MockOpenAIClient, find_board
+from modules.move_protocol import reconstruct_board, delta_turn_prompt, DELTA_RULES, DELTA_OUTPUT
+from webapp.services.match_controller import MatchController
+
+
+HUMAN_MOVES = [('P', 'a2', 'a3'), ('P', 'h2', 'h3'), ('P', 'a3', 'a4'), ('P', 'h3', 'h4'), ('N', 'b1', 'c3')]
+
+
+class TestReplayMoves:
+
+    def test_replay_matches_apply_move(self, initial_board):
+        expected = apply_move('p', 'e7', 'e5', apply_move('P', 'e2', 'e4', initial_board))
+        assert boards_equal(replay_moves(initial_board, ['e2-e4', 'e7-e5']), expected)
+
+    def test_wrong_color_and_illegal_moves_are_rejected(self, initial_board):
+        with pytest.raises(ValueError, match='Move 1'):
+            replay_moves(initial_board, ['e7-e5'])
+        with pytest.raises(ValueError, match='Move 2'):
+            replay_moves(initial_board, ['e2-e4', 'e7-e4'])
+        with pytest.raises(ValueError, match='format'):
+            replay_moves(initial_board, ['e4'])
+
+    def test_reconstruct_from_conversation(self, initial_board):
+        messages = [
+            {'role': 'user', 'content': delta_turn_prompt('e2-e4')},
+            {'role': 'assistant', 'content': '{"mossa_proposta": "e7-e5", "commento_giocatore": "e2-e4 classica"}'},
+            {'role': 'user', 'content': delta_turn_prompt('g1-f3')}
+        ]
+        expected = replay_moves(initial_board, ['e2-e4', 'e7-e5', 'g1-f3'])
+        assert boards_equal(reconstruct_board(initial_board, messages), expected)
+
+    def test_reconstruct_resolves_san_replies(self, initial_board):
+        messages = [
+            {'role': 'user', 'content': delta_turn_prompt('e2-e4')},
+            {'role': 'assistant', 'content': '{"mossa_proposta": "Nf6"}'},
+            {'role': 'user', 'content': delta_turn_prompt('g1-f3')},
+            {'role': 'assistant', 'content': '{"mossa_proposta": "O-O"}'}
+        ]
+        expected = replay_moves(initial_board, ['e2-e4', 'g8-f6', 'g1-f3'])
+        assert boards_equal(reconstruct_board(initial_board, messages[:3]), expected)
+        # l'arrocco non è supportato dal motore: errore esplicito invece di saltare la mossa
+        with pytest.raises(ValueError, match='O-O'):
+            reconstruct_board(initial_board, messages)
+
+    def test_mock_backend_follows_delta_turns(self, initial_board, initial_board_json):
+        messages = [
+            {'role': 'system', 'content': f'Stato scacchiera iniziale: {json.dumps(initial_board_json)}'},
+            {'role': 'user', 'content': delta_turn_prompt('e2-e4')}
+        ]
+        assert find_board(messages) == board_to_json(replay_moves(initial_board, ['e2-e4']))
+
+
+def play(protocol, initial_board_json, checkpoint_every=10):
+    session = ChatSession(MockOpenAIClient(seed=4))
+    if protocol == 'delta':
+        session.add_initial_system(f'{DELTA_RULES}\nStato scacchiera iniziale: {json.dumps(initial_board_json)}\n{DELTA_OUTPUT}',
+                                   force=True)
+    else:
+        session.add_initial_system('Tu giochi con i Neri.', force=True)
+    prompts = []
+
+    def llm_func(prompt, temperature=0.7):
+        prompts.append(prompt)
+        return session.chat(prompt, model='gpt-4o', temperature=temperature)
+
+    controller = MatchController(initial_board_json, llm_func, protocol=protocol, checkpoint_every=checkpoint_every)
+    for human_move in HUMAN_MOVES:
+        assert controller.submit_human_move(*human_move)['success']
+        assert controller.request_ai_move()['success']
+    return controller, session, prompts
+
+
+class TestDeltaProtocol:
+
+    def test_turns_carry_only_moves_with_periodic_checkpoints(self, initial_board_json):
+        controller, session, prompts = play('delta', initial_board_json, checkpoint_every=2)
+        assert len(prompts) == len(HUMAN_MOVES)
+        assert ['Checkpoint' in p for p in prompts] == [False, True, False, True, False]
+        assert all('pedoni' not in p for p in prompts[::2])
+
+    def test_local_board_matches_reconstruction(self, initial_board_json):
+        controller, session, prompts = play('delta', initial_board_json, checkpoint_every=0)
+        reconstructed = reconstruct_board(json_to_board(initial_board_json), session.messages)
+        assert boards_equal(reconstructed, controller.board_prev)
+
+    def test_user_turns_are_much_smaller_than_full_protocol(self, initial_board_json):
+        _, _, delta_prompts = play('delta', initial_board_json, checkpoint_every=0)
+        _, _, full_prompts = play('full', initial_board_json)
+        assert sum(map(len, delta_prompts)) * 3 < sum(map(len, full_prompts))
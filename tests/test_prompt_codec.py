@@ -0,0 +1,83 @@
+"""
+Test Codifica Compatta dei Prompt
+Verifica conversione FEN, codifica della scacchiera nei prompt e confronto dei token
+"""
+import pytest
+import json
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.chess_core import json_to_board, board_to_json, board_to_fen, fen_to_board, boards_equal
+from modules.chat_session import ChatSession
+from modules.mock_llm import MockOpenAIClient, find_board
+from modules.prompt_codec import encode_board, compare_encodings, encoding_from_env, INITIAL_FEN
+from webapp.services.match_controller import MatchController
+
+
+class TestFen:
+
+    def test_initial_position(self, initial_board):
+        assert board_to_fen(initial_board, 'w') == INITIAL_FEN
+
+    def test_round_trip(self, check_scenario_json):
+        board = json_to_board(check_scenario_json)
+        assert boards_equal(fen_to_board(board_to_fen(board)), board)
+
+    def test_invalid_fen(self):
+        with pytest.raises(ValueError):
+            fen_to_board('rnbqkbnr/pppppppp/8/8')
+        with pytest.raises(ValueError):
+            fen_to_board('rnbqkbnr/ppppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR b - - 0 1')
+        with pytest.raises(ValueError):
+            fen_to_board('rnbqkbnr/pppppppx/8/8/8/8/PPPPPPPP/RNBQKBNR b - - 0 1')
+
+
+class TestPromptEncoding:
+
+    def test_json_encoding_of_a_dict_matches_json_dumps(self, initial_board_json):
+        assert encode_board(initial_board_json, 'json', indent=4) == json.dumps(initial_board_json, indent=4)
+
+    def test_json_string_input_is_parsed_and_reserialized(self, initial_board_json):
+        # la stringa non passa invariata (né viene racchiusa tra virgolette come farebbe json.dumps):
+        # viene letta e riscritta con l'indentazione richiesta
+        compact = json.dumps(initial_board_json, separators=(',', ':'))
+        assert encode_board(compact) == json.dumps(initial_board_json)
+        assert encode_board(compact, indent=4) == json.dumps(initial_board_json, indent=4)
+        assert encode_board(compact, 'fen') == encode_board(initial_board_json, 'fen')
+
+    def test_fen_encoding(self, initial_board_json):
+        assert encode_board(initial_board_json, 'fen') == 'FEN: rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR b - - 0 1'
+
+    def test_unknown_encoding(self, initial_board_json, monkeypatch):
+        with pytest.raises(ValueError):
+            encode_board(initial_board_json, 'ascii')
+        monkeypatch.setenv('PROMPT_ENCODING', 'FEN')
+        assert encoding_from_env() == 'fen'
+
+    def test_fen_uses_fewer_tokens(self, initial_board_json):
+        counts = compare_encodings(initial_board_json, 'gpt-4o')
+        assert counts['fen'] < counts['json_compact'] < counts['json_indent4']
+
+    def test_mock_backend_reads_fen(self, initial_board_json):
+        messages = [{'role': 'user', 'content': f"Stato: {encode_board(initial_board_json, 'fen')}"}]
+        assert find_board(messages) == board_to_json(json_to_board(initial_board_json))
+
+
+class TestMatchControllerFen:
+
+    def test_prompt_carries_fen_and_reply_is_parsed_as_json(self, initial_board_json):
+        session = ChatSession(MockOpenAIClient(seed=2))
+        session.add_initial_system('Tu giochi con i Neri.', force=True)
+        prompts = []
+
+        def llm_func(prompt, temperature=0.7):
+            prompts.append(prompt)
+            return session.chat(prompt, model='gpt-4o', temperature=temperature)
+
+        controller = MatchController(initial_board_json, llm_func, prompt_encoding='fen')
+        assert controller.submit_human_move('P', 'e2', 'e4')['success']
+        assert controller.request_ai_move()['success']
+        assert 'FEN: rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b - - 0 1' in prompts[0]
+        assert '"neri"' not in prompts[0]
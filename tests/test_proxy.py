@@ -0,0 +1,460 @@
+"""
+Test Proxy OpenAI
+Verifica ChatSession, il registro delle sessioni e gli endpoint del proxy senza chiamate reali all'API
+"""
+import pytest
+import asyncio
+import json
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import openai_proxy_service
+import openai_proxy_asgi
+import threading
+from werkzeug.serving import make_server
+from modules.proxy_client import ProxyClient, InProcessProxyClient, ProxyError, make_proxy_client, collect_stream
+from modules.sse import iter_sse
+from openai_proxy_service import ChatSession
+from modules.session_registry import SessionRegistry
+from modules.model_registry import context_tokens, max_output_tokens
+import modules.chat_session as chat_session_module
+
+
+class FakeCompletions:
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.calls = []
+
+    def create(self, **kwargs):
+        self.calls.append(kwargs)
+        if kwargs.get('stream'):
+            return iter(self.chunks())
+        message = type('Message', (), {'content': self.answer})()
+        choice = type('Choice', (), {'message': message})()
+        return type('Completion', (), {'choices': [choice], 'usage': None})()
+
+    def chunks(self, size=5):
+        # frammenti come quelli restituiti da OpenAI con stream=True
+        result = []
+        for i in range(0, len(self.answer), size):
+            delta = type('Delta', (), {'content': self.answer[i:i + size]})()
+            choice = type('Choice', (), {'delta': delta})()
+            result.append(type('Chunk', (), {'choices': [choice]})())
+        return result
+
+
+class FakeAsyncCompletions(FakeCompletions):
+
+    def __init__(self, answer, delay=0):
+        super().__init__(answer)
+        self.delay = delay
+
+    async def create(self, **kwargs):
+        await asyncio.sleep(self.delay)
+        result = FakeCompletions.create(self, **kwargs)
+        if kwargs.get('stream'):
+            return self.async_chunks(list(result))
+        return result
+
+    async def async_chunks(self, chunks):
+        for chunk in chunks:
+            await asyncio.sleep(0)
+            yield chunk
+
+
+class FakeOpenAIClient:
+
+    def __init__(self, answer='{"mossa_proposta": "e7-e5"}'):
+        self.completions = FakeCompletions(answer)
+        self.chat = type('Chat', (), {'completions': self.completions})()
+
+
+class FakeAsyncOpenAIClient:
+
+    def __init__(self, answer='{"mossa_proposta": "e7-e5"}', delay=0):
+        self.completions = FakeAsyncCompletions(answer, delay)
+        self.chat = type('Chat', (), {'completions': self.completions})()
+
+
+def call_asgi(method, path, body=None, headers=None, raw=False):
+    """
+    Esegue una richiesta HTTP sull'app ASGI e restituisce (status, json),
+    oppure (status, corpo testuale) se raw è True.
+    """
+    scope = {
+        'type': 'http', 'method': method, 'path': path, 'query_string': b'',
+        'headers': [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]
+    }
+    messages = [{'type': 'http.request', 'body': json.dumps(body).encode() if body else b''}]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.Event().wait()
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(openai_proxy_asgi.app(scope, receive, send))
+    body = b''.join(m.get('body', b'') for m in sent[1:])
+    if raw:
+        return sent[0]['status'], body.decode('utf-8')
+    return sent[0]['status'], json.loads(body)
+
+
+@pytest.fixture
+def registry():
+    return SessionRegistry(factory=lambda: ChatSession(None), max_sessions=2, idle_ttl=None)
+
+
+@pytest.fixture
+def proxy_client(monkeypatch, registry):
+    monkeypatch.setattr(openai_proxy_service, 'session_registry', registry)
+    return openai_proxy_service.app.test_client()
+
+
+@pytest.fixture
+def live_proxy(monkeypatch, registry):
+    """
+    Avvia il proxy Flask su una porta libera e restituisce il suo base URL.
+    """
+    monkeypatch.setattr(openai_proxy_service, 'session_registry', registry)
+    server = make_server('127.0.0.1', 0, openai_proxy_service.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+
+
+class TestSessionRegistry:
+
+    def test_sessions_are_isolated(self, registry):
+        with registry.acquire('game-1') as session:
+            session.put_message('user', 'e2-e4')
+        with registry.acquire('game-2') as session:
+            assert session.messages == []
+
+    def test_lru_eviction(self, registry):
+        for sid in ('a', 'b', 'c'):
+            with registry.acquire(sid) as session:
+                session.put_message('user', sid)
+        assert len(registry) == 2
+        assert 'a' not in registry
+
+    def test_spill_to_disk_and_reload(self, tmp_path):
+        registry = SessionRegistry(factory=lambda: ChatSession(None), max_sessions=1,
+                                   idle_ttl=None, spill_dir=str(tmp_path))
+        with registry.acquire('game-1') as session:
+            session.put_message('user', 'e2-e4')
+        with registry.acquire('game-2'):
+            pass
+        assert 'game-1' not in registry
+        with registry.acquire('game-1') as session:
+            assert session.messages[-1]['content'] == 'e2-e4'
+
+    def test_spill_happens_outside_the_registry_lock(self, tmp_path):
+        registry = SessionRegistry(factory=lambda: ChatSession(None), max_sessions=1,
+                                   idle_ttl=None, spill_dir=str(tmp_path))
+        writing = threading.Event()
+        resume = threading.Event()
+        evict = registry._evict
+
+        def slow_evict(session_id, entry):
+            if session_id == 'game-1':
+                writing.set()
+                assert resume.wait(5)
+            evict(session_id, entry)
+
+        registry._evict = slow_evict
+        with registry.acquire('game-1') as session:
+            session.put_message('user', 'e2-e4')
+
+        def use(session_id, seen):
+            with registry.acquire(session_id) as session:
+                seen.append([m['content'] for m in session.messages])
+
+        saver = threading.Thread(target=use, args=('game-2', []))
+        saver.start()
+        assert writing.wait(5)
+        # game-1 è in scrittura su disco: le altre sessioni non attendono
+        use('game-3', [])
+        reloaded = []
+        reloader = threading.Thread(target=use, args=('game-1', reloaded))
+        reloader.start()
+        reloader.join(0.05)
+        assert reloaded == []
+        resume.set()
+        saver.join(5)
+        reloader.join(5)
+        assert reloaded == [['e2-e4']]
+
+
+class TestProxyEndpoints:
+
+    def test_append_is_scoped_by_session_id(self, proxy_client):
+        proxy_client.post('/chat/append', json={'role': 'user', 'content': 'uno', 'session_id': 'a'})
+        r = proxy_client.get('/chat/history', headers={'X-Session-Id': 'b'})
+        assert r.get_json() == []
+        r = proxy_client.get('/chat/history?session_id=a')
+        assert r.get_json()[0]['content'] == 'uno'
+
+
+@pytest.fixture(params=['http', 'inprocess'])
+def make_client(request, registry):
+    """
+    Restituisce una factory di client per session id, per entrambi i trasporti.
+    """
+    if request.param == 'http':
+        base_url = request.getfixturevalue('live_proxy')
+        return lambda sid: ProxyClient(base_url, session_id=sid)
+    return lambda sid: InProcessProxyClient(session_id=sid, registry=registry)
+
+
+class TestProxyClient:
+
+    def test_calls_are_scoped_by_session_id(self, make_client):
+        game = make_client('game-1')
+        game.append('user', 'e2-e4')
+        game.append('assistant', '{"mossa_proposta": "e7-e5"}')
+        assert game.last_user()['content'] == 'e2-e4'
+        assert game.pop_assistant()['role'] == 'assistant'
+        assert make_client('game-2').history() == []
+
+    def test_append_confirms_the_candidates_prompt(self, make_client, registry):
+        with registry.acquire('game-1') as session:
+            session.client = FakeOpenAIClient()
+            session.add_initial_system('Regole', force=True)
+            session.chat_candidates('e2-e4', n=2)
+        game = make_client('game-1')
+        game.append('assistant', '{"mossa_proposta": "e7-e5"}')
+        assert [m['role'] for m in game.history()] == ['system', 'user', 'assistant']
+        assert game.last_user()['content'] == 'e2-e4'
+
+    def test_error_status_raises_proxy_error(self, make_client):
+        with pytest.raises(ProxyError) as exc:
+            make_client('vuota').last_assistant()
+        assert exc.value.status_code == 400
+
+    def test_chat_goes_through_session(self, make_client, registry):
+        with registry.acquire('game-1') as session:
+            session.client = FakeOpenAIClient()
+        game = make_client('game-1')
+        game.init(['Regole'])
+        assert game.chat('e2-e4', model='gpt-4o') == '{"mossa_proposta": "e7-e5"}'
+        assert [m['role'] for m in game.history()] == ['system', 'user', 'assistant']
+
+    def test_chat_stream_yields_fragments_and_commits(self, make_client, registry):
+        with registry.acquire('game-1') as session:
+            session.client = FakeOpenAIClient()
+        game = make_client('game-1')
+        game.init(['Regole'])
+        fragments = list(game.chat_stream('e2-e4', model='gpt-4o'))
+        assert len(fragments) > 1
+        assert ''.join(fragments) == '{"mossa_proposta": "e7-e5"}'
+        assert game.last_assistant()['content'] == ''.join(fragments)
+
+    def test_chat_reports_token_usage(self, make_client, registry):
+        with registry.acquire('game-1') as session:
+            session.client = FakeOpenAIClient()
+        game = make_client('game-1')
+        game.init(['Regole'])
+        game.chat('e2-e4', model='gpt-4o')
+        assert game.last_usage['model'] == 'gpt-4o'
+        assert game.last_usage['prompt_tokens'] > 0 and game.last_usage['completion_tokens'] > 0
+        collect_stream(game.chat_stream('d2-d4', model='gpt-4.1-nano'))
+        assert game.last_usage['model'] == 'gpt-4.1-nano'
+
+    def test_chat_stream_error_raises_proxy_error(self, make_client):
+        # nessun messaggio di sistema: la sessione rifiuta la richiesta
+        with pytest.raises(ProxyError):
+            collect_stream(make_client('vuota').chat_stream('e2-e4'))
+
+    def test_unreachable_proxy_raises_proxy_error(self):
+        client = ProxyClient('http://127.0.0.1:9', retries=0, timeout=1)
+        with pytest.raises(ProxyError) as exc:
+            client.history()
+        assert exc.value.status_code == 0
+
+    def test_transport_is_selected_by_config(self, registry):
+        assert isinstance(make_proxy_client({'PROXY_TRANSPORT': 'inprocess'}, registry=registry), InProcessProxyClient)
+        assert isinstance(make_proxy_client({'PROXY_TRANSPORT': 'http'}), ProxyClient)
+        with pytest.raises(ValueError):
+            make_proxy_client({'PROXY_TRANSPORT': 'carrier-pigeon'})
+
+
+class TestIncrementalTokenCount:
+
+    def test_running_total_matches_full_count(self):
+        session = ChatSession(None)
+        session.add_initial_system('Regole: giochi con i Neri.', force=True)
+        session.put_message('user', 'e2-e4')
+        session.put_message('assistant', '{"mossa_proposta": "e7-e5"}')
+        session.prepend_message('user', 'benvenuto')
+        session.pop_last_assistant()
+        expected = openai_proxy_service.count_message_tokens(session.messages, session.token_model)
+        assert session.total_tokens == expected
+
+    def test_length_and_size_are_kept_in_constant_time(self):
+        session = ChatSession(None)
+        session.add_initial_system('Regole: giochi con i Neri.', force=True)
+        session.put_message('user', 'e2-e4')
+        session.put_message('assistant', '{"mossa_proposta": "e7-e5"}')
+        session.prepend_message('user', 'benvenuto')
+        session.pop_last_assistant()
+        session.messages = session.messages + [{'role': 'system', 'content': 'Sintesi della conversazione precedente:\nok'}]
+        assert len(session) == len(session.messages)
+        assert session.size_bytes == sum(chat_session_module.message_size(m) for m in session.messages)
+
+    def test_total_resets_on_clear_and_assignment(self):
+        session = ChatSession(None)
+        session.put_message('user', 'e2-e4')
+        session.clear_messages()
+        assert session.total_tokens == 0
+        session.messages = [{'role': 'system', 'content': 'sintesi'}]
+        assert session.total_tokens == openai_proxy_service.count_tokens('sintesi', session.token_model)
+
+    def test_available_tokens_uses_running_total(self):
+        session = ChatSession(None)
+        # storia vicina al contesto di gpt-4o: i token liberi restano sotto il limite della risposta
+        session.put_message('user', 'x' * 4 * 120000)
+        context = context_tokens('gpt-4o')
+        assert session.available_tokens('gpt-4o', margin=0) == context - session.total_tokens
+
+    def test_max_tokens_never_exceeds_the_model_output_limit(self):
+        client = FakeOpenAIClient()
+        session = ChatSession(client)
+        session.add_initial_system('Regole', force=True)
+        session.chat('e2-e4')
+        session.chat('d2-d4', model='gpt-4o')
+        assert [c['max_tokens'] for c in client.completions.calls] == [
+            max_output_tokens('gpt-4.1-nano'), max_output_tokens('gpt-4o')]
+        assert session.available_tokens('modello-sconosciuto') <= context_tokens('modello-sconosciuto')
+
+    def test_history_budget_is_capped_below_large_context_windows(self):
+        session = ChatSession(None)
+        assert session.history_budget('gpt-4.1-nano', margin=0) == (
+            session.max_context_tokens - session.min_response_tokens)
+        assert session.history_budget('gpt-4.1-nano') < context_tokens('gpt-4.1-nano') // 10
+
+
+class TestTokenBudgetTrimming:
+
+    def test_oldest_turns_are_evicted_first(self):
+        session = ChatSession(None, min_response_tokens=0)
+        session.add_initial_system('Regole', force=True)
+        budget = session.history_budget('gpt-4o', margin=0)
+        big = 'x' * (budget * 4 // 3)
+        session.put_message('user', big)
+        session.put_message('assistant', big)
+        session.put_message('user', 'ultima mossa')
+        session.trim_to_budget('gpt-4o', margin=0)
+        assert session.messages[0]['content'] == 'Regole'
+        assert session.messages[-1]['content'] == 'ultima mossa'
+        assert session.total_tokens <= budget
+
+    def test_request_model_sets_the_token_count(self, monkeypatch):
+        class FakeEncoding:
+
+            def __init__(self, name, chars_per_token):
+                self.name = name
+                self.chars_per_token = chars_per_token
+
+            def encode(self, text):
+                return [0] * (len(text) // self.chars_per_token)
+
+        encodings = {'gpt-4o': FakeEncoding('o200k_base', 4), 'gpt-4': FakeEncoding('cl100k_base', 2)}
+        monkeypatch.setattr(chat_session_module, 'get_encoding', lambda model: encodings.get(model))
+        session = ChatSession(None, token_model='gpt-4o')
+        session.add_initial_system('Regole' * 10, force=True)
+        session.put_message('user', 'e2-e4' * 20)
+        request = session.prepare_chat('d2-d4', model='gpt-4')
+        assert session.token_model == 'gpt-4'
+        assert session.total_tokens == chat_session_module.count_message_tokens(request['messages'], 'gpt-4')
+
+    def test_max_history_bounds_turns(self):
+        session = ChatSession(None, max_history=3)
+        for i in range(5):
+            session.put_message('user', f'mossa {i}')
+        assert [m['content'] for m in session.messages] == ['mossa 2', 'mossa 3', 'mossa 4']
+
+    def test_long_conversation_never_exceeds_context(self):
+        client = FakeOpenAIClient()
+        session = ChatSession(client)
+        session.add_initial_system('Regole', force=True)
+        board = 'x' * 4000
+        for i in range(40):
+            session.chat(f'{i} {board}', model='gpt-4o')
+        max_tokens = client.completions.calls[-1]['max_tokens']
+        assert max_tokens >= session.min_response_tokens
+
+
+class TestAsgiProxy:
+
+    @pytest.fixture
+    def async_registry(self, monkeypatch):
+        client = FakeAsyncOpenAIClient(delay=0.2)
+        registry = SessionRegistry(factory=lambda: ChatSession(None, async_client=client), idle_ttl=None)
+        monkeypatch.setattr(openai_proxy_asgi, 'session_registry', registry)
+        return registry
+
+    def test_chat_is_scoped_by_session_id(self, async_registry):
+        call_asgi('POST', '/chat/init', {'system_messages': ['Regole'], 'session_id': 'a'})
+        status, data = call_asgi('POST', '/chat', {'prompt': 'e2-e4', 'session_id': 'a'})
+        assert status == 200
+        assert data['response'] == '{"mossa_proposta": "e7-e5"}'
+        assert call_asgi('GET', '/chat/history', headers={'X-Session-Id': 'b'})[1] == []
+        assert len(call_asgi('GET', '/chat/history', headers={'X-Session-Id': 'a'})[1]) == 3
+
+    def test_timeout_returns_504(self, async_registry):
+        call_asgi('POST', '/chat/init', {'system_messages': ['Regole']})
+        status, _ = call_asgi('POST', '/chat', {'prompt': 'e2-e4', 'timeout': 0.01})
+        assert status == 504
+
+
+class TestChatStream:
+
+    def _session(self):
+        session = ChatSession(FakeOpenAIClient())
+        session.add_initial_system('Regole', force=True)
+        return session
+
+    def test_stream_commits_full_answer(self):
+        session = self._session()
+        answer = ''.join(session.chat_stream('e2-e4', model='gpt-4o'))
+        assert answer == '{"mossa_proposta": "e7-e5"}'
+        assert session.get_last_assistant()['content'] == answer
+
+    def test_closed_stream_does_not_commit(self):
+        session = self._session()
+        stream = session.chat_stream('e2-e4', model='gpt-4o')
+        next(stream)
+        stream.close()
+        assert session.get_last_assistant() is None
+
+    def test_flask_endpoint_emits_sse(self, proxy_client, registry):
+        with registry.acquire('a') as session:
+            session.client = FakeOpenAIClient()
+            session.add_initial_system('Regole', force=True)
+        r = proxy_client.post('/chat/stream', json={'prompt': 'e2-e4', 'session_id': 'a'})
+        assert r.mimetype == 'text/event-stream'
+        events = list(iter_sse(r.get_data(as_text=True).splitlines()))
+        assert events[-1][0] == 'done'
+        assert events[-1][1]['response'] == '{"mossa_proposta": "e7-e5"}'
+        assert events[-1][1]['usage']['model'] == 'gpt-4.1-nano'
+        assert ''.join(data['delta'] for event, data in events[:-1]) == events[-1][1]['response']
+
+    def test_asgi_endpoint_emits_sse(self, monkeypatch):
+        client = FakeAsyncOpenAIClient()
+        registry = SessionRegistry(factory=lambda: ChatSession(None, async_client=client), idle_ttl=None)
+        monkeypatch.setattr(openai_proxy_asgi, 'session_registry', registry)
+        call_asgi('POST', '/chat/init', {'system_messages': ['Regole']})
+        status, body = call_asgi('POST', '/chat/stream', {'prompt': 'e2-e4'}, raw=True)
+        assert status == 200
+        events = list(iter_sse(body.splitlines()))
+        assert events[-1][0] == 'done'
+        assert events[-1][1]['response'] == '{"mossa_proposta": "e7-e5"}'
+        assert events[-1][1]['usage']['model'] == 'gpt-4.1-nano'
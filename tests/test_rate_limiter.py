@@ -0,0 +1,132 @@
+"""
+Test Limiti di Rate
+Verifica token bucket, coda a priorità e backoff sui 429 del pianificatore delle richieste
+"""
+import pytest
+import asyncio
+import sys
+import os
+from openai import RateLimitError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.rate_limiter import TokenBucket, RateLimitScheduler
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeRateLimitError(RateLimitError):
+    # 429 di OpenAI senza una risposta HTTP reale
+
+    def __init__(self):
+        Exception.__init__(self, 'Rate limit reached')
+
+
+def rate_limit_error():
+    return FakeRateLimitError()
+
+
+class TestTokenBucket:
+
+    def test_refills_linearly_per_minute(self):
+        clock = FakeClock()
+        bucket = TokenBucket(60, clock)
+        bucket.consume(60)
+        assert bucket.wait_time(30) == pytest.approx(30)
+        clock.sleep(30)
+        assert bucket.wait_time(30) == 0
+
+
+class TestRateLimitScheduler:
+
+    def test_token_budget_paces_requests(self):
+        clock = FakeClock()
+        scheduler = RateLimitScheduler(limits={'gpt-4o': {'tpm': 600}}, clock=clock)
+        scheduler.acquire('gpt-4o', tokens=600)
+        ticket = scheduler._enqueue('gpt-4o', 0)
+        with scheduler._lock:
+            assert scheduler._poll('gpt-4o', ticket, 300) == pytest.approx(30)
+        clock.sleep(30)
+        with scheduler._lock:
+            assert scheduler._poll('gpt-4o', ticket, 300) == 0
+
+    def test_lower_priority_value_is_served_first(self):
+        scheduler = RateLimitScheduler()
+        background = scheduler._enqueue('gpt-4o', 5)
+        urgent = scheduler._enqueue('gpt-4o', 0)
+        with scheduler._lock:
+            assert scheduler._poll('gpt-4o', background, 0) is None
+            assert scheduler._poll('gpt-4o', urgent, 0) == 0
+            assert scheduler._poll('gpt-4o', background, 0) == 0
+
+    def test_retries_with_backoff_on_429(self):
+        clock = FakeClock()
+        scheduler = RateLimitScheduler(clock=clock, sleep=clock.sleep, rng=lambda: 1.0, base_backoff=1.0)
+        calls = []
+
+        def func():
+            calls.append(clock())
+            if len(calls) < 3:
+                raise rate_limit_error()
+            return 'ok'
+
+        assert scheduler.run('gpt-4o', 10, func) == 'ok'
+        # backoff 1s e poi 2s
+        assert calls == [0.0, 1.0, 3.0]
+        assert scheduler.stats()['rate_limited'] == 2
+
+    def test_gives_up_after_max_retries(self):
+        clock = FakeClock()
+        scheduler = RateLimitScheduler(max_retries=1, clock=clock, sleep=clock.sleep)
+
+        def func():
+            raise rate_limit_error()
+
+        with pytest.raises(RateLimitError):
+            scheduler.run('gpt-4o', 10, func)
+
+    def test_async_run(self):
+        scheduler = RateLimitScheduler(limits={'gpt-4o': {'rpm': 60}})
+
+        async def call():
+            return 'ok'
+
+        assert asyncio.run(scheduler.arun('gpt-4o', 0, call)) == 'ok'
+        assert scheduler.stats()['requests'] == 1
+
+    def test_async_waiters_are_woken_in_priority_order_without_polling(self):
+        scheduler = RateLimitScheduler()
+        polls = []
+        poll = scheduler._poll
+
+        def counting_poll(model, ticket, tokens):
+            polls.append(ticket)
+            return poll(model, ticket, tokens)
+
+        scheduler._poll = counting_poll
+        scheduler._paused_until['gpt-4o'] = scheduler.clock() + 0.1
+
+        async def scenario():
+            order = []
+
+            async def request(name, priority):
+                await scheduler.aacquire('gpt-4o', priority=priority)
+                order.append(name)
+
+            await asyncio.gather(request('sintesi', 10), request('mossa', 0), request('altra mossa', 0))
+            return order
+
+        assert asyncio.run(scenario()) == ['mossa', 'altra mossa', 'sintesi']
+        # senza attesa attiva: un controllo all'arrivo, uno alla fine della pausa e uno per ogni cambio di testa
+        assert len(polls) <= 8
+        assert scheduler.stats()['queued'] == {}
@@ -0,0 +1,109 @@
+"""
+Test Store delle Sessioni
+Verifica il versionamento ottimistico degli store e la condivisione delle sessioni tra più worker
+"""
+import pytest
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.chat_session import ChatSession
+from modules.session_registry import SessionRegistry
+from modules.session_store import MemorySessionStore, SQLiteSessionStore, SessionConflict
+from tests.test_proxy import FakeOpenAIClient, FakeCompletions, proxy_client, registry
+
+
+def make_worker(store):
+    # un registro per worker: ognuno ha la propria memoria, lo stato condiviso è nello store
+    return SessionRegistry(factory=lambda: ChatSession(FakeOpenAIClient()), idle_ttl=None, store=store)
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        yield MemorySessionStore()
+    else:
+        store = SQLiteSessionStore(str(tmp_path / 'sessions.sqlite'))
+        yield store
+        store.close()
+
+
+class TestSessionStore:
+
+    def test_compare_and_swap(self, store):
+        assert store.load('a') == (0, None)
+        assert store.save('a', {'messages': []}, 0) == 1
+        assert store.save('a', {'messages': [{'role': 'system', 'content': 'Regole'}]}, 1) == 2
+        with pytest.raises(SessionConflict):
+            store.save('a', {'messages': []}, 1)
+        assert store.load('a') == (2, {'messages': [{'role': 'system', 'content': 'Regole'}]})
+        assert store.session_ids() == ['a']
+        assert store.delete('a') and store.version('a') == 0
+
+    def test_sqlite_store_is_shared_between_connections(self, tmp_path):
+        path = str(tmp_path / 'sessions.sqlite')
+        first, second = SQLiteSessionStore(path), SQLiteSessionStore(path)
+        first.save('a', {'messages': []}, 0)
+        with pytest.raises(SessionConflict):
+            second.save('a', {'messages': []}, 0)
+        assert second.save('a', {'messages': []}, 1) == 2
+        first.close()
+        second.close()
+
+
+class TestSharedRegistry:
+
+    def test_any_worker_serves_any_session(self, store):
+        worker_a, worker_b = make_worker(store), make_worker(store)
+        with worker_a.acquire('partita') as session:
+            session.add_initial_system('Regole', force=True)
+            session.chat('e2-e4')
+        with worker_b.acquire('partita') as session:
+            assert [m['role'] for m in session.messages] == ['system', 'user', 'assistant']
+            session.chat('d2-d4')
+        with worker_a.acquire('partita') as session:
+            assert len(session.messages) == 5
+
+    def test_read_only_requests_do_not_bump_the_version(self, store):
+        worker = make_worker(store)
+        with worker.acquire('partita') as session:
+            session.add_initial_system('Regole', force=True)
+        with worker.acquire('partita') as session:
+            session.get_last_assistant()
+        assert store.version('partita') == 1
+
+    def test_concurrent_update_raises_conflict_and_reloads(self, store):
+        worker_a, worker_b = make_worker(store), make_worker(store)
+        with worker_a.acquire('partita') as session:
+            session.add_initial_system('Regole', force=True)
+        with pytest.raises(SessionConflict):
+            with worker_a.acquire('partita') as session:
+                # un altro worker salva la sessione mentre questa richiesta è in corso
+                with worker_b.acquire('partita') as other:
+                    other.put_message('user', 'e2-e4')
+                session.put_message('user', 'd2-d4')
+        with worker_a.acquire('partita') as session:
+            assert session.get_last_user()['content'] == 'e2-e4'
+
+
+class TestConflictResponse:
+
+    def test_flask_chat_returns_409(self, proxy_client, registry):
+        store = MemorySessionStore()
+        registry.store = store
+        other_worker = make_worker(store)
+
+        class InterferingCompletions(FakeCompletions):
+
+            def create(self, **kwargs):
+                with other_worker.acquire('a') as other:
+                    other.put_message('user', 'mossa di un altro worker')
+                return super().create(**kwargs)
+
+        with registry.acquire('a') as session:
+            session.add_initial_system('Regole', force=True)
+            session.client = FakeOpenAIClient()
+            session.client.chat.completions = InterferingCompletions('{"mossa_proposta": "e7-e5"}')
+        r = proxy_client.post('/chat', json={'prompt': 'e2-e4', 'session_id': 'a'})
+        assert r.status_code == 409
@@ -0,0 +1,94 @@
+"""
+Test Write-Ahead Log delle Sessioni
+Verifica la registrazione delle modifiche, gli snapshot periodici e il recupero delle sessioni dopo un crash
+"""
+import pytest
+import json
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.chat_session import ChatSession
+from modules.session_registry import SessionRegistry
+from modules.session_wal import SessionWAL
+from tests.test_proxy import FakeOpenAIClient
+
+
+def make_registry(directory, snapshot_every=200):
+    # fsync_interval=0: fsync sincrono a ogni riga, per test deterministici
+    wal = SessionWAL(str(directory), fsync_interval=0, snapshot_every=snapshot_every)
+    registry = SessionRegistry(factory=lambda: ChatSession(FakeOpenAIClient('ok'), max_history=4),
+                               idle_ttl=None, wal=wal)
+    return registry, wal
+
+
+def play(session):
+    session.add_initial_system('Regole', force=True)
+    for move in ('e2-e4', 'd2-d4', 'g1-f3'):
+        session.chat(move, model='gpt-4o')
+    session.prepend_message('system', 'Tu giochi con i Neri.')
+    session.pop_last_assistant()
+
+
+class TestSessionWAL:
+
+    def test_recovery_after_crash(self, tmp_path):
+        registry, wal = make_registry(tmp_path)
+        with registry.acquire('partita-1') as session:
+            play(session)
+            expected, tokens = session.messages, session.total_tokens
+        # nuovo processo: nessuna chiusura ordinata del precedente
+        recovered, _ = make_registry(tmp_path)
+        assert recovered.recover() == ['partita-1']
+        with recovered.acquire('partita-1') as session:
+            assert session.messages == expected
+            assert session.total_tokens == tokens
+
+    def test_snapshot_truncates_log(self, tmp_path):
+        registry, wal = make_registry(tmp_path, snapshot_every=5)
+        with registry.acquire('s1') as session:
+            play(session)
+            expected = session.messages
+        assert os.path.exists(wal.snapshot_path('s1'))
+        assert os.path.getsize(wal.log_path('s1')) == 0
+        with registry.acquire('s1') as session:
+            session.put_message('user', 'b1-c3')
+            expected.append({'role': 'user', 'content': 'b1-c3'})
+        recovered, _ = make_registry(tmp_path)
+        with recovered.acquire('s1') as session:
+            assert session.messages == expected
+
+    def test_entries_already_in_snapshot_are_skipped(self, tmp_path):
+        wal = SessionWAL(str(tmp_path), fsync_interval=0)
+        wal.append('s1', {'op': 'add', 'message': {'role': 'user', 'content': 'e2-e4'}})
+        wal.snapshot('s1', {'messages': [{'role': 'user', 'content': 'e2-e4'}]})
+        # righe rimaste da un crash tra la scrittura dello snapshot e il troncamento del log
+        with open(wal.log_path('s1'), 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'seq': 1, 'op': 'add', 'message': {'role': 'user', 'content': 'e2-e4'}}) + '\n')
+            f.write(json.dumps({'seq': 2, 'op': 'add', 'message': {'role': 'assistant', 'content': 'e7-e5'}}) + '\n')
+        session = ChatSession(None)
+        assert wal.load('s1', session)
+        assert [m['content'] for m in session.messages] == ['e2-e4', 'e7-e5']
+
+    def test_truncated_last_line_is_ignored(self, tmp_path):
+        wal = SessionWAL(str(tmp_path), fsync_interval=0)
+        wal.append('s1', {'op': 'add', 'message': {'role': 'user', 'content': 'e2-e4'}})
+        with open(wal.log_path('s1'), 'a', encoding='utf-8') as f:
+            f.write('{"seq": 2, "op": "add", "mess')
+        session = ChatSession(None)
+        assert wal.load('s1', session)
+        assert session.messages == [{'role': 'user', 'content': 'e2-e4'}]
+
+    def test_eviction_and_drop(self, tmp_path):
+        registry, wal = make_registry(tmp_path)
+        registry.max_sessions = 1
+        with registry.acquire('a') as session:
+            session.put_message('user', 'e2-e4')
+        with registry.acquire('b') as session:
+            session.put_message('user', 'd2-d4')
+        assert 'a' not in registry
+        with registry.acquire('a') as session:
+            assert session.messages == [{'role': 'user', 'content': 'e2-e4'}]
+        assert registry.drop('b')
+        assert wal.session_ids() == ['a']
@@ -0,0 +1,120 @@
+"""
+Test Sintesi in Background
+Verifica l'avvio oltre la soglia di token, la sostituzione atomica dei turni sintetizzati e la sintesi su richiesta
+"""
+import pytest
+import asyncio
+import threading
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.chat_session import ChatSession, SUMMARY_PREFIX, DEFAULT_MAX_CONTEXT_TOKENS
+from modules.summarizer import BackgroundSummarizer
+from tests.test_proxy import FakeOpenAIClient, FakeAsyncOpenAIClient
+
+# budget della storia di 1000 token per gpt-4o
+MIN_RESPONSE_TOKENS = DEFAULT_MAX_CONTEXT_TOKENS - 100 - 1000
+LONG_PROMPT = 'mossa ' * 200
+
+
+class GatedClient:
+    """
+    Client finto: risponde subito alle richieste di gioco, mentre le richieste di sintesi
+    attendono l'evento 'release' (per verificare che non blocchino le altre richieste).
+    """
+
+    def __init__(self, prompt):
+        self.summary_prompt = prompt
+        self.release = threading.Event()
+        self.summary_started = threading.Event()
+        self.chat = type('Chat', (), {'completions': self})()
+
+    def create(self, **kwargs):
+        if kwargs['messages'][0]['content'] == self.summary_prompt:
+            self.summary_started.set()
+            self.release.wait(5)
+            answer = 'SINTESI'
+        else:
+            answer = 'ok'
+        message = type('Message', (), {'content': answer})()
+        return type('Completion', (), {'choices': [type('Choice', (), {'message': message})()]})()
+
+
+def make_session(client, summarizer, async_client=None):
+    session = ChatSession(client, token_model='gpt-4o', min_response_tokens=MIN_RESPONSE_TOKENS,
+                          summarizer=summarizer, async_client=async_client)
+    session.add_initial_system('Regole', force=True)
+    return session
+
+
+class TestBackgroundSummarizer:
+
+    def test_invalid_watermarks(self):
+        with pytest.raises(ValueError):
+            BackgroundSummarizer(high_watermark=0.5, low_watermark=0.7)
+
+    def test_summary_runs_in_background_and_replaces_span(self):
+        summarizer = BackgroundSummarizer(high_watermark=0.6, low_watermark=0.3, keep_turns=2)
+        client = GatedClient(summarizer.prompt)
+        session = make_session(client, summarizer)
+        while session._summary_job is None:
+            session.chat(LONG_PROMPT, model='gpt-4o')
+        span = len(session._summary_job[0])
+        assert client.summary_started.wait(5)
+        # la sintesi è in corso: le richieste continuano senza attenderla
+        assert session.chat('altra mossa', model='gpt-4o') == 'ok'
+        turns_before = len(session._turns)
+        client.release.set()
+        session._summary_job[1].result(5)
+        session.chat('ultima mossa', model='gpt-4o')
+        messages = session.messages
+        assert messages[1] == {'role': 'system', 'content': f'{SUMMARY_PREFIX}\nSINTESI'}
+        assert len(session._turns) == turns_before - span + 2
+        assert summarizer.stats()['applied'] == 1
+        summarizer.shutdown()
+
+    def test_summary_is_discarded_if_span_changed(self):
+        summarizer = BackgroundSummarizer(high_watermark=0.6, low_watermark=0.3, keep_turns=2)
+        client = GatedClient(summarizer.prompt)
+        session = make_session(client, summarizer)
+        while session._summary_job is None:
+            session.chat(LONG_PROMPT, model='gpt-4o')
+        # il turno più vecchio viene sfrattato mentre la sintesi è in corso
+        session._evict_oldest()
+        client.release.set()
+        session._summary_job[1].result(5)
+        session.chat('mossa', model='gpt-4o')
+        assert not any(m['content'].startswith(SUMMARY_PREFIX) for m in session.messages)
+        assert summarizer.stats()['discarded'] == 1
+        summarizer.shutdown()
+
+    def test_async_session_uses_event_loop_task(self):
+        summarizer = BackgroundSummarizer(high_watermark=0.6, low_watermark=0.3, keep_turns=2)
+        session = make_session(None, summarizer, async_client=FakeAsyncOpenAIClient('SINTESI'))
+
+        async def run():
+            while session._summary_job is None:
+                await session.achat(LONG_PROMPT, model='gpt-4o')
+            await session._summary_job[1]
+            await session.achat('mossa', model='gpt-4o')
+
+        asyncio.run(run())
+        assert session.messages[1]['content'].startswith(SUMMARY_PREFIX)
+        assert summarizer.stats() == {'scheduled': 1, 'applied': 1, 'discarded': 0, 'failed': 0}
+
+
+class TestSummaryPlan:
+
+    def test_duplicate_user_messages_are_summarized_by_position(self):
+        session = ChatSession(FakeOpenAIClient('sintesi'))
+        session.add_initial_system('Regole', force=True)
+        for content in ('e2-e4', 'risposta', 'e2-e4', 'risposta', 'e2-e4'):
+            session.put_message('user' if content == 'e2-e4' else 'assistant', content)
+        plan = session._summary_plan()
+        # solo l'ultimo messaggio user resta nella richiesta di sintesi, anche se ha lo stesso testo dei precedenti
+        assert [m['content'] for m in plan['reduced']] == ['Regole', 'risposta', 'risposta', 'e2-e4']
+        result = session.summarize('Sintetizza')
+        assert result['preserved_user'] == 'e2-e4'
+        assert [m['role'] for m in session.messages] == ['system', 'system', 'assistant', 'assistant', 'user']
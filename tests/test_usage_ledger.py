@@ -0,0 +1,110 @@
+"""
+Test Registro dei Consumi
+Verifica l'aggregazione in memoria, la scrittura a lotti su SQLite e le query per sessione, utente e giorno
+"""
+import pytest
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import openai_proxy_asgi
+from modules.chat_session import ChatSession, DEFAULT_MAX_CONTEXT_TOKENS
+from modules.session_registry import SessionRegistry
+from modules.summarizer import BackgroundSummarizer
+from modules.usage_ledger import UsageLedger
+from tests.test_proxy import FakeOpenAIClient, FakeAsyncOpenAIClient, call_asgi, proxy_client, registry
+
+# 2026-10-19 12:00 UTC
+NOON = 1792411200.0
+
+
+class TestUsageLedger:
+
+    def test_records_are_aggregated_until_flush(self, tmp_path):
+        path = str(tmp_path / 'usage.sqlite')
+        ledger = UsageLedger(path=path, flush_interval=0, clock=lambda: NOON)
+        ledger.record('partita-1', 'gpt-4o', 1000, 100, latency=1.0, user_id='mario')
+        ledger.record('partita-1', 'gpt-4o', 3000, 300, latency=3.0, user_id='mario')
+        assert ledger._db.execute('SELECT COUNT(*) FROM usage').fetchone()[0] == 0
+        assert ledger.flush() == 1
+        assert ledger.query(session_id='partita-1') == [{
+            'session_id': 'partita-1', 'requests': 2, 'prompt_tokens': 4000, 'completion_tokens': 400,
+            'total_tokens': 4400, 'cost': 0.014, 'avg_latency': 2.0}]
+        ledger.close()
+
+    def test_totals_survive_restart_and_are_summed(self, tmp_path):
+        path = str(tmp_path / 'usage.sqlite')
+        ledger = UsageLedger(path=path, flush_interval=0, clock=lambda: NOON)
+        ledger.record('partita-1', 'gpt-4.1-nano', 100, 10, user_id='mario')
+        ledger.close()
+        ledger = UsageLedger(path=path, flush_interval=0, clock=lambda: NOON)
+        ledger.record('partita-1', 'gpt-4.1-nano', 100, 10, user_id='mario')
+        rows = ledger.query(user_id='mario', group_by=('day', 'model'))
+        assert rows == [{'day': '2026-10-19', 'model': 'gpt-4.1-nano', 'requests': 2, 'prompt_tokens': 200,
+                         'completion_tokens': 20, 'total_tokens': 220, 'cost': 0.000028, 'avg_latency': 0.0}]
+        ledger.close()
+
+    def test_query_filters_by_user_and_day(self):
+        now = [NOON]
+        ledger = UsageLedger(flush_interval=0, clock=lambda: now[0])
+        ledger.record('a', 'gpt-4o', 10, 1, user_id='mario')
+        ledger.record('b', 'gpt-4o', 10, 1, user_id='luigi')
+        now[0] += 24 * 3600
+        ledger.record('a', 'gpt-4o', 10, 1, user_id='mario')
+        assert [r['requests'] for r in ledger.query(user_id='mario', group_by=())] == [2]
+        assert sorted(r['session_id'] for r in ledger.query(day='2026-10-19')) == ['a', 'b']
+        assert ledger.query(user_id='nessuno') == []
+
+    def test_invalid_group_by(self):
+        with pytest.raises(ValueError):
+            UsageLedger(flush_interval=0).query(group_by=('prompt',))
+
+
+class TestLedgerIntegration:
+
+    def test_proxy_sessions_are_accounted(self, proxy_client, registry):
+        registry.ledger = UsageLedger(flush_interval=0)
+        with registry.acquire('partita-1') as session:
+            session.client = FakeOpenAIClient()
+            session.add_initial_system('Regole', force=True)
+        proxy_client.post('/chat', json={'prompt': 'e2-e4', 'session_id': 'partita-1'})
+        proxy_client.post('/chat', json={'prompt': 'd2-d4', 'session_id': 'partita-1'})
+        body = proxy_client.get('/usage?session_id=partita-1').get_json()
+        assert body['enabled'] is True
+        assert body['usage'][0]['session_id'] == 'partita-1'
+        assert body['usage'][0]['requests'] == 2
+        assert proxy_client.get('/usage?group_by=prompt').status_code == 400
+
+    def test_usage_is_attributed_to_the_request_user(self, proxy_client, registry, monkeypatch):
+        registry.ledger = UsageLedger(flush_interval=0)
+        with registry.acquire('partita-1') as session:
+            session.client = FakeOpenAIClient()
+            session.add_initial_system('Regole', force=True)
+        proxy_client.post('/chat', json={'prompt': 'e2-e4', 'session_id': 'partita-1', 'user_id': 'mario'})
+        proxy_client.post('/chat/stream', json={'prompt': 'd2-d4', 'session_id': 'partita-1'},
+                          headers={'X-User-Id': 'mario'}).get_data()
+        rows = proxy_client.get('/usage?user_id=mario').get_json()['usage']
+        assert [(r['session_id'], r['requests']) for r in rows] == [('partita-1', 2)]
+
+        async_registry = SessionRegistry(factory=lambda: ChatSession(None, async_client=FakeAsyncOpenAIClient()),
+                                         idle_ttl=None, ledger=UsageLedger(flush_interval=0))
+        monkeypatch.setattr(openai_proxy_asgi, 'session_registry', async_registry)
+        call_asgi('POST', '/chat/init', {'system_messages': ['Regole'], 'session_id': 'partita-2'})
+        call_asgi('POST', '/chat', {'prompt': 'e2-e4', 'session_id': 'partita-2'}, headers={'X-User-Id': 'luigi'})
+        assert [r['session_id'] for r in async_registry.ledger.query(user_id='luigi')] == ['partita-2']
+
+    def test_background_summaries_are_accounted(self):
+        ledger = UsageLedger(flush_interval=0)
+        summarizer = BackgroundSummarizer(high_watermark=0.6, low_watermark=0.3, keep_turns=2)
+        session = ChatSession(FakeOpenAIClient(), token_model='gpt-4o', summarizer=summarizer,
+                              min_response_tokens=DEFAULT_MAX_CONTEXT_TOKENS - 100 - 1000)
+        session.add_initial_system('Regole', force=True)
+        session.usage_sink = ledger.sink('partita-1', 'mario')
+        chats = 0
+        while session._summary_job is None:
+            session.chat('mossa ' * 200, model='gpt-4o')
+            chats += 1
+        session._summary_job[1].result(5)
+        assert ledger.query(user_id='mario', group_by=())[0]['requests'] == chats + 1
+        summarizer.shutdown()
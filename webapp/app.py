@@ -1,14 +1,25 @@
 import os
 import sys
+import time
+import atexit
 import json as json_module
 from functools import wraps
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, Response, render_template, request, redirect, url_for, session, flash, jsonify
 from flask_cors import CORS
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from webapp.services import LoginService, SessionManager
 from webapp.services.match_controller import MatchController
+from modules.prompt_codec import encoding_from_env
+from modules.move_protocol import protocol_from_env, checkpoint_every_from_env
+from modules.usage_ledger import ledger_from_env, usage_query_args
+from modules.admission import Overloaded, admission_from_env
+from modules.metrics import REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE, HISTORY_BUCKETS, Gauge, Histogram
+
+# Durata della risposta dell'AI a una mossa (richiesta all'LLM, validazione e retry)
+AI_MOVE_LATENCY = REGISTRY.histogram(
+    "promptchess_ai_move_seconds", "Durata della risposta dell'AI a una mossa", ("result",))
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'promptchess-dev-key-change-in-prod')
@@ -16,6 +27,12 @@ CORS(app)
 
 login_service = None
 session_manager = None
+# Registro dei consumi dell'LLM per partita e utente (USAGE_LEDGER_PATH per salvarlo su SQLite)
+usage_ledger = ledger_from_env()
+atexit.register(usage_ledger.close)
+# Limiti di concorrenza delle mosse (MOVE_MAX_CONCURRENT, MOVE_MAX_PER_USER, MOVE_MAX_QUEUE, MOVE_QUEUE_TIMEOUT):
+# ogni mossa tiene occupato un thread in attesa dell'AI
+move_admission = admission_from_env('MOVE', scope='move')
 
 def get_login_service():
     global login_service
@@ -26,7 +43,7 @@ def get_login_service():
 def get_session_manager():
     global session_manager
     if session_manager is None:
-        session_manager = SessionManager()
+        session_manager = SessionManager(ledger=usage_ledger)
     return session_manager
 
 
@@ -48,6 +65,28 @@ def login_required(f):
     return decorated_function
 
 
+def admission_required(f):
+    # 503 con Retry-After se le mosse in corso e in coda sono già al limite (per processo o per utente)
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        try:
+            release = move_admission.acquire(session.get('username'))
+        except Overloaded as e:
+            response = jsonify({
+                'success': False,
+                'error': f'Server busy, please retry in {e.retry_after} seconds',
+                'retry_after': e.retry_after
+            })
+            response.status_code = 503
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response
+        try:
+            return f(*args, **kwargs)
+        finally:
+            release()
+    return decorated_function
+
+
 @app.route('/')
 def index():
     if 'session_token' in session:
@@ -206,18 +245,73 @@ def get_match_controller(game_session):
         def llm_func(prompt, temperature=0.7):
             return game_session.send_to_llm(prompt, model='gpt-4.1-nano', temperature=temperature)
         
+        def stream_func(prompt, temperature=0.7):
+            return game_session.send_to_llm_stream(prompt, model='gpt-4.1-nano', temperature=temperature)
+        
+        def hedge_func(prompt, temperature, model, cancel_event):
+            return game_session.complete(prompt, model=model, temperature=temperature, cancel_event=cancel_event)
+        
+        def candidates_func(prompt, temperature, n):
+            return game_session.complete_candidates(prompt, model='gpt-4.1-nano', temperature=temperature, n=n)
+        
+        # LLM_STREAM=1 attiva lo streaming (e la validazione anticipata della mossa)
+        use_stream = os.environ.get('LLM_STREAM', '0') == '1'
+        # LLM_HEDGE_DELAY (secondi) attiva l'hedging: se gpt-4.1-nano non risponde in tempo
+        # parte una seconda richiesta a LLM_HEDGE_MODEL e vince la prima mossa valida
+        hedge_delay = os.environ.get('LLM_HEDGE_DELAY')
+        reply_options = {}
+        if hedge_delay:
+            reply_options = {
+                'hedge_func': hedge_func,
+                'commit_func': game_session.commit_exchange,
+                'hedge_models': ('gpt-4.1-nano', os.environ.get('LLM_HEDGE_MODEL', 'gpt-4o-mini')),
+                'hedge_delay': float(hedge_delay)
+            }
+        
+        # LLM_CANDIDATES > 1 chiede più mosse candidate in una sola chiamata e sceglie la prima legale
+        candidates = int(os.environ.get('LLM_CANDIDATES', '1'))
+        if candidates > 1 and not reply_options:
+            reply_options = {
+                'candidates_func': candidates_func,
+                'commit_func': game_session.commit_exchange,
+                'candidates': candidates
+            }
+        
         controller = MatchController(
             initial_board_json=game_session.board_state,
             llm_func=llm_func,
-            observer=None
+            observer=None,
+            stream_func=stream_func if use_stream else None,
+            prompt_encoding=encoding_from_env(),
+            protocol=protocol_from_env(),
+            checkpoint_every=checkpoint_every_from_env(),
+            **reply_options
         )
         match_controllers[session_id] = controller
     
     return match_controllers[session_id]
 
 
+def game_metrics():
+    # collector di /metrics: partite in memoria e dimensione della loro storia
+    active = Gauge("promptchess_active_games", "Partite con un controller in memoria")
+    active.set(len(match_controllers))
+    history = Histogram("promptchess_game_history_messages", "Messaggi nella storia delle partite attive",
+                        buckets=HISTORY_BUCKETS)
+    if session_manager is not None:
+        for game_session in list(session_manager.active_sessions.values()):
+            history.observe(len(game_session.messages))
+    return [active, history]
+
+
+@app.route('/metrics')
+def metrics():
+    return Response(REGISTRY.render([game_metrics]), content_type=METRICS_CONTENT_TYPE)
+
+
 @app.route('/api/game/<session_id>/move', methods=['POST'])
 @login_required
+@admission_required
 def api_make_move(session_id):
     sm = get_session_manager()
     game_session = sm.get_session(session_id)
@@ -261,7 +355,9 @@ def api_make_move(session_id):
             'move_history': game_session.move_history
         })
     
+    started = time.perf_counter()
     ai_result = controller.request_ai_move()
+    AI_MOVE_LATENCY.observe(time.perf_counter() - started, result='success' if ai_result['success'] else 'failure')
     
     if not ai_result['success']:
         sm.save_session(game_session)
@@ -321,6 +417,18 @@ def api_game_state(session_id):
     })
 
 
+@app.route('/api/usage')
+@login_required
+def api_usage():
+    # consumi dell'LLM dell'utente collegato, filtrabili per partita (session_id) e giorno, raggruppati con group_by
+    options = usage_query_args(request.args)
+    options['user_id'] = session.get('username')
+    try:
+        return jsonify({'success': True, 'usage': usage_ledger.query(**options)})
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=True)
@@ -1,7 +1,8 @@
-import json
 import copy
 import random
+import threading
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import sys
 import os
@@ -12,6 +13,35 @@ from modules.chess_core import (
     detect_move, apply_move, boards_equal, 
     warn_if_in_check, is_game_active, game_result
 )
+from modules.move_parser import resolve_move
+from modules.json_stream import IncrementalJsonScanner
+from modules.json_extractor import extract_json_object
+from modules.prompt_codec import encode_board, check_encoding, DEFAULT_PROMPT_ENCODING
+from modules.move_protocol import (
+    check_protocol, delta_turn_prompt, DELTA_PROTOCOL,
+    DEFAULT_PROMPT_PROTOCOL, DEFAULT_CHECKPOINT_EVERY
+)
+from modules.metrics import REGISTRY
+
+# Metriche delle richieste con hedging: la frazione di richieste duplicate è il costo aggiuntivo
+HEDGE_REQUESTS = REGISTRY.counter(
+    "promptchess_hedge_requests_total", "Richieste di mossa all'AI con hedging attivo")
+HEDGE_LAUNCHED = REGISTRY.counter(
+    "promptchess_hedge_launched_total", "Seconde richieste avviate perché la prima non ha risposto entro il ritardo")
+HEDGE_CANCELLED = REGISTRY.counter(
+    "promptchess_hedge_cancelled_total", "Richieste annullate perché l'altra ha prodotto per prima una mossa valida")
+HEDGE_WINS = REGISTRY.counter(
+    "promptchess_hedge_wins_total", "Richieste con hedging per risposta vincente (primary, hedge o none)", ("winner",))
+
+# Metriche del campionamento di più candidati per chiamata: posizione del primo candidato legale
+CANDIDATE_REQUESTS = REGISTRY.counter(
+    "promptchess_candidate_requests_total", "Chiamate all'AI che chiedono più mosse candidate")
+CANDIDATE_PICKS = REGISTRY.counter(
+    "promptchess_candidate_picks_total", "Candidato scelto per posizione (0 = il primo), o none se nessuno è legale",
+    ("position",))
+
+# Thread delle richieste con hedging, condivisi da tutte le partite
+_HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=16, thread_name_prefix="hedge")
 
 
 class MatchObserver(ABC):
@@ -31,14 +61,53 @@ class MatchObserver(ABC):
 class MatchController:
     MAX_RETRIES = 3
     
-    def __init__(self, initial_board_json, llm_func, observer=None):
+    def __init__(self, initial_board_json, llm_func, observer=None, stream_func=None,
+                 prompt_encoding=DEFAULT_PROMPT_ENCODING, protocol=DEFAULT_PROMPT_PROTOCOL,
+                 checkpoint_every=DEFAULT_CHECKPOINT_EVERY, hedge_func=None, commit_func=None,
+                 hedge_models=None, hedge_delay=None, candidates_func=None, candidates=1):
         self.board_prev = json_to_board(initial_board_json)
         self.llm_func = llm_func
+        # stream_func(prompt, temperature) -> iteratore dei frammenti della risposta: se presente,
+        # la mossa proposta viene validata appena arriva e lo stream interrotto se è illegale
+        self.stream_func = stream_func
+        # codifica della scacchiera nei prompt ('json' o 'fen'); la risposta resta nello schema JSON
+        self.prompt_encoding = check_encoding(prompt_encoding)
+        # protocollo 'full' (scacchiera completa ad ogni turno) o 'delta' (solo le mosse, con un
+        # checkpoint della posizione ogni checkpoint_every mosse dei Neri)
+        self.protocol = check_protocol(protocol)
+        self.checkpoint_every = checkpoint_every
+        self.turns_since_checkpoint = 0
+        # hedging: hedge_func(prompt, temperature, model, cancel_event) -> risposta non ancora in storia,
+        # commit_func(prompt, risposta) la conferma. Se il modello primario non risponde entro hedge_delay
+        # secondi parte una seconda richiesta al modello di riserva; vince la prima risposta valida.
+        self.hedge_func = hedge_func
+        self.commit_func = commit_func
+        self.hedge_models = tuple(hedge_models or ())
+        self.hedge_delay = hedge_delay
+        if hedge_func is not None and (commit_func is None or len(self.hedge_models) != 2 or hedge_delay is None):
+            raise ValueError("Hedging richiede commit_func, hedge_models (primario, riserva) e hedge_delay")
+        # campionamento: candidates_func(prompt, temperature, n) -> n risposte non ancora in storia, ottenute
+        # con una sola chiamata; vengono validate tutte localmente e la prima legale è confermata con commit_func
+        self.candidates_func = candidates_func
+        self.candidates = candidates
+        if candidates_func is not None and (commit_func is None or candidates < 2):
+            raise ValueError("Il campionamento richiede commit_func e almeno 2 candidati")
         self.observer = observer
         self.is_human_turn = True
         self.last_human_move = None
         self.conversation_history = []
     
+    def encode_board(self, board_json, indent=None, side_to_move='b'):
+        return encode_board(board_json, self.prompt_encoding, indent=indent, side_to_move=side_to_move)
+    
+    def _delta_prompt(self, board_json):
+        self.turns_since_checkpoint += 1
+        checkpoint = None
+        if self.checkpoint_every and self.turns_since_checkpoint >= self.checkpoint_every:
+            checkpoint = self.encode_board(board_json)
+            self.turns_since_checkpoint = 0
+        return delta_turn_prompt(self.last_human_move, checkpoint)
+    
     def get_board_json(self):
         return board_to_json(self.board_prev)
     
@@ -89,97 +158,243 @@ class MatchController:
         
         return {'success': True}
     
+    def _read_streamed_reply(self, prompt, temperature):
+        """
+        Legge la risposta in streaming validando 'mossa_proposta' appena è completa.
+        Ritorna (risposta, errore): se la mossa è illegale lo stream viene chiuso subito
+        (interrompendo la generazione) e la risposta è None.
+        """
+        scanner = IncrementalJsonScanner()
+        stream = self.stream_func(prompt, temperature=temperature)
+        parts = []
+        try:
+            for delta in stream:
+                parts.append(delta)
+                mossa_proposta = scanner.feed(delta).get('mossa_proposta')
+                if mossa_proposta is None:
+                    continue
+                try:
+                    piece, from_sq, to_sq = resolve_move(mossa_proposta, self.board_prev, "black")
+                except ValueError as e:
+                    return None, f"Mossa illegale '{mossa_proposta}': {e}"
+                check_warning = warn_if_in_check(apply_move(piece, from_sq, to_sq, self.board_prev),
+                                                 "black", (piece, from_sq, to_sq))
+                if check_warning is not None:
+                    return None, check_warning
+        finally:
+            close = getattr(stream, 'close', None)
+            if close is not None:
+                close()
+        return ''.join(parts), None
+    
+    def _validate_reply(self, ai_response, board_json):
+        """
+        Valida la risposta dell'AI contro le regole (chess_core) senza modificare lo stato della partita.
+        Ritorna {'parsed', 'move': (pezzo, da, a), 'board_next'} se la mossa è valida,
+        altrimenti {'error', 'prompt'} con il messaggio di correzione per il tentativo successivo.
+        """
+        try:
+            parsed = extract_json_object(ai_response)
+        except ValueError:
+            return {'error': 'Invalid JSON',
+                    'prompt': f"La tua risposta non era JSON valido. Riprova: {self.encode_board(board_json)}"}
+        
+        if self.protocol == DELTA_PROTOCOL:
+            # protocollo a delta: la risposta contiene solo la mossa, la scacchiera è ricostruita localmente
+            mossa_proposta = parsed.get('mossa_proposta', '')
+            try:
+                piece, from_sq, to_sq = resolve_move(mossa_proposta, self.board_prev, "black")
+            except ValueError as e:
+                error = f"Mossa illegale '{mossa_proposta}': {e}"
+                return {'error': error,
+                        'prompt': f"{error}. Proponi una mossa valida per i Neri. Stato: {self.encode_board(board_json)}"}
+            board_next = apply_move(piece, from_sq, to_sq, self.board_prev)
+        else:
+            if 'neri' not in parsed or 'bianchi' not in parsed:
+                return {'error': 'Missing neri/bianchi in response',
+                        'prompt': f"Manca la definizione di neri/bianchi. Stato attuale: {self.encode_board(board_json)}"}
+            
+            ai_board_json = {'neri': parsed['neri'], 'bianchi': parsed['bianchi']}
+            
+            try:
+                board_next = json_to_board(ai_board_json)
+            except Exception as e:
+                return {'error': f'Invalid board structure: {e}',
+                        'prompt': f"Struttura board invalida. Stato attuale: {self.encode_board(board_json)}"}
+            
+            try:
+                detected = detect_move(self.board_prev, board_next)
+                piece, from_sq, to_sq = detected
+            except Exception as e:
+                # la board restituita non è coerente: risolviamo direttamente la mossa proposta
+                # contro le mosse legali, evitando un nuovo round trip verso l'LLM
+                mossa_proposta = parsed.get('mossa_proposta', '')
+                try:
+                    piece, from_sq, to_sq = resolve_move(mossa_proposta, self.board_prev, "black")
+                except ValueError as e2:
+                    return {'error': f'Cannot detect move: {e} ({e2})',
+                            'prompt': f"Non riesco a rilevare la mossa. Proponi una mossa valida per i Neri e aggiorna la board: {self.encode_board(board_json)}"}
+                board_next = apply_move(piece, from_sq, to_sq, self.board_prev)
+        
+        if not is_legal_move(piece, from_sq, to_sq, self.board_prev, "black"):
+            return {'error': f'Illegal move: {piece} {from_sq}->{to_sq}',
+                    'prompt': f"Mossa illegale '{from_sq}->{to_sq}'. Proponi una mossa valida per i Neri. Stato: {self.encode_board(board_json)}"}
+        
+        verified_board = apply_move(piece, from_sq, to_sq, self.board_prev)
+        
+        if not boards_equal(verified_board, board_next):
+            correct_json = board_to_json(verified_board)
+            return {'error': 'Board state mismatch after applying move',
+                    'prompt': f"Lo stato della board non corrisponde alla mossa. Stato corretto dopo la mossa: {self.encode_board(correct_json, side_to_move='w')}"}
+        
+        check_warning = warn_if_in_check(board_next, "black", (piece, from_sq, to_sq))
+        if check_warning is not None:
+            return {'error': check_warning,
+                    'prompt': f"{check_warning} - Proponi una mossa che non lasci il Re nero sotto scacco. Stato: {self.encode_board(board_json)}"}
+        
+        return {'parsed': parsed, 'move': (piece, from_sq, to_sq), 'board_next': board_next}
+    
+    def _hedged_reply(self, prompt, temperature, board_json):
+        """
+        Richiesta con hedging: parte la richiesta al modello primario; se non risponde entro hedge_delay
+        secondi ne parte una seconda al modello di riserva. Vince la prima risposta che supera la validazione:
+        l'altra richiesta viene annullata e solo la vincente entra nella storia (commit_func).
+        Ritorna (risposta, verdetto di _validate_reply); se nessuna risposta è valida, quella del primario.
+        """
+        primary_model, hedge_model = self.hedge_models
+        requests = {}
+        
+        def launch(model):
+            cancel_event = threading.Event()
+            future = _HEDGE_EXECUTOR.submit(self.hedge_func, prompt, temperature, model, cancel_event)
+            requests[future] = (model, cancel_event)
+            return future
+        
+        HEDGE_REQUESTS.inc()
+        primary = launch(primary_model)
+        done, pending = wait({primary}, timeout=self.hedge_delay)
+        if pending:
+            HEDGE_LAUNCHED.inc()
+            print(f"[DEBUG] Nessuna risposta da {primary_model} dopo {self.hedge_delay}s: richiesta anche a {hedge_model}")
+            pending.add(launch(hedge_model))
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        
+        results = {}
+        while True:
+            for future in done:
+                try:
+                    answer = future.result()
+                except Exception as e:
+                    answer, verdict = None, {'error': str(e)}
+                else:
+                    verdict = self._validate_reply(answer, board_json) if answer is not None else {'error': 'No response from AI'}
+                results[future] = (answer, verdict)
+                if 'error' not in verdict:
+                    for other in pending:
+                        requests[other][1].set()
+                        other.cancel()
+                    HEDGE_CANCELLED.inc(len(pending))
+                    HEDGE_WINS.inc(winner='primary' if future is primary else 'hedge')
+                    self.commit_func(prompt, answer)
+                    return answer, verdict
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        
+        HEDGE_WINS.inc(winner='none')
+        # nessuna risposta valida: la risposta del primario resta in storia, come senza hedging,
+        # così il prompt di correzione del tentativo successivo si riferisce ad essa
+        answer, verdict = results[primary]
+        if answer is not None:
+            self.commit_func(prompt, answer)
+        return answer, verdict
+    
+    def _sampled_reply(self, prompt, temperature, board_json):
+        """
+        Chiede self.candidates risposte in una sola chiamata e le valida tutte con _validate_reply:
+        la prima mossa legale entra nella storia (commit_func), così un candidato illegale non costa
+        un nuovo round trip. Ritorna (risposta, verdetto); se nessuna è valida, la prima risposta.
+        """
+        CANDIDATE_REQUESTS.inc()
+        answers = self.candidates_func(prompt, temperature, self.candidates)
+        first = None
+        for position, answer in enumerate(answers):
+            if answer is None:
+                continue
+            verdict = self._validate_reply(answer, board_json)
+            if 'error' not in verdict:
+                print(f"[DEBUG] Scelto il candidato {position + 1} di {len(answers)}")
+                CANDIDATE_PICKS.inc(position=str(position))
+                self.commit_func(prompt, answer)
+                return answer, verdict
+            if first is None:
+                first = (answer, verdict)
+        
+        CANDIDATE_PICKS.inc(position='none')
+        if first is None:
+            return None, None
+        # nessun candidato legale: il primo resta in storia, come con una sola risposta,
+        # così il prompt di correzione del tentativo successivo si riferisce ad esso
+        self.commit_func(prompt, first[0])
+        return first
+    
     def request_ai_move(self):
         if self.is_human_turn:
             return {'success': False, 'error': 'Not AI turn'}
         
         board_json = board_to_json(self.board_prev)
         
-        prompt = f'''
+        if self.protocol == DELTA_PROTOCOL:
+            prompt = self._delta_prompt(board_json)
+        else:
+            prompt = f'''
 Mossa dei Bianchi: {self.last_human_move}
 Stato scacchiera attuale (già aggiornato con la mossa dei Bianchi):
-{json.dumps(board_json, indent=2)}
+{self.encode_board(board_json, indent=2)}
 
 Proponi la tua mossa per i Neri e aggiorna lo stato della scacchiera.
-Rispondi in JSON con: neri, bianchi, mossa_proposta, commento_giocatore, messaggio_avversario.
+Rispondi in JSON con: mossa_proposta (come prima chiave), neri, bianchi, commento_giocatore, messaggio_avversario.
 '''
         
         last_error = ''
         
         for attempt in range(self.MAX_RETRIES):
             temperature = random.uniform(0.70, 0.95)
+            verdict = None
             
             try:
-                ai_response = self.llm_func(prompt, temperature=temperature)
+                if self.hedge_func is not None:
+                    ai_response, verdict = self._hedged_reply(prompt, temperature, board_json)
+                elif self.candidates_func is not None:
+                    ai_response, verdict = self._sampled_reply(prompt, temperature, board_json)
+                elif self.stream_func is not None:
+                    ai_response, early_error = self._read_streamed_reply(prompt, temperature)
+                    if early_error is not None:
+                        # stream interrotto: si riparte subito senza attendere il resto della risposta
+                        last_error = early_error
+                        prompt = f"{early_error}. Proponi una mossa valida per i Neri. Stato: {self.encode_board(board_json)}"
+                        continue
+                else:
+                    ai_response = self.llm_func(prompt, temperature=temperature)
             except Exception as e:
                 last_error = str(e)
                 continue
             
-            if ai_response is None:
+            if ai_response is None and verdict is None:
                 last_error = 'No response from AI'
                 continue
             
-            try:
-                parsed = json.loads(ai_response)
-            except json.JSONDecodeError:
-                last_error = 'Invalid JSON'
-                prompt = f"La tua risposta non era JSON valido. Riprova: {json.dumps(board_json)}"
-                continue
-            
-            if 'neri' not in parsed or 'bianchi' not in parsed:
-                last_error = 'Missing neri/bianchi in response'
-                prompt = f"Manca la definizione di neri/bianchi. Stato attuale: {json.dumps(board_json)}"
-                continue
-            
-            ai_board_json = {'neri': parsed['neri'], 'bianchi': parsed['bianchi']}
-            
-            try:
-                board_next = json_to_board(ai_board_json)
-            except Exception as e:
-                last_error = f'Invalid board structure: {e}'
-                prompt = f"Struttura board invalida. Stato attuale: {json.dumps(board_json)}"
-                continue
-            
-            try:
-                detected = detect_move(self.board_prev, board_next)
-                piece, from_sq, to_sq = detected
-            except Exception as e:
-                mossa_proposta = parsed.get('mossa_proposta', '')
-                if mossa_proposta and '-' in mossa_proposta:
-                    parts = mossa_proposta.replace('-', ' ').split()
-                    if len(parts) >= 2:
-                        from_sq = parts[0].lower()
-                        to_sq = parts[1].lower()
-                        
-                        if boards_equal(self.board_prev, board_next):
-                            if is_legal_move(None, from_sq, to_sq, self.board_prev, "black"):
-                                correct_board = apply_move(None, from_sq, to_sq, self.board_prev)
-                                correct_json = board_to_json(correct_board)
-                                prompt = f"La board non è stata aggiornata dopo la mossa '{mossa_proposta}'. Aggiorna così: {json.dumps(correct_json)}"
-                                continue
-                
-                last_error = f'Cannot detect move: {e}'
-                prompt = f"Non riesco a rilevare la mossa. Proponi una mossa valida per i Neri e aggiorna la board: {json.dumps(board_json)}"
-                continue
-            
-            if not is_legal_move(piece, from_sq, to_sq, self.board_prev, "black"):
-                last_error = f'Illegal move: {piece} {from_sq}->{to_sq}'
-                prompt = f"Mossa illegale '{from_sq}->{to_sq}'. Proponi una mossa valida per i Neri. Stato: {json.dumps(board_json)}"
+            if verdict is None:
+                verdict = self._validate_reply(ai_response, board_json)
+            if 'error' in verdict:
+                last_error = verdict['error']
+                if verdict.get('prompt'):
+                    prompt = verdict['prompt']
                 continue
             
-            verified_board = apply_move(piece, from_sq, to_sq, self.board_prev)
-            
-            if not boards_equal(verified_board, board_next):
-                last_error = 'Board state mismatch after applying move'
-                correct_json = board_to_json(verified_board)
-                prompt = f"Lo stato della board non corrisponde alla mossa. Stato corretto dopo la mossa: {json.dumps(correct_json)}"
-                continue
-            
-            check_warning = warn_if_in_check(board_next, "black", (piece, from_sq, to_sq))
-            if check_warning is not None:
-                last_error = check_warning
-                prompt = f"{check_warning} - Proponi una mossa che non lasci il Re nero sotto scacco. Stato: {json.dumps(board_json)}"
-                continue
+            parsed = verdict['parsed']
+            piece, from_sq, to_sq = verdict['move']
+            board_next = verdict['board_next']
             
             self.board_prev = board_next
             self.is_human_turn = True
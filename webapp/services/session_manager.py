@@ -1,4 +1,5 @@
 import os
+import time
 import uuid
 import json
 from datetime import datetime
@@ -6,6 +7,12 @@ from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
 from urllib.parse import quote_plus
 from openai import OpenAI
+from modules.mock_llm import MockOpenAIClient, use_mock_backend
+from modules.prompt_codec import encode_board, encoding_from_env
+from modules.move_protocol import protocol_from_env, DELTA_PROTOCOL, DELTA_RULES, DELTA_OUTPUT
+from modules.history_compaction import compact_board_history
+from modules.metrics import track_llm_call, record_llm_usage, usage_tokens
+from modules.chat_session import count_tokens, count_message_tokens
 
 
 class GameSession:
@@ -20,9 +27,15 @@ class GameSession:
         self.status = 'active'
         self.created_at = datetime.utcnow()
         self.current_turn = 'white'
+        # indice del messaggio con l'ultima scacchiera: i messaggi precedenti sono già compattati
+        self._compacted_until = 0
+        # funzione usage_sink(model, prompt_tokens, completion_tokens, latency) del registro dei consumi, opzionale
+        self.usage_sink = None
         
         api_key = os.environ.get('OPENAI_API_KEY')
-        if api_key:
+        if use_mock_backend():
+            self.openai_client = MockOpenAIClient.from_env()
+        elif api_key:
             self.openai_client = OpenAI(api_key=api_key)
         else:
             self.openai_client = None
@@ -69,6 +82,7 @@ class GameSession:
     def pop_last_assistant(self):
         for i in range(len(self.messages) - 1, -1, -1):
             if self.messages[i]['role'] == 'assistant':
+                self._compacted_until = 0
                 return self.messages.pop(i)
         return None
     
@@ -77,24 +91,167 @@ class GameSession:
     
     def clear_messages(self):
         self.messages = [m for m in self.messages if m['role'] == 'system']
+        self._compacted_until = 0
+    
+    def compact_history(self) -> int:
+        """
+        Sostituisce le scacchiere superate nei messaggi con un riferimento alla mossa,
+        mantenendo l'ultima scacchiera e i messaggi di feedback (prima di ogni completion).
+        """
+        self._compacted_until, compacted = compact_board_history(self.messages, self._compacted_until)
+        return compacted
+    
+    def _record_usage(self, model: str, prompt_tokens: int, completion_tokens: int, started: float):
+        # consumi della completion per /metrics e per il registro dei consumi (sessione e utente)
+        record_llm_usage(model, prompt_tokens, completion_tokens)
+        if self.usage_sink is not None:
+            self.usage_sink(model, prompt_tokens, completion_tokens, time.perf_counter() - started)
     
     def send_to_llm(self, prompt: str, model: str = 'gpt-4.1-nano', temperature: float = 0.7) -> str:
         if not self.openai_client:
             raise ValueError("OpenAI client not initialized")
         
         self.add_user_message(prompt)
+        self.compact_history()
         
-        response = self.openai_client.chat.completions.create(
-            model=model,
-            messages=self.messages,
-            temperature=temperature
-        )
+        started = time.perf_counter()
+        with track_llm_call(model):
+            response = self.openai_client.chat.completions.create(
+                model=model,
+                messages=self.messages,
+                temperature=temperature
+            )
         
         assistant_content = response.choices[0].message.content
+        # la storia viene ricontata solo se la risposta non riporta usage
+        self._record_usage(model, *usage_tokens(
+            response, lambda: count_message_tokens(self.messages, model),
+            lambda: count_tokens(assistant_content, model)), started)
         self.add_assistant_message(assistant_content)
         
         return assistant_content
     
+    def send_to_llm_stream(self, prompt: str, model: str = 'gpt-4.1-nano', temperature: float = 0.7):
+        """
+        Come send_to_llm, ma restituisce i frammenti della risposta man mano che arrivano.
+        La risposta completa viene aggiunta ai messaggi solo se lo stream arriva alla fine.
+        """
+        if not self.openai_client:
+            raise ValueError("OpenAI client not initialized")
+        
+        self.add_user_message(prompt)
+        self.compact_history()
+        
+        started = time.perf_counter()
+        with track_llm_call(model, stream=True):
+            stream = self.openai_client.chat.completions.create(
+                model=model,
+                messages=self.messages,
+                temperature=temperature,
+                stream=True
+            )
+        
+        parts = []
+        # ultimo chunk con il campo usage (se l'API lo include nello stream)
+        usage_chunk = None
+        try:
+            for chunk in stream:
+                if getattr(chunk, 'usage', None) is not None:
+                    usage_chunk = chunk
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    yield delta
+        finally:
+            close = getattr(stream, 'close', None)
+            if close is not None:
+                close()
+        
+        assistant_content = ''.join(parts)
+        self._record_usage(model, *usage_tokens(
+            usage_chunk, lambda: count_message_tokens(self.messages, model),
+            lambda: count_tokens(assistant_content, model)), started)
+        self.add_assistant_message(assistant_content)
+    
+    def complete(self, prompt: str, model: str = 'gpt-4.1-nano', temperature: float = 0.7, cancel_event=None):
+        """
+        Chiede una risposta all'LLM per il prompt senza modificare la storia (da confermare con commit_exchange).
+        La risposta arriva in streaming: se cancel_event viene impostato, lo stream è chiuso e ritorna None.
+        Usato dalle richieste con hedging, in cui più richieste concorrenti partono dalla stessa storia.
+        """
+        if not self.openai_client:
+            raise ValueError("OpenAI client not initialized")
+        
+        messages = [dict(m) for m in self.messages] + [{'role': 'user', 'content': prompt}]
+        compact_board_history(messages, self._compacted_until)
+        
+        started = time.perf_counter()
+        with track_llm_call(model, stream=True):
+            stream = self.openai_client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                stream=True
+            )
+        
+        parts = []
+        usage_chunk = None
+        try:
+            for chunk in stream:
+                if cancel_event is not None and cancel_event.is_set():
+                    return None
+                if getattr(chunk, 'usage', None) is not None:
+                    usage_chunk = chunk
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+        finally:
+            close = getattr(stream, 'close', None)
+            if close is not None:
+                close()
+        
+        if cancel_event is not None and cancel_event.is_set():
+            return None
+        assistant_content = ''.join(parts)
+        self._record_usage(model, *usage_tokens(
+            usage_chunk, lambda: count_message_tokens(messages, model),
+            lambda: count_tokens(assistant_content, model)), started)
+        return assistant_content
+    
+    def complete_candidates(self, prompt: str, model: str = 'gpt-4.1-nano', temperature: float = 0.7, n: int = 3) -> list:
+        """
+        Chiede n risposte alternative al prompt in una sola chiamata (parametro n dell'API),
+        senza modificare la storia: la risposta scelta va confermata con commit_exchange.
+        """
+        if not self.openai_client:
+            raise ValueError("OpenAI client not initialized")
+
+        messages = [dict(m) for m in self.messages] + [{'role': 'user', 'content': prompt}]
+        compact_board_history(messages, self._compacted_until)
+
+        started = time.perf_counter()
+        with track_llm_call(model):
+            response = self.openai_client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                n=n
+            )
+
+        answers = [choice.message.content for choice in response.choices]
+        self._record_usage(model, *usage_tokens(
+            response, lambda: count_message_tokens(messages, model),
+            lambda: sum(count_tokens(a or '', model) for a in answers)), started)
+        return answers
+
+    def commit_exchange(self, prompt: str, answer: str):
+        """
+        Aggiunge alla storia il prompt e la risposta scelta (ottenuta con complete).
+        """
+        self.add_user_message(prompt)
+        self.compact_history()
+        self.add_assistant_message(answer)
+    
     def apply_move_to_board(self, piece: str, from_sq: str, to_sq: str):
         piece_map = {
             'P': 'pedoni', 'N': 'cavalli', 'B': 'alfieri', 
@@ -158,7 +315,7 @@ class GameSession:
 
 class SessionManager:
     
-    def __init__(self):
+    def __init__(self, ledger=None):
         user = os.environ.get('MONGO_USER', '')
         password = os.environ.get('MONGO_PASSWORD', '')
         
@@ -176,25 +333,41 @@ class SessionManager:
         self.moves_collection = self.db['moves']
         
         self.active_sessions = {}
+        # registro dei consumi dell'LLM (UsageLedger) per partita e utente, opzionale
+        self.ledger = ledger
     
     def create_game_session(self, user_id: str, username: str) -> GameSession:
         session_id = str(uuid.uuid4())
         
         session = GameSession(session_id, user_id, username)
         session.init_board()
+        if self.ledger is not None:
+            session.usage_sink = self.ledger.sink(session_id, username)
         
-        board_json = json.dumps(session.board_state, indent=4)
-        session.add_system_message(f'''Regole:
+        # PROMPT_ENCODING=fen invia la posizione in FEN (molti meno token del JSON indentato)
+        board_json = encode_board(session.board_state, encoding_from_env(), indent=4)
+        if protocol_from_env() == DELTA_PROTOCOL:
+            # protocollo a delta: la posizione viaggia solo qui (e nei checkpoint), i turni contengono le mosse
+            session.add_system_message(f'''Regole:
 - Tu giochi dalla parte dei Neri.
 - Devi rispondere alla mossa proposta dai Bianchi.
+{DELTA_RULES}
 Stato scacchiera iniziale: {board_json}''')
-        
-        session.add_system_message('''Obiettivi:
+            session.add_system_message('''Obiettivi:
+- Proponi una mossa valida per i Neri.''')
+            session.add_system_message(DELTA_OUTPUT)
+        else:
+            session.add_system_message(f'''Regole:
+- Tu giochi dalla parte dei Neri.
+- Devi rispondere alla mossa proposta dai Bianchi.
+Stato scacchiera iniziale: {board_json}''')
+            
+            session.add_system_message('''Obiettivi:
 - Proponi una mossa valida per i Neri.
 - Aggiorna lo stato della scacchiera dopo la tua mossa.''')
-        
-        session.add_system_message('''Output: Restituisci esclusivamente un oggetto JSON con:
-- "mossa_proposta" (es. "e7-e5")
+            
+            session.add_system_message('''Output: Restituisci esclusivamente un oggetto JSON con:
+- "mossa_proposta" (es. "e7-e5"), come prima chiave
 - "bianchi" e "neri" aggiornati con le nuove posizioni dei pezzi''')
         
         self.active_sessions[session_id] = session
@@ -224,6 +397,8 @@ Stato scacchiera iniziale: {board_json}''')
             user_id=game_doc.get('user_id', ''),
             username=game_doc.get('username', '')
         )
+        if self.ledger is not None:
+            session.usage_sink = self.ledger.sink(session_id, session.username)
         session.board_state = game_doc.get('board_state', session.init_board())
         session.status = game_doc.get('status', 'active')
         session.current_turn = game_doc.get('current_turn', 'white')
@@ -238,12 +413,21 @@ Stato scacchiera iniziale: {board_json}''')
             'timestamp': m.get('timestamp', '').isoformat() if hasattr(m.get('timestamp', ''), 'isoformat') else str(m.get('timestamp', ''))
         } for m in moves]
         
-        board_json = json.dumps(session.board_state, indent=4)
-        session.add_system_message(f'''Regole:
+        side_to_move = 'w' if session.current_turn == 'white' else 'b'
+        board_json = encode_board(session.board_state, encoding_from_env(), indent=4, side_to_move=side_to_move)
+        if protocol_from_env() == DELTA_PROTOCOL:
+            session.add_system_message(f'''Regole:
+- Tu giochi dalla parte dei Neri.
+- Devi rispondere alla mossa proposta dai Bianchi.
+{DELTA_RULES}
+Stato scacchiera: {board_json}''')
+            session.add_system_message(DELTA_OUTPUT)
+        else:
+            session.add_system_message(f'''Regole:
 - Tu giochi dalla parte dei Neri.
 - Devi rispondere alla mossa proposta dai Bianchi.
 Stato scacchiera: {board_json}''')
-        session.add_system_message('''Output: Restituisci esclusivamente un oggetto JSON con:
+            session.add_system_message('''Output: Restituisci esclusivamente un oggetto JSON con:
 - "mossa_proposta" (es. "e7-e5")
 - "bianchi" e "neri" aggiornati''')
         